@@ -65,7 +65,7 @@ def mk_preset_array_schema(is_exp):
                                                                       var='background_toggle_color')),
                     jg.Dict.make_key('shiftBackgroundColor', jg.zero_atom),
                     jg.Dict.make_key('msgArray', jg.List('Message List', 32, msg_array_schema,
-                                                         var='messages'))],
+                                                         sparse=True, var='messages'))],
                    model=backup_model.Preset)
 
 
@@ -81,11 +81,12 @@ bank_array_schema = \
          jg.Dict.make_key('bankClearToggle',
                           jg.Atom('Bank Clear Toggle', bool, False, var='clear_toggle')),
          jg.Dict.make_key('bankMsgArray',
-                          jg.List('Bank Message List', 32, msg_array_schema, var='messages')),
+                          jg.List('Bank Message List', 32, msg_array_schema, sparse=True, var='messages')),
          jg.Dict.make_key('presetArray',
-                          jg.List('Bank Preset List', 24, preset_array_schema, var='presets')),
+                          jg.List('Bank Preset List', 24, preset_array_schema, sparse=True, var='presets')),
          jg.Dict.make_key('expPresetArray',
-                          jg.List('Bank Expression Preset List', 4, exp_preset_array_schema, var='exp_presets')),
+                          jg.List('Bank Expression Preset List', 4, exp_preset_array_schema, sparse=True,
+                                  var='exp_presets')),
          jg.Dict.make_key('bankDescription',
                           jg.Atom('Bank Description', str, '', var='description')),
          jg.Dict.make_key('toDisplay',
@@ -174,6 +175,11 @@ def midi_clock_output_ports(elem, _ctxt, _lp):
     return 4095
 
 
+jg.template_functions.add(midi_clock_output_ports)
+
+
+midi_channel_atom = jg.Atom('MIDI Channel', int, 0, var='midi_channel')
+
 general_configuration_schema = \
     jg.Dict(
         'general_configurations',
@@ -189,7 +195,7 @@ general_configuration_schema = \
                   jg.Dict.make_key('ignoreMidiClock', jg.false_atom),
                   jg.Dict.make_key('crossMidiThru', jg.false_atom),
                   jg.Dict.make_key('savePresetToggle', jg.false_atom),
-                  jg.Dict.make_key('midiChannel', jg.Atom('MIDI Channel', int, 0, var='midi_channel')),
+                  jg.Dict.make_key('midiChannel', midi_channel_atom),
                   jg.Dict.make_key('switchSensitivity', jg.Atom('Switch Sensitivity', int, value=2)),
                   jg.Dict.make_key('bankChangeDelayTime', jg.zero_atom),
                   jg.Dict.make_key('bankChangeDisplayTime', jg.Atom('Bank Change Display Time', int, value=60)),
@@ -234,6 +240,9 @@ def sequencer_engine_len_hack(elem, _ctxt, _lp):
     return 0
 
 
+jg.template_functions.add(sequencer_engine_len_hack)
+
+
 # Some more than slight randomness in the backup file
 def sequencer_engine_arr_hack(elem, _ctxt, _lp):
     if isinstance(elem, int):
@@ -242,6 +251,9 @@ def sequencer_engine_arr_hack(elem, _ctxt, _lp):
     return 0
 
 
+jg.template_functions.add(sequencer_engine_arr_hack)
+
+
 sequencer_engine_schema = \
     jg.Dict(
         'sequencer_engine',
@@ -385,6 +397,16 @@ controller_settings_schema = \
                       jg.Dict.make_key('resistor_ladder_aux', resistor_ladder_aux_schema)]))])
 
 
+# Controller settings are kept as a blob: most of it is constants, only the MIDI channel names, bank arrangement and
+# MIDI channel are modelled. Blobs not seen before are checked against the full schema.
+controller_settings_blob_schema = \
+    jg.Opaque('Controller Settings', controller_settings_schema,
+              [(('data', 'controller_settings', 'data', 'midiChannel'), midi_channel_atom),
+               (('data', 'midi_channels'), midi_channels_schema),
+               (('data', 'bank_arrangement'), bank_arrangement_schema)],
+              'controller_settings', check=True)
+
+
 def download_date(_elem, _ctxt, _lp):
     return datetime.datetime.now().isoformat()
 
@@ -402,6 +424,6 @@ backup_schema = \
              "data",
              jg.Dict('data',
                      [jg.Dict.make_key('bankArray',
-                                       jg.List('Bank List', 128, bank_array_schema, var='banks')),
-                      jg.Dict.make_key('controller_settings', controller_settings_schema, required=False)]))],
+                                       jg.List('Bank List', 128, bank_array_schema, sparse=True, var='banks')),
+                      jg.Dict.make_key('controller_settings', controller_settings_blob_schema, required=False)]))],
         model=backup_model.Backup)
@@ -21,13 +21,7 @@ def msg_array_data_byte(msg_array_data, byte, mask=None):
 
 # Model object for MIDI messages
 class MidiMessage(jg.GrammarModel):
-    def __init__(self):
-        super().__init__('MidiMessage')
-        self.msg_array_data = None
-        self.channel = None
-        self.type = None
-        self.trigger = None
-        self.toggle_state = None
+    __slots__ = ('msg_array_data', 'channel', 'type', 'trigger', 'toggle_state')
 
     # compare one byte with another, handling none, and masking if desired
     def eq_helper(self, other, pos, mask=None):
@@ -84,22 +78,9 @@ class MidiMessage(jg.GrammarModel):
 
 # Model for a Preset
 class Preset(jg.GrammarModel):
-    def __init__(self):
-        super().__init__('Preset')
-        self.short_name = None
-        self.toggle_name = None
-        self.long_name = None
-        self.name_color = None
-        self.name_toggle_color = None
-        self.shifted_name_color = None
-        self.background_color = None
-        self.background_toggle_color = None
-        self.strip_color = None
-        self.strip_toggle_color = None
-        self.to_toggle = None
-        self.toggle_group = None
-        self.to_msg_scroll = None
-        self.messages = None
+    __slots__ = ('short_name', 'toggle_name', 'long_name', 'name_color', 'name_toggle_color', 'shifted_name_color',
+                 'background_color', 'background_toggle_color', 'strip_color', 'strip_toggle_color', 'to_toggle',
+                 'toggle_group', 'to_msg_scroll', 'messages')
 
     def __eq__(self, other):
         result = (isinstance(other, Preset) and
@@ -124,24 +105,14 @@ class Preset(jg.GrammarModel):
 
     def set_message(self, message, pos):
         if self.messages is None:
-            self.messages = [None] * 32
+            self.messages = jg.SparseList(32)
         self.messages[pos] = message
 
 
 # Model for a Bank
 class Bank(jg.GrammarModel):
-    def __init__(self):
-        super().__init__('Bank')
-        self.name = None
-        self.description = None
-        self.short_name = None
-        self.text_color = None
-        self.background_color = None
-        self.to_display = None
-        self.clear_toggle = None
-        self.messages = None
-        self.presets = None
-        self.exp_presets = None
+    __slots__ = ('name', 'description', 'short_name', 'text_color', 'background_color', 'to_display', 'clear_toggle',
+                 'messages', 'presets', 'exp_presets')
 
     def __eq__(self, other):
         result = (isinstance(other, Bank) and
@@ -162,25 +133,23 @@ class Bank(jg.GrammarModel):
 
     def set_preset(self, preset, pos):
         if self.presets is None:
-            self.presets = [None] * 24
+            self.presets = jg.SparseList(24)
         self.presets[pos] = preset
 
     def set_exp_preset(self, preset, pos):
         if self.exp_presets is None:
-            self.exp_presets = [None] * 4
+            self.exp_presets = jg.SparseList(4)
         self.exp_presets[pos] = preset
 
     def set_message(self, message, pos):
         if self.messages is None:
-            self.messages = [None] * 32
+            self.messages = jg.SparseList(32)
         self.messages[pos] = message
 
 
 # Model for a MIDI Channel Name mapping
 class MidiChannel(jg.GrammarModel):
-    def __init__(self):
-        super().__init__('MidiChannel')
-        self.name = None
+    __slots__ = ('name',)
 
     def __eq__(self, other):
         result = self.name == other.name
@@ -192,9 +161,7 @@ class MidiChannel(jg.GrammarModel):
 
 # Model for a Bank Arrangement Item
 class BankArrangementItem(jg.GrammarModel):
-    def __init__(self):
-        super().__init__('BankArrangementItem')
-        self.name = None
+    __slots__ = ('name',)
 
     def __eq__(self, other):
         result = self.name == other.name
@@ -206,17 +173,19 @@ class BankArrangementItem(jg.GrammarModel):
 
 # Model for the entire backup/config file
 class Backup(jg.GrammarModel):
-    def __init__(self):
-        super().__init__('Backup')
-        self.hash = None
-        self.download_date = None
-        self.banks = None
+    __slots__ = (
+        'hash',
+        'download_date',
+        'banks',
         # Midi Channels
-        self.midi_channels = None
+        'midi_channels',
         # Bank Arrangement
-        self.bank_arrangement = None
+        'bank_arrangement',
         # General Configuration
-        self.midi_channel = None
+        'midi_channel',
+        # The raw controller settings, see backup_grammar.controller_settings_blob_schema
+        'controller_settings',
+    )
 
     def __eq__(self, other):
         if self.bank_arrangement is None or other.bank_arrangement is None:
@@ -239,7 +208,7 @@ class Backup(jg.GrammarModel):
 
     def set_bank(self, bank, pos):
         if self.banks is None:
-            self.banks = [None] * 128
+            self.banks = jg.SparseList(128)
         self.banks[pos] = bank
 
     def set_bank_arrangement(self, bank_arrangement, pos):
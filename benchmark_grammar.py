@@ -0,0 +1,268 @@
+# Micro-benchmarks for the grammar engines
+#
+# Builds node shapes like the ones the real grammars spend their time in, and measures how many parse and gen
+# operations per second each grammar mode (complete, minimal) and engine (interpreted, compiled, stack) runs:
+#   message: a list of MIDI messages, like backup_grammar.msg_array_schema
+#   preset: a list of presets holding message lists, like backup_grammar.preset_array_schema
+#   switch_message: a list of switch dict messages with case models, like simple_message.mk_message_schema
+#     Its case atoms have no defaults, so like the simple grammar it is only run minimal, in an unlimited list
+# The shapes are built here, not imported, so results stay comparable as the real grammars change.
+# Their models are slotted, like the backup models.
+#
+# Each shape has a sample model with a few significant values, the rest is default as in a typical config.
+# Parsing parses the sample model genned in the grammar's mode, genning gens the sample model.
+# The grammar is reused across operations, as a conversion reuses it across banks, presets and messages.
+#
+# Results are written as JSON, and can be compared against a stored baseline:
+#   python3 benchmark_grammar.py --output baseline.json
+#   (change the engine)
+#   python3 benchmark_grammar.py --baseline baseline.json
+# Comparing exits with 1 if an operation got slower than the baseline by more than the tolerance.
+
+import argparse
+import json
+import platform
+import time
+
+import grammar as jg
+
+
+class BenchMessage(jg.GrammarModel):
+    __slots__ = ('msg_array_data', 'channel', 'type', 'trigger', 'toggle_state')
+
+    def __eq__(self, other):
+        return (isinstance(other, BenchMessage) and self.msg_array_data == other.msg_array_data and
+                self.channel == other.channel and self.type == other.type and self.trigger == other.trigger and
+                self.toggle_state == other.toggle_state)
+
+
+class BenchPreset(jg.GrammarModel):
+    __slots__ = ('short_name', 'long_name', 'to_toggle', 'strip_color', 'name_color', 'messages')
+
+    def __eq__(self, other):
+        return (isinstance(other, BenchPreset) and self.short_name == other.short_name and
+                self.long_name == other.long_name and self.to_toggle == other.to_toggle and
+                self.strip_color == other.strip_color and self.name_color == other.name_color and
+                self.messages == other.messages)
+
+
+class BenchSwitchMessage(jg.GrammarModel):
+    __slots__ = ('name', 'type', 'trigger', 'toggle_state', 'specific_message')
+
+    def __eq__(self, other):
+        return (isinstance(other, BenchSwitchMessage) and self.name == other.name and self.type == other.type and
+                self.trigger == other.trigger and self.toggle_state == other.toggle_state and
+                self.specific_message == other.specific_message)
+
+
+class BenchPCModel(jg.GrammarModel):
+    __slots__ = ('number', 'channel')
+
+    def __eq__(self, other):
+        return isinstance(other, BenchPCModel) and self.number == other.number and self.channel == other.channel
+
+
+class BenchCCModel(jg.GrammarModel):
+    __slots__ = ('number', 'value', 'channel')
+
+    def __eq__(self, other):
+        return (isinstance(other, BenchCCModel) and self.number == other.number and self.value == other.value and
+                self.channel == other.channel)
+
+
+message_schema = \
+    jg.Dict('Message Array',
+            [jg.Dict.make_key('data', jg.List('Data List', 18, jg.Atom('Data', int, 0), var='msg_array_data')),
+             jg.Dict.make_key('m', jg.Atom('Message Number', int, value=jg.identity)),
+             jg.Dict.make_key('c', jg.Atom('Channel', int, 1, var='channel')),
+             jg.Dict.make_key('t', jg.Atom('Type', int, 0, var='type')),
+             jg.Dict.make_key('a', jg.Atom('Trigger', int, 0, var='trigger')),
+             jg.Dict.make_key('tg', jg.Atom('Toggle Group', int, 2, var='toggle_state')),
+             jg.Dict.make_key('mi', jg.Atom('mi', str, value=''))],
+            model=BenchMessage)
+
+preset_schema = \
+    jg.Dict('Preset Array',
+            [jg.Dict.make_key('presetNum', jg.identity_atom),
+             jg.Dict.make_key('isExp', jg.false_atom),
+             jg.Dict.make_key('shortName', jg.Atom('Short Name', str, 'EMPTY', var='short_name')),
+             jg.Dict.make_key('toggleName', jg.empty_atom),
+             jg.Dict.make_key('longName', jg.Atom('Long Name', str, '', var='long_name')),
+             jg.Dict.make_key('toToggle', jg.Atom('To Toggle', bool, False, var='to_toggle')),
+             jg.Dict.make_key('toBlink', jg.false_atom),
+             jg.Dict.make_key('ledColor', jg.Atom('Strip Color', int, 0, var='strip_color')),
+             jg.Dict.make_key('ledShiftColor', jg.zero_atom),
+             jg.Dict.make_key('nameColor', jg.Atom('Name Color', int, 7, var='name_color')),
+             jg.Dict.make_key('msgArray', jg.List('Message List', 16, message_schema, var='messages'))],
+            model=BenchPreset)
+
+switch_message_types = ['unused', 'PC', 'CC']
+switch_message_triggers = ['Press', 'Release', 'Long Press']
+switch_message_toggles = ['one', 'two', 'both']
+
+switch_message_schema = \
+    jg.SwitchDict('message_schema',
+                  jg.SwitchDict.make_key('type', jg.Enum('Type', switch_message_types, 'unused', var='type')),
+                  {'unused': [],
+                   'PC': [BenchPCModel,
+                          jg.SwitchDict.make_key('number', jg.Atom('Number', int, var='number')),
+                          jg.SwitchDict.make_key('channel', jg.Atom('Channel', int, var='channel'), required=True)],
+                   'CC': [BenchCCModel,
+                          jg.SwitchDict.make_key('number', jg.Atom('Number', int, var='number')),
+                          jg.SwitchDict.make_key('value', jg.Atom('Value', int, var='value')),
+                          jg.SwitchDict.make_key('channel', jg.Atom('Channel', int, var='channel'), required=True)]},
+                  [jg.SwitchDict.make_key('name', jg.Atom('Name', str, '', var='name')),
+                   jg.SwitchDict.make_key('trigger', jg.Enum('Trigger', switch_message_triggers, 'Press',
+                                                             var='trigger')),
+                   jg.SwitchDict.make_key('toggle_state', jg.Enum('Toggle', switch_message_toggles, 'both',
+                                                                  var='toggle_state'))],
+                  model=BenchSwitchMessage, model_var='specific_message')
+
+
+def make_message(channel, message_type, data):
+    message = BenchMessage()
+    message.channel = channel
+    message.type = message_type
+    message.msg_array_data = data
+    return message
+
+
+def make_messages():
+    messages = [None] * 32
+    messages[0] = make_message(2, 1, [5] + [None] * 17)
+    messages[3] = make_message(3, 2, [7, 127] + [None] * 16)
+    return messages
+
+
+def make_presets():
+    presets = [None] * 24
+    for pos in [0, 5]:
+        preset = BenchPreset()
+        preset.short_name = 'P' + str(pos)
+        preset.name_color = 3
+        messages = [None] * 16
+        messages[0] = make_message(2, 1, [pos] + [None] * 17)
+        preset.messages = messages
+        presets[pos] = preset
+    return presets
+
+
+def make_switch_messages():
+    messages = []
+    for pos in range(8):
+        message = BenchSwitchMessage()
+        if pos % 2 == 0:
+            message.type = 'PC'
+            message.specific_message = BenchPCModel()
+        else:
+            message.type = 'CC'
+            message.specific_message = BenchCCModel()
+            message.specific_message.value = 127
+            message.trigger = 'Release'
+        message.name = message.type + ' ' + str(pos)
+        message.specific_message.number = pos
+        message.specific_message.channel = pos % 4 + 1
+        messages.append(message)
+    return messages
+
+
+modes = {'complete': False, 'minimal': True}
+# shape name: (schema, function making the sample model, the modes it runs in)
+shapes = {'message': (jg.List('Message List', 32, message_schema), make_messages, list(modes)),
+          'preset': (jg.List('Preset List', 24, preset_schema), make_presets, list(modes)),
+          'switch_message': (jg.List('Message List', 0, switch_message_schema), make_switch_messages, ['minimal'])}
+engines = ['interpreted', 'compiled', 'stack']
+operations = ['parse', 'gen']
+
+
+def make_grammar(schema, minimal, engine):
+    grammar = jg.Grammar(schema, minimal)
+    if engine == 'compiled':
+        grammar.compile()
+    elif engine == 'stack':
+        grammar.use_stack_engine()
+    return grammar
+
+
+# The best operations per second over the repeats, each repeat runs for at least min_time seconds
+# The first call is not timed, so the one-time work (key tables, templates) isn't counted
+def ops_per_sec(operation, min_time, repeat):
+    operation()
+    best = 0.0
+    for _ in range(repeat):
+        count = 0
+        start = time.perf_counter()
+        while True:
+            operation()
+            count += 1
+            elapsed = time.perf_counter() - start
+            if elapsed >= min_time:
+                break
+        best = max(best, count / elapsed)
+    return best
+
+
+# Returns {'shape/mode/engine/operation': operations per second}
+def run(shape_names=None, mode_names=None, engine_names=None, min_time=0.2, repeat=3):
+    results = {}
+    for shape_name in shape_names or shapes:
+        schema, make_model, shape_modes = shapes[shape_name]
+        model = make_model()
+        for mode_name in mode_names or modes:
+            if mode_name not in shape_modes:
+                continue
+            for engine in engine_names or engines:
+                grammar = make_grammar(schema, modes[mode_name], engine)
+                elem = grammar.gen_config(model)
+                key = '/'.join([shape_name, mode_name, engine])
+                results[key + '/parse'] = ops_per_sec(lambda: grammar.parse_config(elem), min_time, repeat)
+                results[key + '/gen'] = ops_per_sec(lambda: grammar.gen_config(model), min_time, repeat)
+    return results
+
+
+# Compare results against a baseline, returning the report lines and the keys that got slower than the tolerance
+# (a fraction of the baseline)
+def compare(results, baseline, tolerance):
+    lines = ['%-48s %12s %12s %8s' % ('Benchmark', 'Baseline', 'Current', 'Ratio')]
+    regressions = []
+    for key, current in results.items():
+        if key not in baseline:
+            lines.append('%-48s %12s %12.1f %8s' % (key, '-', current, '-'))
+            continue
+        ratio = current / baseline[key]
+        marker = ''
+        if ratio < 1 - tolerance:
+            regressions.append(key)
+            marker = ' slower'
+        lines.append('%-48s %12.1f %12.1f %8.2f%s' % (key, baseline[key], current, ratio, marker))
+    return lines, regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the grammar engines on representative node shapes')
+    parser.add_argument('--shape', action='append', choices=list(shapes), help='A shape to run (default all)')
+    parser.add_argument('--mode', action='append', choices=list(modes), help='A grammar mode to run (default all)')
+    parser.add_argument('--engine', action='append', choices=engines, help='An engine to run (default all)')
+    parser.add_argument('--min-time', type=float, default=0.2, help='The minimum seconds to run each benchmark')
+    parser.add_argument('--repeat', type=int, default=3, help='The number of times to run each benchmark')
+    parser.add_argument('--output', help='Write the results to this JSON file')
+    parser.add_argument('--baseline', help='Compare the results to this JSON file of earlier results')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='The fraction an operation may be slower than the baseline')
+    args = parser.parse_args()
+
+    benchmark_results = run(args.shape, args.mode, args.engine, args.min_time, args.repeat)
+    if args.output is not None:
+        with open(args.output, 'w') as output_file:
+            json.dump({'python': platform.python_version(), 'results': benchmark_results}, output_file, indent=4)
+    if args.baseline is None:
+        for result_key, result in benchmark_results.items():
+            print('%-48s %12.1f ops/sec' % (result_key, result))
+    else:
+        with open(args.baseline) as baseline_file:
+            baseline_results = json.load(baseline_file)['results']
+        report, slower = compare(benchmark_results, baseline_results, args.tolerance)
+        print('\n'.join(report))
+        if slower:
+            print(str(len(slower)) + ' benchmarks are slower than the baseline')
+            exit(1)
@@ -1,8 +1,24 @@
+import concurrent.futures
+import contextlib
 import copy
-import inspect
+import hashlib
+import importlib
+import io
 import json
+import marshal
+import os
+import pickle
+import time
 import yaml
+import zlib
 import re
+import shutil
+import sys
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 
 # JSON/YAML Grammar
@@ -35,6 +51,7 @@ import re
 # Lists can also be unlimited (length == 0), only for minimal grammars
 # Enums are lists of constants, used for color names (for example) or for switch keys in dictionaries
 # Atoms are ints, strings, or booleans
+# Opaque elements keep a subtree as a raw blob, only parsing the few parts of it that are modelled
 #
 # All grammar elements have var, model and cleanup bindings (optional)
 # A var binding means that when that element is encountered while parsing, it is bound to that variable in the current
@@ -54,6 +71,8 @@ import re
 # The "context" is the immediately enclosing dictionary or list element
 # The list position is a list of integers, representing which position in the list this element occurred in, with the
 # innermost being the last in the list
+# The list position is a single list shared by the whole parse or gen, lists push and pop their positions on it.
+# A function that needs to keep the position must copy it.
 #
 # Models are python classes, with variables mapping to values.
 # All models must inherit from GrammarModel
@@ -63,29 +82,387 @@ class GrammarException(Exception):
     pass
 
 
+# The debugging trail: the names of the nodes and keys leading to the node being parsed
+# Like the list position, it is a single stack shared by the whole parse, nodes push and pop their names on it.
+# It is only joined into a string when an error message is built.
+# A string name (as passed to parse_config or to a node directly) starts a new trail
+class GrammarPath(list):
+    def __init__(self, name=""):
+        super().__init__()
+        if name != "":
+            self.append(name)
+
+    @staticmethod
+    def of(name):
+        if isinstance(name, GrammarPath):
+            return name
+        return GrammarPath(name)
+
+    def __str__(self):
+        return ':'.join(self)
+
+
+# Models hold the parse results bound to variables
+# A model declares its variables either as attributes set in __init__, or as __slots__:
+#   class Message(GrammarModel):
+#       __slots__ = ('channel', 'type')
+# Slotted models have no per instance __dict__, their variables are set to None by GrammarModel.__init__, and the
+# model name is the class name unless the class sets model_name. A backup has tens of thousands of models, so its
+# models are slotted. make_model_class builds a slotted model from the variables bound in a schema.
+#
+# Digests: digest() is a hash of a model's variables, following sub-models, lists and dicts. Two models with equal
+# digests are the same model, so equals() compares digests, and diff() skips sub-models whose digests are equal.
+# Unlike the models' __eq__, neither sets modified.
+# A digest is cached in its model until a variable of the model is set. The digest of an enclosing model includes it,
+# so each model keeps the models whose cached digests include its own (digest_parents), and drops their caches too.
+# Lists and dicts in a model aren't watched: after changing one in place, call the model's invalidate_digests().
+# Setting variables is only watched on models that have been digested or frozen: watch() moves the model to a twin of
+# its class (watched_class) whose __setattr__ checks and invalidates, so parsing and genning bind variables at full
+# speed. plain_class is the class a model was made with, copies and pickles are made of it.
+#
+# Frozen models are shared by interning (see Grammar.use_interning), setting the variables their schema binds raises
+# frozen_model. frozen is the set of those variables. Other attributes, like modified or the state kept by
+# conversions, can still be set. A copy of a frozen model isn't frozen.
 class GrammarModel:
     """Base class for models, includes the modified boolean"""
-    def __init__(self, name):
+    __slots__ = ('modified', 'digest_cache', 'frozen', 'digest_parents')
+    model_name = 'GrammarModel'
+    # The variables of a slotted model, None when instances have a __dict__
+    model_fields = None
+    # The slots kept by watch(), digest() and freeze(), which a copy doesn't share
+    unshared_slots = frozenset(['digest_cache', 'frozen', 'digest_parents'])
+    plain_class = None
+    watched_class = None
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if 'model_name' not in cls.__dict__:
+            cls.model_name = cls.__name__
+        if 'plain_class' not in cls.__dict__:
+            cls.plain_class = cls
+            cls.watched_class = None
+        fields = []
+        for klass in cls.__mro__:
+            if klass is GrammarModel:
+                break
+            slots = klass.__dict__.get('__slots__')
+            if isinstance(slots, str):
+                slots = (slots,)
+            if slots is None or '__dict__' in slots:
+                fields = None
+                break
+            fields.extend(slots)
+        cls.model_fields = None if fields is None else frozenset(fields)
+
+    def __init__(self, name=None):
+        self.digest_cache = None
+        self.frozen = None
+        self.digest_parents = None
         self.modified = False
-        self.model_name = name
+        if name is not None and name != self.model_name:
+            self.model_name = name
+        if self.model_fields is not None:
+            for field in self.model_fields:
+                setattr(self, field, None)
 
-    def get_var(self, variable):
-        model_vars = vars(self)
-        if variable not in model_vars:
-            raise GrammarException('model_missing_var', 'In ' + name + ' the model ' + self.model_name +
-                                   ' is missing the variable ' + variable)
-        return model_vars[variable]
+    # The __setattr__ of watched classes
+    def watched_setattr(self, name, value):
+        if name != 'modified':
+            if name in self.unshared_slots:
+                raise GrammarException('model_internal_slot', 'The slot ' + name + ' of the model ' + self.model_name +
+                                       ' is kept by the model itself, and can not be set')
+            frozen = self.frozen
+            if frozen and name in frozen:
+                raise GrammarException('frozen_model', 'The model ' + self.model_name + ' is shared, so its variable ' +
+                                       name + ' can not be set')
+            if self.digest_cache is not None or self.digest_parents is not None:
+                self.invalidate_digests()
+        object.__setattr__(self, name, value)
+
+    # Watch setting variables from now on, see GrammarModel
+    def watch(self):
+        cls = type(self)
+        if cls.plain_class is not cls:
+            return
+        watched = cls.watched_class
+        if watched is None:
+            watched = type(cls.__name__, (cls,), {'__slots__': (), '__module__': cls.__module__,
+                                                  '__qualname__': cls.__qualname__, 'model_name': cls.model_name,
+                                                  'plain_class': cls, '__setattr__': GrammarModel.watched_setattr})
+            cls.watched_class = watched
+        object.__setattr__(self, '__class__', watched)
+
+    # Copies and pickles are made of the plain class, and leave out the digest cache, parents and frozen set, as the
+    # parents would take the enclosing models along
+    def __reduce_ex__(self, protocol):
+        return new_model, (self.plain_class,), self.__getstate__()
+
+    def __getstate__(self):
+        slots = {}
+        for klass in type(self).__mro__:
+            names = klass.__dict__.get('__slots__', ())
+            for name in (names,) if isinstance(names, str) else names:
+                if name in self.unshared_slots:
+                    slots[name] = None
+                elif name != '__dict__' and name != '__weakref__' and hasattr(self, name):
+                    slots[name] = getattr(self, name)
+        return getattr(self, '__dict__', None), slots
+
+    # variables is a frozenset, shared by the models of a class
+    def freeze(self, variables):
+        self.watch()
+        object.__setattr__(self, 'frozen', variables)
+
+    # Drop the cached digest, and those of the models that include it
+    def invalidate_digests(self):
+        object.__setattr__(self, 'digest_cache', None)
+        parents = self.digest_parents
+        if parents is not None:
+            object.__setattr__(self, 'digest_parents', None)
+            for parent in parents.values():
+                parent.invalidate_digests()
+
+    # parent's digest includes this model's, parents are kept by id as models may define __eq__
+    def add_digest_parent(self, parent):
+        parents = self.digest_parents
+        if parents is None:
+            parents = {}
+            object.__setattr__(self, 'digest_parents', parents)
+        parents[id(parent)] = parent
+
+    def digest_fields(self):
+        if self.model_fields is not None:
+            return sorted(self.model_fields)
+        return sorted(vars(self))
+
+    def digest(self):
+        if self.digest_cache is not None:
+            return self.digest_cache
+        self.watch()
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(self.model_name.encode())
+        for field in self.digest_fields():
+            digest.update(b'.' + field.encode())
+            update_digest(digest, getattr(self, field), self)
+        result = digest.digest()
+        object.__setattr__(self, 'digest_cache', result)
+        return result
+
+    def equals(self, other):
+        return self is other or (isinstance(other, GrammarModel) and self.digest() == other.digest())
+
+    # The paths where this model and other differ, like Backup.banks[2].presets[0].short_name
+    # Only the first difference unless every is True
+    def diff(self, other, every=False):
+        result = []
+        diff_values(self, other, self.model_name, result, every)
+        return result
+
+    def has_var(self, variable):
+        if self.model_fields is not None:
+            return variable in self.model_fields
+        return variable in vars(self)
+
+    def get_var(self, variable, name=None):
+        fields = self.model_fields
+        if fields is not None:
+            if variable in fields:
+                return getattr(self, variable)
+        else:
+            model_vars = vars(self)
+            if variable in model_vars:
+                return model_vars[variable]
+        raise GrammarException('model_missing_var', 'In ' + str(name) + ' the model ' + self.model_name +
+                               ' is missing the variable ' + variable)
 
     def set_var(self, variable, result, name):
         self.modified = True
+        fields = self.model_fields
+        if fields is not None:
+            if variable not in fields:
+                raise GrammarException('model_missing_var', 'In ' + str(name) + ' the model ' + self.model_name +
+                                       ' is missing the variable ' + variable)
+            if getattr(self, variable) is not None:
+                raise GrammarException('multiply_assigned_var', 'In ' + str(name) + ' with model ' +
+                                       self.model_name + ' the variable ' + variable + ' is assigned multiple times')
+            setattr(self, variable, result)
+            return
         model_vars = vars(self)
         if variable not in model_vars:
-            raise GrammarException('model_missing_var', 'In ' + name + ' the model ' + self.model_name +
+            raise GrammarException('model_missing_var', 'In ' + str(name) + ' the model ' + self.model_name +
                                    ' is missing the variable ' + variable)
         if model_vars[variable] is not None:
-            raise GrammarException('multiply_assigned_var', 'In ' + name + ' with model ' + self.model_name +
+            raise GrammarException('multiply_assigned_var', 'In ' + str(name) + ' with model ' + self.model_name +
                                    ' the variable ' + variable + ' is assigned multiple times')
-        model_vars[variable] = result
+        setattr(self, variable, result)
+
+
+GrammarModel.plain_class = GrammarModel
+
+
+# Make an uninitialized model when copying or unpickling, see GrammarModel.__reduce_ex__
+def new_model(model_class):
+    return model_class.__new__(model_class)
+
+
+# A schema value in a fingerprint (see Grammar.fingerprint): functions and classes by their qualified name, as their
+# addresses change from run to run, and other values by repr
+def describe_value(value):
+    if callable(value):
+        return getattr(value, '__module__', '') + '.' + getattr(value, '__qualname__', repr(value))
+    return repr(value)
+
+
+# Add a variable's value of model to model's digest
+# The type is hashed with the value, so 1, True and '1' differ
+def update_digest(digest, value, model):
+    if isinstance(value, GrammarModel):
+        value.add_digest_parent(model)
+        digest.update(b'M')
+        digest.update(value.digest())
+    elif isinstance(value, LazyList):
+        update_digest(digest, value.resolve(), model)
+    elif isinstance(value, (list, tuple, SparseList)):
+        digest.update(b'[' + str(len(value)).encode())
+        for item in value:
+            update_digest(digest, item, model)
+    elif isinstance(value, dict):
+        digest.update(b'{' + str(len(value)).encode())
+        for key in sorted(value, key=repr):
+            update_digest(digest, key, model)
+            update_digest(digest, value[key], model)
+    else:
+        digest.update(b'(' + type(value).__name__.encode() + b')' + repr(value).encode() + b';')
+
+
+# Add the paths where value and other differ to result, see GrammarModel.diff
+def diff_values(value, other, path, result, every):
+    if isinstance(value, LazyList):
+        value = value.resolve()
+    if isinstance(other, LazyList):
+        other = other.resolve()
+    if isinstance(value, GrammarModel) and isinstance(other, GrammarModel):
+        if value.plain_class is not other.plain_class or value.model_name != other.model_name:
+            result.append(path)
+        elif value.digest() != other.digest():
+            fields = value.digest_fields()
+            if value.model_fields is None:
+                fields = sorted(set(fields) | set(other.digest_fields()))
+            for field in fields:
+                if not hasattr(value, field) or not hasattr(other, field):
+                    result.append(path + '.' + field)
+                else:
+                    diff_values(getattr(value, field), getattr(other, field), path + '.' + field, result, every)
+                if result and not every:
+                    return
+    elif isinstance(value, SparseList) and isinstance(other, (list, SparseList)):
+        diff_values(value.to_list(), list(other), path, result, every)
+    elif isinstance(value, list) and isinstance(other, SparseList):
+        diff_values(value, other.to_list(), path, result, every)
+    elif isinstance(value, (list, tuple)) and type(value) is type(other):
+        if len(value) != len(other):
+            result.append(path)
+            return
+        for pos, item in enumerate(value):
+            diff_values(item, other[pos], path + '[' + str(pos) + ']', result, every)
+            if result and not every:
+                return
+    elif isinstance(value, dict) and isinstance(other, dict):
+        for key in sorted(set(value) | set(other), key=repr):
+            if key not in value or key not in other:
+                result.append(path + '[' + repr(key) + ']')
+            else:
+                diff_values(value[key], other[key], path + '[' + repr(key) + ']', result, every)
+            if result and not every:
+                return
+    elif type(value) is not type(other) or isinstance(value, GrammarModel) or value != other:
+        result.append(path)
+
+
+# Build a slotted model class with the given variables, see GrammarModel
+def make_model_class(name, fields, base=GrammarModel):
+    return type(name, (base,), {'__slots__': tuple(fields)})
+
+
+# Interning (see Grammar.use_interning): structurally identical models, lists and dicts are replaced by one shared
+# instance, and strings are interned
+# Values are interned bottom up, so the key of a model, list or dict only holds the ids of its interned parts. The
+# table keeps the interned values, so their ids aren't reused while it is in use.
+# model_vars are the variables frozen in each model class, as returned by Grammar.model_vars
+# Lists and dicts whose parts are already interned are kept, rather than copied
+class InternTable:
+    def __init__(self, model_vars):
+        self.model_vars = {model_class: frozenset(variables) for model_class, variables in model_vars.items()}
+        self.values = {}
+
+    # Returns the interned value and its key
+    def intern(self, value):
+        if type(value) is LazyList:
+            value = value.resolve()
+        value_type = type(value)
+        if value_type is str:
+            value = sys.intern(value)
+            return value, (str, value)
+        if value is None or value_type is int or value_type is bool:
+            return value, (value_type, value)
+        # 0.0 and -0.0 are equal but differ in repr, which also gives NaNs one key
+        if value_type is float:
+            return value, (float, repr(value))
+        if isinstance(value, GrammarModel):
+            value_type = value.plain_class
+            fields = value.digest_fields()
+            interned = [self.intern(getattr(value, field)) for field in fields]
+            key = (value_type, value.model_name, tuple(fields), tuple(item_key for _, item_key in interned))
+            shared = self.values.get(key)
+            if shared is None:
+                for field, (field_value, _) in zip(fields, interned):
+                    object.__setattr__(value, field, field_value)
+                if value_type not in self.model_vars:
+                    self.model_vars[value_type] = frozenset(fields)
+                value.freeze(self.model_vars[value_type])
+                shared = self.values[key] = value
+        elif value_type is list or value_type is tuple:
+            interned = [self.intern(item) for item in value]
+            key = (value_type, tuple(item_key for _, item_key in interned))
+            shared = self.values.get(key)
+            if shared is None:
+                if any(item is not value[pos] for pos, (item, _) in enumerate(interned)):
+                    value = value_type(item for item, _ in interned)
+                shared = self.values[key] = value
+        elif value_type is SparseList:
+            interned = [(pos, self.intern(item)) for pos, item in value.populated()]
+            key = (SparseList, value.length, tuple((pos, item[1]) for pos, item in interned))
+            shared = self.values.get(key)
+            if shared is None:
+                if any(item[0] is not value.entries[pos] for pos, item in interned):
+                    value = SparseList(value.length, {pos: item[0] for pos, item in interned})
+                shared = self.values[key] = value
+        elif value_type is dict:
+            interned = [(self.intern(item_key), self.intern(item)) for item_key, item in value.items()]
+            key = (dict, tuple((item_key[1], item[1]) for item_key, item in interned))
+            shared = self.values.get(key)
+            if shared is None:
+                if any(item[0] is not value[item_key[0]] for item_key, item in interned):
+                    value = {item_key[0]: item[0] for item_key, item in interned}
+                shared = self.values[key] = value
+        else:
+            shared = self.values.setdefault(('id', id(value)), value)
+        return shared, ('id', id(shared))
+
+
+# A schema key, made by DictBase.make_key: a dict of the key's name, schema and required flag
+# Keys can't be changed once made, so key lists and the nodes in them are shared between schemas (and threads) rather
+# than copied. They pickle as a plain dict of their items.
+class SchemaKey(dict):
+    __slots__ = ()
+
+    def frozen_key(self, *args, **kwargs):
+        raise GrammarException('frozen_schema_key', 'The schema key ' + str(self.get('name')) + ' can not be changed')
+
+    __setitem__ = __delitem__ = __ior__ = clear = pop = popitem = setdefault = update = frozen_key
+
+    def __reduce__(self):
+        return SchemaKey, (dict(self),)
 
 
 # The base class for all grammar modes
@@ -103,18 +480,90 @@ class GrammarNode:
     def gen(self, grammar, model, context, list_pos):
         raise GrammarException("virtual-method", "Attempted virtual method call: GrammarNode.gen")
 
+    # Stack engine: container nodes have parse_steps and gen_steps, generator versions of parse and gen
+    # Instead of recursing, they yield the steps for their sub-elements to Grammar.run_steps and are sent back the
+    # results
+    # Leaf nodes don't recurse, so they are parsed and genned directly
+    container = False
+
+    # Compiling: return a closure equivalent to parse/gen for this node, with the schema decisions already made
+    # parse closures are called as f(elem, context, list_pos, model), gen closures as f(model, context, list_pos)
+    # Nodes that don't specialize fall back to the interpreted methods
+    def compile_parse(self, grammar, name):
+        def parse_node(elem, context, list_pos, model):
+            return self.parse(grammar, elem, name, context, list_pos, model)
+        return parse_node
+
+    def compile_gen(self, grammar):
+        def gen_node(model, context, list_pos):
+            return self.gen(grammar, model, context, list_pos)
+        return gen_node
+
+    # Validating: the checks of parse, without building models or results (see Grammar.validate)
+    # Leaf nodes don't build anything, so they validate by parsing
+    def validate(self, grammar, elem, name, context, list_pos):
+        self.parse(grammar, elem, name, context, list_pos, None)
+
+    # Model variables: add the variables the children of this node bind to result, a dict of model class to variable
+    # names. model is the model class the children bind into. See Grammar.model_vars
+    def collect_vars(self, model, result):
+        pass
+
+    # The child nodes of this node, see Grammar.find_nodes
+    def children(self):
+        return ()
+
+    # The structure of this node for Grammar.fingerprint, as a tuple of names, values (see describe_value) and the
+    # fingerprints of its children, from child_fingerprint(child node)
+    def describe(self, child_fingerprint):
+        return (type(self).__name__, self.name, describe_value(self.variable), describe_value(self.model),
+                describe_value(self.cleanup))
+
+    # Paths (see Grammar.gen_at and parse_at): the child a path step addresses, with the list position pushed
+    # path_gen_step returns (child schema, the model the child is genned from)
+    # path_parse_step returns (child schema, the model class the child binds into, the child element or None)
+    # Leaf nodes have no children
+    def path_gen_step(self, grammar, step, model, list_pos):
+        raise self.path_error(step)
+
+    def path_parse_step(self, grammar, step, elem, model_class, list_pos):
+        raise self.path_error(step)
+
+    def path_error(self, step):
+        return GrammarException('path_not_found', 'The ' + type(self).__name__ + ' ' + self.name + ' has no ' +
+                                str(step))
+
+    # Gen templates: True if genning this node without a model, in a complete grammar, only depends on the list
+    # position. See Grammar.gen_template
+    def templatable(self):
+        return False
+
+    # Context: True if parsing or genning this node may call a value or default function with its context, the
+    # enclosing element. Callers that don't have the enclosing element (streaming, paths, parallel lists) gen or parse
+    # the enclosing node instead, or refuse the node. Containers build their own context for their children.
+    def reads_context(self):
+        return False
+
     def print(self, indent):
         raise GrammarException("virtual-method", "Attempted virtual method call: GrammarNode.print")
 
 
 # Base class for Dict and SwitchDict nodes
 class DictBase(GrammarNode):
+    container = True
+
     def __init__(self, name, **kwargs):
         super().__init__(name, **kwargs)
+        # Maps key names to keys, built on first use by make_key_table
+        self.key_table = None
 
     @staticmethod
     def make_key(key_name, key_schema, required=None):
-        return {'name': key_name, 'schema': key_schema, 'required': required}
+        return SchemaKey({'name': key_name, 'schema': key_schema, 'required': required})
+
+    @staticmethod
+    def describe_keys(keys, child_fingerprint):
+        return tuple((key['name'], key['required'], child_fingerprint(key['schema'])) for key in keys)
 
     @staticmethod
     def lookup_key(key_name, key_list):
@@ -123,86 +572,188 @@ class DictBase(GrammarNode):
                 return potential_match['name']
         return False
 
+    # Key tables map each key name the schema knows about to its key, so checking an element's keys doesn't scan
+    # the key lists
+    # They are built when the grammar is first used, so a duplicate key is reported as a parse error
+    @staticmethod
+    def make_key_table(keys, key_table):
+        for key in keys:
+            if key['name'] in key_table:
+                raise GrammarException('dict_duplicate_keys', 'grammar has duplicate keys')
+            key_table[key['name']] = key
+        return key_table
+
     @staticmethod
     def check_elem(elem):
         if not isinstance(elem, dict):
             raise GrammarException('type_not_dict', "parse called on non-dict")
 
+    # If 'required' is explicit, that takes precedence
+    # Otherwise it is set to True for complete, false for minimal grammars
+    @staticmethod
+    def key_required(grammar, key):
+        if key['required'] is None:
+            return not grammar.minimal
+        return key['required']
+
+    @staticmethod
+    def missing_key_error(name, key_name, elem):
+        return GrammarException(
+            'dict_bad_keys',
+            "Parse position: " + str(name) + ", error: parse dictionary/switch dictionary expected key: \"" +
+            key_name + "\" but didn't find it in " + str(elem.keys()))
+
+    @staticmethod
+    def switch_model_result_error(name, key_name):
+        msg = ('Paring SwitchDict ' + str(name) + ' the key ' + key_name +
+               'returned a result instead of being stored in the switch model')
+        return GrammarException('switch_model_result', msg)
+
+    @staticmethod
+    def undefined_keys_error(name, missing_keys, non_model_keys, model_keys):
+        message = 'While parsing ' + str(name) + ' the following keys are undefined: '
+        message += ", ".join(missing_keys)
+        valid_keys = []
+        for key in non_model_keys:
+            valid_keys.append(key['name'])
+        for key in model_keys:
+            valid_keys.append(key['name'])
+        message += "\nThe valid keys are: " + ", ".join(valid_keys)
+        return GrammarException('dict_bad_keys', message)
+
     @staticmethod
-    def parse_key(grammar, elem, name, list_pos, model, key, found_keys_name, result, seen_keys):
+    def parse_key(grammar, elem, name, list_pos, model, key, result):
         found_keys = 0
-        if key['name'] not in elem:
-            # If 'required' is explicit, that takes precedence
-            # Otherwise it is set to True for complete, false for minimal grammars
-            if key['required'] is None:
-                required = not grammar.minimal
-            else:
-                required = key['required']
-            if not required:
+        key_name = key['name']
+        if key_name not in elem:
+            if not DictBase.key_required(grammar, key):
                 key_result = None
             else:
-                raise GrammarException(
-                    'dict_bad_keys',
-                    "Parse position: " + name + ", error: parse dictionary/switch dictionary expected key: \"" +
-                    key['name'] + "\" but didn't find it in " + str(elem.keys()))
+                raise DictBase.missing_key_error(name, key_name, elem)
         else:
             found_keys = 1
-            found_keys_name.append(key['name'])
             # Note we update the context with the elem for sub-parsing
-            key_result = grammar.parse(elem[key['name']], key['schema'], name + ':' + key['name'], elem, list_pos,
-                                       model)
-        if key['name'] in seen_keys:
-            raise GrammarException('dict_duplicate_keys', 'grammar has duplicate keys')
-        seen_keys[key['name']] = True
+            name.append(key_name)
+            key_result = grammar.parse(elem[key_name], key['schema'], name, elem, list_pos, model)
+            name.pop()
         # Only store if significant
         if key_result is not None:
             if result is None:
-                msg = ('Paring SwitchDict ' + name + ' the key ' + key['name'] +
-                       'returned a result instead of being stored in the switch model')
-                raise GrammarException('switch_model_result', msg)
-            result[key['name']] = key_result
+                raise DictBase.switch_model_result_error(name, key_name)
+            result[key_name] = key_result
 
         return found_keys
 
+    # key_table holds all the key names the schema knows about (including any switch key)
+    # Found keys is the number of keys found in the elem while processing the schema (1 for the switch key of a
+    # switch dict)
+    # If this is not the total number of keys in the elem, some keys didn't match
     def parse_keys(self, grammar, elem, name, list_pos, model, non_model_keys, model_keys, switch_model, result,
-                   seen_keys):
-        self.check_elem(elem)
-
-        # The list of keys seen ensures we don't allow keys to appear twice
-        # Found keys is the number of keys found in the elem while processing the schema
-        # If this is not the total number of keys in the elem, some keys didn't match
-        found_keys = len(seen_keys)
-        found_keys_name = []
-        for key in seen_keys:
-            found_keys_name.append(key)
-
+                   key_table, found_keys):
         # process each schema key
         for key in non_model_keys:
-            found_keys += self.parse_key(grammar, elem, name, list_pos, model, key, found_keys_name, result, seen_keys)
+            found_keys += self.parse_key(grammar, elem, name, list_pos, model, key, result)
 
         for key in model_keys:
-            found_keys += self.parse_key(grammar, elem, name, list_pos, switch_model, key, found_keys_name, None,
-                                         seen_keys)
+            found_keys += self.parse_key(grammar, elem, name, list_pos, switch_model, key, None)
 
         # Make sure all keys in the elem were processed
         if found_keys < len(elem):
-            missing_keys = []
-            for key in elem:
-                if key not in found_keys_name:
-                    missing_keys.append(key)
-            message = 'While parsing ' + name + ' the following keys are undefined: '
-            message += ", ".join(missing_keys)
-            valid_keys = []
-            for key in non_model_keys:
-                valid_keys.append(key['name'])
-            for key in model_keys:
-                valid_keys.append(key['name'])
-            message += "\nThe valid keys are: " + ", ".join(valid_keys)
-            raise GrammarException('dict_bad_keys', message)
+            missing_keys = [key for key in elem if key not in key_table]
+            raise DictBase.undefined_keys_error(name, missing_keys, non_model_keys, model_keys)
+        if result == {}:
+            return None
+        return result
+
+    # The stack engine equivalent of parse_keys
+    def parse_keys_steps(self, grammar, elem, name, list_pos, model, non_model_keys, model_keys, switch_model, result,
+                         key_table, found_keys):
+        for keys, key_model, key_results in ((non_model_keys, model, result), (model_keys, switch_model, None)):
+            for key in keys:
+                key_name = key['name']
+                if key_name not in elem:
+                    if self.key_required(grammar, key):
+                        raise self.missing_key_error(name, key_name, elem)
+                    continue
+                found_keys += 1
+                key_schema = key['schema']
+                name.append(key_name)
+                if key_schema is not None and key_schema.container:
+                    key_result = yield grammar.parse_steps(elem[key_name], key_schema, name, elem, list_pos, key_model)
+                else:
+                    key_result = grammar.parse(elem[key_name], key_schema, name, elem, list_pos, key_model)
+                name.pop()
+                if key_result is not None:
+                    if key_results is None:
+                        raise self.switch_model_result_error(name, key_name)
+                    key_results[key_name] = key_result
+
+        if found_keys < len(elem):
+            missing_keys = [key for key in elem if key not in key_table]
+            raise DictBase.undefined_keys_error(name, missing_keys, non_model_keys, model_keys)
         if result == {}:
             return None
         return result
 
+    # The validating equivalent of parse_keys
+    def validate_keys(self, grammar, elem, name, list_pos, non_model_keys, model_keys, key_table, found_keys):
+        for keys in (non_model_keys, model_keys):
+            for key in keys:
+                key_name = key['name']
+                if key_name in elem:
+                    found_keys += 1
+                    name.append(key_name)
+                    grammar.validate_elem(elem[key_name], key['schema'], name, elem, list_pos)
+                    name.pop()
+                elif self.key_required(grammar, key):
+                    raise self.missing_key_error(name, key_name, elem)
+
+        if found_keys < len(elem):
+            missing_keys = [key for key in elem if key not in key_table]
+            raise DictBase.undefined_keys_error(name, missing_keys, non_model_keys, model_keys)
+
+    # Compile the keys of a dict or switch dict into (name, required, parse function) tuples
+    # The required flag is resolved against the grammar here, and duplicate keys are caught once
+    @staticmethod
+    def compile_keys(grammar, name, keys, seen_keys):
+        compiled_keys = []
+        for key in keys:
+            if key['name'] in seen_keys:
+                raise GrammarException('dict_duplicate_keys', 'grammar has duplicate keys')
+            seen_keys[key['name']] = True
+            compiled_keys.append((key['name'], DictBase.key_required(grammar, key),
+                                  grammar.compile_parse(key['schema'], name + ':' + key['name'])))
+        return compiled_keys
+
+    # The compiled equivalent of parse_keys
+    # seen_keys is a dictionary of all key names the schema knows about (including any switch key)
+    # found_keys is the number of keys already consumed (1 for the switch key of a switch dict)
+    @staticmethod
+    def compile_parse_keys(name, non_model_keys, model_keys, seen_keys, compiled_keys, compiled_model_keys):
+        def parse_keys(elem, list_pos, model, switch_model, result, found_keys):
+            for key_name, required, parse_key in compiled_keys:
+                if key_name in elem:
+                    found_keys += 1
+                    key_result = parse_key(elem[key_name], elem, list_pos, model)
+                    if key_result is not None:
+                        result[key_name] = key_result
+                elif required:
+                    raise DictBase.missing_key_error(name, key_name, elem)
+            for key_name, required, parse_key in compiled_model_keys:
+                if key_name in elem:
+                    found_keys += 1
+                    if parse_key(elem[key_name], elem, list_pos, switch_model) is not None:
+                        raise DictBase.switch_model_result_error(name, key_name)
+                elif required:
+                    raise DictBase.missing_key_error(name, key_name, elem)
+            if found_keys < len(elem):
+                missing_keys = [key for key in elem if key not in seen_keys]
+                raise DictBase.undefined_keys_error(name, missing_keys, non_model_keys, model_keys)
+            if result == {}:
+                return None
+            return result
+        return parse_keys
+
     @staticmethod
     def gen_key(grammar, model, model_is_dict, key, list_pos, result, variable_result):
         found_keys = 0
@@ -252,6 +803,120 @@ class DictBase(GrammarNode):
         else:
             return result
 
+    # The stack engine equivalent of gen_keys
+    @staticmethod
+    def gen_keys_steps(grammar, model, keys, model_keys, model_var, list_pos, result, variable_result, found_keys):
+        model_is_dict = isinstance(model, dict)
+        if model is not None and not isinstance(model, GrammarModel) and not model_is_dict:
+            raise GrammarException('type_not_dict', "gen called on non dict")
+
+        keys_model = model
+        switched = False
+        while True:
+            sub_model = keys_model
+            for key in keys:
+                key_name = key['name']
+                if model_is_dict:
+                    sub_model = None
+                    if key_name in keys_model:
+                        sub_model = keys_model[key_name]
+                        found_keys += 1
+                key_schema = key['schema']
+                if key_schema is not None and key_schema.container:
+                    key_result = yield grammar.gen_steps(sub_model, key_schema, result, list_pos)
+                else:
+                    key_result = grammar.gen(sub_model, key_schema, result, list_pos)
+                result[key_name] = key_result
+                if key_result is not None:
+                    variable_result[key_name] = key_result
+            # Then the switch model keys, genned from the switched model
+            if model_var is None or switched:
+                break
+            switched = True
+            keys = model_keys
+            keys_model = model.get_var(model_var)
+
+        if model_is_dict and found_keys != len(model.keys()):
+            raise GrammarException('dict_bad_keys', "gen_dict has unknown key in model")
+        if grammar.minimal:
+            if variable_result == {}:
+                return None
+            return variable_result
+        return result
+
+    # The compiled equivalent of gen_keys, the keys are (name, gen function) tuples
+    @staticmethod
+    def compile_gen_keys(grammar, compiled_keys, compiled_model_keys, model_var):
+        minimal = grammar.minimal
+
+        def gen_keys(model, list_pos, result, variable_result, found_keys):
+            model_is_dict = isinstance(model, dict)
+            if model is not None and not isinstance(model, GrammarModel) and not model_is_dict:
+                raise GrammarException('type_not_dict', "gen called on non dict")
+
+            key_model = model
+            for key_name, gen_key in compiled_keys:
+                if model_is_dict:
+                    key_model = None
+                    if key_name in model:
+                        key_model = model[key_name]
+                        found_keys += 1
+                key_result = gen_key(key_model, result, list_pos)
+                result[key_name] = key_result
+                if key_result is not None:
+                    variable_result[key_name] = key_result
+
+            if model_var is not None:
+                switched_model = model.get_var(model_var)
+                key_model = switched_model
+                for key_name, gen_key in compiled_model_keys:
+                    if model_is_dict:
+                        key_model = None
+                        if key_name in switched_model:
+                            key_model = switched_model[key_name]
+                            found_keys += 1
+                    key_result = gen_key(key_model, result, list_pos)
+                    result[key_name] = key_result
+                    if key_result is not None:
+                        variable_result[key_name] = key_result
+
+            if model_is_dict and found_keys != len(model.keys()):
+                raise GrammarException('dict_bad_keys', "gen_dict has unknown key in model")
+            if minimal:
+                if variable_result == {}:
+                    return None
+                return variable_result
+            return result
+        return gen_keys
+
+    # Duplicate keys are a parse error, so they are never templated
+    @staticmethod
+    def keys_templatable(keys, key_names):
+        for key in keys:
+            if key['name'] in key_names or key['schema'] is None or not key['schema'].templatable():
+                return False
+            key_names.add(key['name'])
+        return True
+
+    # A dict model holds the models of its keys, other models are passed to the keys
+    @staticmethod
+    def path_sub_model(model, step):
+        if isinstance(model, dict):
+            return model.get(step)
+        return model
+
+    @staticmethod
+    def path_sub_elem(elem, step):
+        if elem is None:
+            return None
+        DictBase.check_elem(elem)
+        return elem.get(step)
+
+    @staticmethod
+    def collect_key_vars(key, model, result):
+        if key['schema'] is not None:
+            Grammar.collect_vars(key['schema'], model, result)
+
     @staticmethod
     def print_key(indent, key, prefix=None):
         result = ' ' * indent
@@ -270,7 +935,7 @@ class DictBase(GrammarNode):
 class Dict(DictBase):
     def __init__(self, name, keys, **kwargs):
         super().__init__(name, **kwargs)
-        self.keys = keys
+        self.keys = tuple(keys)
 
     # parse_dict
     # elem is the dictionary element to be parsed
@@ -283,7 +948,11 @@ class Dict(DictBase):
     # In complete, all keys must appear to be sub-parsed
     # In minimal, keys need not appear, but we must still make sure that all appearing keys are in the grammar
     def parse(self, grammar, elem, name, context, list_pos, model):
-        return super().parse_keys(grammar, elem, name, list_pos, model, self.keys, [], None, {}, {})
+        if self.key_table is None:
+            self.key_table = self.make_key_table(self.keys, {})
+        self.check_elem(elem)
+        return super().parse_keys(grammar, elem, GrammarPath.of(name), list_pos, model, self.keys, [], None, {},
+                                  self.key_table, 0)
 
     # generate a dictionary element
     # returns significant keys when minimal, or the entire dict when complete
@@ -294,6 +963,66 @@ class Dict(DictBase):
 
         return super().gen_keys(grammar, model, self.keys, [], None, list_pos, result, variable_result, found_keys)
 
+    def parse_steps(self, grammar, elem, name, context, list_pos, model):
+        if self.key_table is None:
+            self.key_table = self.make_key_table(self.keys, {})
+        self.check_elem(elem)
+        return self.parse_keys_steps(grammar, elem, name, list_pos, model, self.keys, [], None, {}, self.key_table, 0)
+
+    def gen_steps(self, grammar, model, context, list_pos):
+        return self.gen_keys_steps(grammar, model, self.keys, [], None, list_pos, {}, {}, 0)
+
+    def validate(self, grammar, elem, name, context, list_pos):
+        if self.key_table is None:
+            self.key_table = self.make_key_table(self.keys, {})
+        self.check_elem(elem)
+        self.validate_keys(grammar, elem, name, list_pos, self.keys, [], self.key_table, 0)
+
+    def compile_parse(self, grammar, name):
+        seen_keys = {}
+        compiled_keys = self.compile_keys(grammar, name, self.keys, seen_keys)
+        parse_keys = self.compile_parse_keys(name, self.keys, [], seen_keys, compiled_keys, [])
+        check_elem = self.check_elem
+
+        def parse_dict(elem, context, list_pos, model):
+            check_elem(elem)
+            return parse_keys(elem, list_pos, model, None, {}, 0)
+        return parse_dict
+
+    def compile_gen(self, grammar):
+        compiled_keys = [(key['name'], grammar.compile_gen(key['schema'])) for key in self.keys]
+        gen_keys = self.compile_gen_keys(grammar, compiled_keys, [], None)
+
+        def gen_dict(model, context, list_pos):
+            return gen_keys(model, list_pos, {}, {}, 0)
+        return gen_dict
+
+    def collect_vars(self, model, result):
+        for key in self.keys:
+            self.collect_key_vars(key, model, result)
+
+    def children(self):
+        return tuple(key['schema'] for key in self.keys if key['schema'] is not None)
+
+    def describe(self, child_fingerprint):
+        return super().describe(child_fingerprint) + self.describe_keys(self.keys, child_fingerprint)
+
+    def path_key(self, step):
+        if self.key_table is None:
+            self.key_table = self.make_key_table(self.keys, {})
+        if step not in self.key_table:
+            raise self.path_error(step)
+        return self.key_table[step]
+
+    def path_gen_step(self, grammar, step, model, list_pos):
+        return self.path_key(step)['schema'], self.path_sub_model(model, step)
+
+    def path_parse_step(self, grammar, step, elem, model_class, list_pos):
+        return self.path_key(step)['schema'], model_class, self.path_sub_elem(elem, step)
+
+    def templatable(self):
+        return self.keys_templatable(self.keys, set())
+
     def print(self, indent):
         result = ' ' * indent
         result += 'Dict ' + self.name + "\n"
@@ -308,37 +1037,36 @@ class SwitchDict(DictBase):
         super().__init__(name, **kwargs)
         self.model_var = model_var
         self.switch_key = switch_key
-        self.case_keys = copy.deepcopy(case_keys)
+        # The case keys are shared with the schema, not copied: each case's keys, without its model class, are kept in a
+        # new tuple
+        self.case_keys = {}
         self.case_models = {}
-        self.common_keys = common_keys
-        if self.common_keys is None:
-            self.common_keys = []
-        for case_key in self.case_keys:
-            found_pos = None
-            for pos in range(len(self.case_keys[case_key])):
-                case_sub_key = self.case_keys[case_key][pos]
-                if inspect.isclass(case_sub_key):
+        self.common_keys = () if common_keys is None else tuple(common_keys)
+        for case_key, case_sub_keys in case_keys.items():
+            keys = []
+            for case_sub_key in case_sub_keys:
+                if isinstance(case_sub_key, type):
                     if issubclass(case_sub_key, GrammarModel):
                         if self.model_var is None:
                             msg = ('The SwitchDict ' + name + ' did not specify a model variable, but case key ' +
                                    case_key + ' has a model')
                             raise GrammarException('case_model_without_var', msg)
-                        if found_pos is not None:
+                        if case_key in self.case_models:
                             msg = ('The SwitchDict ' + name + ' case key ' + case_key +
                                    ' has multiple case models specified')
                             raise GrammarException('multiple_case_models', msg)
-                        found_pos = pos
                         self.case_models[case_key] = case_sub_key
                     else:
                         msg = ('The SwitchDict ' + name + ' case key ' + case_key +
                                'has a class object which is not a model')
                         raise GrammarException('class_not_model', msg)
-            if found_pos is None:
-                if self.model_var is not None and len(self.case_keys[case_key]) > 0:
+                else:
+                    keys.append(case_sub_key)
+            if case_key not in self.case_models:
+                if self.model_var is not None and len(keys) > 0:
                     msg = 'The SwitchDict ' + name + ' case key ' + case_key + ' has no model'
                     raise GrammarException('case_var_without_model', msg)
-            else:
-                self.case_keys[case_key].pop(found_pos)
+            self.case_keys[case_key] = tuple(keys)
         switch_key_name = switch_key['name']
         common_match = self.lookup_key(switch_key_name, self.common_keys)
         if common_match:
@@ -352,54 +1080,113 @@ class SwitchDict(DictBase):
                        case_key_match)
                 raise GrammarException('switch_key_conflict', msg)
 
+        # The keys for each case, merged once here rather than for every element
+        # parse_case_keys are (non model keys, model keys) in parse order, gen_case_keys the same in gen order
+        self.parse_case_keys = {}
+        self.gen_case_keys = {}
+        for case_key_name, case_keys in self.case_keys.items():
+            if self.model_var is None:
+                self.parse_case_keys[case_key_name] = (self.common_keys + case_keys, ())
+                self.gen_case_keys[case_key_name] = (case_keys + self.common_keys, ())
+            else:
+                self.parse_case_keys[case_key_name] = (self.common_keys, case_keys)
+                self.gen_case_keys[case_key_name] = (self.common_keys, case_keys)
+        # Maps each case to its key table, built on first use
+        self.case_key_tables = None
+
+    def make_case_key_tables(self):
+        case_key_tables = {}
+        for case_key_name, (non_model_keys, model_keys) in self.parse_case_keys.items():
+            key_table = {self.switch_key['name']: self.switch_key}
+            self.make_key_table(non_model_keys, key_table)
+            self.make_key_table(model_keys, key_table)
+            case_key_tables[case_key_name] = key_table
+        return case_key_tables
+
+    def missing_switch_error(self, name, elem):
+        msg = ('While parsing ' + str(name) + ', the switch key ' + self.switch_key['name'] +
+               ' does not appear in the parsed element.')
+        msg += "\nElement keys are " + ', '.join(elem.keys())
+        return GrammarException('missing_switch', msg)
+
+    def bad_switch_error(self, switch_value, elem):
+        msg = 'The switch element ' + str(switch_value) + ' does not appear in the case keys: '
+        msg += ','.join(self.case_keys)
+        msg += "\nwhile parsing " + str(elem)
+        return GrammarException('bad_switch', msg)
+
+    @staticmethod
+    def no_base_model_error(name):
+        return GrammarException('no_base_model', 'While parsing ' + str(name) +
+                                ' the SwitchDict has a switch model but there is no enclosing model.')
+
+    def gen_bad_switch_error(self, switch_value):
+        msg = 'In node ' + self.name + "\n"
+        msg += 'The switch value ' + switch_value + " is not in the case keys\n"
+        msg += 'Valid case keys are: ' + ', '.join(self.case_keys)
+        return GrammarException('switch_dict_bad_switch', msg)
+
     # same as parse_dict except
     # we must parse the switch key into a value, even if it is the default
     def parse(self, grammar, elem, name, context, list_pos, model):
-        self.check_elem(elem)
+        name = GrammarPath.of(name)
+        switch_value, switched_model, result = self.parse_switch(grammar, elem, name, list_pos, model)
+        all_keys, switch_model_keys = self.parse_case_keys[switch_value]
+        return super().parse_keys(grammar, elem, name, list_pos, model, all_keys, switch_model_keys, switched_model,
+                                  result, self.case_key_tables[switch_value], 1)
+
+    def parse_steps(self, grammar, elem, name, context, list_pos, model):
+        switch_value, switched_model, result = self.parse_switch(grammar, elem, name, list_pos, model)
+        all_keys, switch_model_keys = self.parse_case_keys[switch_value]
+        return self.parse_keys_steps(grammar, elem, name, list_pos, model, all_keys, switch_model_keys, switched_model,
+                                     result, self.case_key_tables[switch_value], 1)
+
+    def validate(self, grammar, elem, name, context, list_pos):
+        switch_value = self.parse_switch_value(grammar, elem, name)
+        all_keys, switch_model_keys = self.parse_case_keys[switch_value]
+        self.validate_keys(grammar, elem, name, list_pos, all_keys, switch_model_keys,
+                           self.case_key_tables[switch_value], 1)
+
+    # Parse the switch key, returning the switch value, the switched model and the result holding the switch key
+    def parse_switch(self, grammar, elem, name, list_pos, model):
+        switch_value = self.parse_switch_value(grammar, elem, name)
         switch_key = self.switch_key
-        if switch_key['name'] not in elem:
-            if switch_key['schema'].default is None:
-                msg = ('While parsing ' + name + ', the switch key ' + switch_key['name'] +
-                       ' does not appear in the parsed element.')
-                msg += "\nElement keys are " + ', '.join(elem.keys())
-                raise GrammarException('missing_switch', msg)
-            switch_key_value = switch_key['schema'].default
-        else:
-            switch_key_value = elem[switch_key['name']]
-        # Figure out what the switch value is
-        switch_value = switch_key['schema'].parse(grammar, switch_key_value, name, None, [], None)
-        if switch_value is None:
-            switch_value = switch_key['schema'].default
-        if switch_value not in self.case_keys:
-            msg = 'The switch element ' + str(switch_value) + ' does not appear in the case keys: '
-            msg += ','.join(self.case_keys)
-            msg += "\nwhile parsing " + str(elem)
-            raise GrammarException('bad_switch', msg)
-        case_keys = self.case_keys[switch_value]
 
+        switched_model = None
         if self.model_var is not None:
             if model is None:
-                raise GrammarException('no_base_model', 'While parsing ' + name +
-                                       ' the SwitchDict has a switch model but there is no enclosing model.')
-            switched_model = None
+                raise self.no_base_model_error(name)
             if switch_value in self.case_models:
                 switched_model = self.case_models[switch_value]()
+                if grammar.profile is not None:
+                    grammar.profile.node(self).models += 1
             model.set_var(self.model_var, switched_model, name)
-            all_keys = self.common_keys
-            switch_model_keys = case_keys
-        else:
-            all_keys = self.common_keys + case_keys
-            switch_model_keys = []
-            switched_model = None
 
         parse_value = grammar.parse(switch_value, switch_key['schema'], name, None, list_pos, model)
         result = {}
         if parse_value is not None:
             result[switch_key['name']] = parse_value
-        seen_keys = {switch_key['name']: True}
+        return switch_value, switched_model, result
 
-        return super().parse_keys(grammar, elem, name, list_pos, model, all_keys, switch_model_keys, switched_model,
-                                  result, seen_keys)
+    # Find the case of the element from its switch key
+    def parse_switch_value(self, grammar, elem, name):
+        if self.case_key_tables is None:
+            self.case_key_tables = self.make_case_key_tables()
+        self.check_elem(elem)
+        switch_key = self.switch_key
+        if switch_key['name'] not in elem:
+            if switch_key['schema'].default is None:
+                raise self.missing_switch_error(name, elem)
+            switch_key_value = switch_key['schema'].default
+        else:
+            switch_key_value = elem[switch_key['name']]
+        # Figure out what the switch value is
+        switch_value = switch_key['schema'].parse(grammar, switch_key_value, name, None, [], None)
+        if switch_value is None:
+            switch_value = switch_key['schema'].default
+        if switch_value not in self.case_keys:
+            raise self.bad_switch_error(switch_value, elem)
+        return switch_value
 
     # generate a switch key element
     # returns significant keys when minimal, or the entire dict when complete
@@ -411,6 +1198,18 @@ class SwitchDict(DictBase):
     # This affects value and default functions which try to access the switch key
     # I don't have any use cases yet
     def gen(self, grammar, model, context, list_pos):
+        switch_value, result, variable_result = self.gen_switch(grammar, model, list_pos)
+        keys, model_keys = self.gen_case_keys[switch_value]
+        return super().gen_keys(grammar, model, keys, model_keys, self.model_var, list_pos, result, variable_result, 1)
+
+    def gen_steps(self, grammar, model, context, list_pos):
+        switch_value, result, variable_result = self.gen_switch(grammar, model, list_pos)
+        keys, model_keys = self.gen_case_keys[switch_value]
+        return self.gen_keys_steps(grammar, model, keys, model_keys, self.model_var, list_pos, result, variable_result,
+                                   1)
+
+    # Gen the switch key, returning the (defaulted) switch value, and the result and variable result holding it
+    def gen_switch(self, grammar, model, list_pos):
         # Determine what the switch is
         switch_model = model
         if isinstance(model, dict):
@@ -424,26 +1223,167 @@ class SwitchDict(DictBase):
         if defaulted_switch_value is None:
             defaulted_switch_value = self.switch_key['schema'].default
         if defaulted_switch_value not in self.case_keys:
-            msg = 'In node ' + self.name + "\n"
-            msg += 'The switch value ' + defaulted_switch_value + " is not in the case keys\n"
-            msg += 'Valid case keys are: ' + ', '.join(self.case_keys)
-            raise GrammarException('switch_dict_bad_switch', msg)
-        if self.model_var is None:
-            keys = self.case_keys[defaulted_switch_value] + self.common_keys
-            model_keys = []
-        else:
-            keys = self.common_keys
-            model_keys = self.case_keys[defaulted_switch_value]
+            raise self.gen_bad_switch_error(defaulted_switch_value)
 
         result = {}
         variable_result = {}
         if switch_value is not None:
             result = {self.switch_key['name']: switch_value}
             variable_result = {self.switch_key['name']: switch_value}
-        found_keys = 1
+        return defaulted_switch_value, result, variable_result
+
+    # Each case gets its own compiled key loop, so the switch value selects a ready-made parser
+    def compile_parse(self, grammar, name):
+        switch_key_name = self.switch_key['name']
+        switch_schema = self.switch_key['schema']
+        switch_default = switch_schema.default
+        parse_switch_value = switch_schema.compile_parse(grammar, name)
+        parse_switch = grammar.compile_parse(switch_schema, name)
+        model_var = self.model_var
+        case_models = self.case_models
+        if grammar.profile is not None:
+            case_models = {case_name: grammar.profile.counted_model(self, case_model)
+                           for case_name, case_model in case_models.items()}
+        check_elem = self.check_elem
+
+        case_parsers = {}
+        for case_name, (all_keys, switch_model_keys) in self.parse_case_keys.items():
+            seen_keys = {switch_key_name: True}
+            compiled_keys = self.compile_keys(grammar, name, all_keys, seen_keys)
+            compiled_model_keys = self.compile_keys(grammar, name, switch_model_keys, seen_keys)
+            case_parsers[case_name] = self.compile_parse_keys(name, all_keys, switch_model_keys, seen_keys,
+                                                              compiled_keys, compiled_model_keys)
+
+        def parse_switch_dict(elem, context, list_pos, model):
+            check_elem(elem)
+            if switch_key_name not in elem:
+                if switch_default is None:
+                    raise self.missing_switch_error(name, elem)
+                switch_key_value = switch_default
+            else:
+                switch_key_value = elem[switch_key_name]
+            switch_value = parse_switch_value(switch_key_value, None, [], None)
+            if switch_value is None:
+                switch_value = switch_default
+            parse_keys = case_parsers.get(switch_value)
+            if parse_keys is None:
+                raise self.bad_switch_error(switch_value, elem)
+
+            switched_model = None
+            if model_var is not None:
+                if model is None:
+                    raise self.no_base_model_error(name)
+                if switch_value in case_models:
+                    switched_model = case_models[switch_value]()
+                model.set_var(model_var, switched_model, name)
+
+            parse_value = parse_switch(switch_value, None, list_pos, model)
+            result = {}
+            if parse_value is not None:
+                result[switch_key_name] = parse_value
+            return parse_keys(elem, list_pos, model, switched_model, result, 1)
+        return parse_switch_dict
+
+    def compile_gen(self, grammar):
+        switch_key_name = self.switch_key['name']
+        switch_default = self.switch_key['schema'].default
+        gen_switch = grammar.compile_gen(self.switch_key['schema'])
+        model_var = self.model_var
+
+        case_gens = {}
+        for case_name, (keys, model_keys) in self.gen_case_keys.items():
+            compiled_keys = [(key['name'], grammar.compile_gen(key['schema'])) for key in keys]
+            compiled_model_keys = [(key['name'], grammar.compile_gen(key['schema'])) for key in model_keys]
+            case_gens[case_name] = self.compile_gen_keys(grammar, compiled_keys, compiled_model_keys, model_var)
+
+        def gen_switch_dict(model, context, list_pos):
+            switch_model = model
+            if isinstance(model, dict):
+                if switch_key_name in model:
+                    switch_model = model[switch_key_name]
+                else:
+                    switch_model = None
+            switch_value = gen_switch(switch_model, {}, list_pos)
+
+            defaulted_switch_value = switch_value
+            if defaulted_switch_value is None:
+                defaulted_switch_value = switch_default
+            gen_keys = case_gens.get(defaulted_switch_value)
+            if gen_keys is None:
+                raise self.gen_bad_switch_error(defaulted_switch_value)
+
+            result = {}
+            variable_result = {}
+            if switch_value is not None:
+                result = {switch_key_name: switch_value}
+                variable_result = {switch_key_name: switch_value}
+            return gen_keys(model, list_pos, result, variable_result, 1)
+        return gen_switch_dict
+
+    # With a model variable, the case keys bind into the case models
+    def collect_vars(self, model, result):
+        for key in (self.switch_key,) + self.common_keys:
+            self.collect_key_vars(key, model, result)
+        if self.model_var is not None and model is not None:
+            result[model].add(self.model_var)
+        for case_key_name, case_keys in self.case_keys.items():
+            case_model = self.case_models.get(case_key_name, model)
+            if case_model is not None:
+                result.setdefault(case_model, set())
+            for key in case_keys:
+                self.collect_key_vars(key, case_model, result)
+
+    def children(self):
+        keys = (self.switch_key,) + self.common_keys
+        for case_keys in self.case_keys.values():
+            keys += case_keys
+        return tuple(key['schema'] for key in keys if key['schema'] is not None)
+
+    def describe(self, child_fingerprint):
+        cases = tuple((case, describe_value(self.case_models.get(case)),
+                       self.describe_keys(case_keys, child_fingerprint))
+                      for case, case_keys in self.case_keys.items())
+        return super().describe(child_fingerprint) + (
+            self.model_var, self.describe_keys((self.switch_key,), child_fingerprint),
+            self.describe_keys(self.common_keys, child_fingerprint), cases)
+
+    # The keys of the case, and whether the key is in the case model
+    def path_case_key(self, switch_value, step):
+        if step == self.switch_key['name']:
+            return self.switch_key, False
+        keys, model_keys = self.gen_case_keys[switch_value]
+        for key in keys:
+            if key['name'] == step:
+                return key, False
+        for key in model_keys:
+            if key['name'] == step:
+                return key, True
+        raise self.path_error(step)
+
+    def path_gen_step(self, grammar, step, model, list_pos):
+        switch_value = self.gen_switch(grammar, model, list_pos)[0]
+        key, in_case_model = self.path_case_key(switch_value, step)
+        if in_case_model and model is not None:
+            model = model.get_var(self.model_var)
+        return key['schema'], self.path_sub_model(model, step)
 
-        return super().gen_keys(grammar, model, keys, model_keys, self.model_var, list_pos, result, variable_result,
-                                found_keys)
+    # A missing element is default, and so is its switch
+    def path_parse_step(self, grammar, step, elem, model_class, list_pos):
+        switch_value = self.parse_switch_value(grammar, {} if elem is None else elem, self.name)
+        key, in_case_model = self.path_case_key(switch_value, step)
+        if in_case_model:
+            model_class = self.case_models.get(switch_value)
+        return key['schema'], model_class, self.path_sub_elem(elem, step)
+
+    # Without a model, the switch is the default, so only the default case keys are genned
+    def templatable(self):
+        switch_schema = self.switch_key['schema']
+        if self.model_var is not None or switch_schema is None or not switch_schema.templatable():
+            return False
+        if switch_schema.default not in self.gen_case_keys:
+            return False
+        keys, model_keys = self.gen_case_keys[switch_schema.default]
+        return self.keys_templatable(keys, {self.switch_key['name']})
 
     def print(self, indent):
         result = ' ' * indent
@@ -462,10 +1402,20 @@ class SwitchDict(DictBase):
 
 
 class List(GrammarNode):
-    def __init__(self, name, length, schema, **kwargs):
+    container = True
+
+    # A sparse list parses to a SparseList rather than a list. It needs a fixed length.
+    def __init__(self, name, length, schema, sparse=False, **kwargs):
         super().__init__(name, **kwargs)
+        if sparse and length == 0:
+            raise GrammarException('unlimited_sparse_list', 'In List ' + str(name) + ' a sparse list needs a length')
         self.length = length
         self.schema = schema
+        self.sparse = sparse
+        # The entries are independent if they parse to their own model, as then parsing one doesn't bind anything in
+        # the enclosing model. They can be parsed lazily (see Grammar.use_lazy_lists) or in parallel (see
+        # Grammar.use_parallel_lists).
+        self.independent = isinstance(schema, DictBase) and schema.model is not None and schema.variable is None
 
     # parse_list
     # for complete grammars, the list must be the exact length of the schema
@@ -475,6 +1425,46 @@ class List(GrammarNode):
     # Note that the list is not compacted, embedded insignificant values are kept with None
     # If the entire list is empty, None is returned
     def parse(self, grammar, elem, name, context, list_pos, model):
+        list_length = self.parse_length(grammar, elem)
+        if type(elem) is PreparsedList:
+            return self.merge_entries(grammar, list_length, enumerate(elem))
+        if self.independent:
+            if grammar.lazy_lists:
+                return LazyList.of(grammar, self, elem, name, list_pos, model, list_length)
+            if grammar.parallel is not None and self in grammar.parallel.nodes:
+                return grammar.parallel.parse(self, elem, name, list_pos, list_length)
+        result = self.parse_result(list_length)
+        modified = False
+        # The position of each entry is pushed on the shared list position
+        list_pos.append(0)
+        for new_list_pos, list_elem in enumerate(elem):
+            if list_elem is not None:
+                list_pos[-1] = new_list_pos
+                entry_result = grammar.parse(list_elem, self.schema, name, elem, list_pos, model)
+                if entry_result is not None:
+                    modified = True
+                    result[new_list_pos] = entry_result
+        list_pos.pop()
+        if modified:
+            if grammar.minimal and not self.sparse:
+                prune_list(result)
+                if len(result) == 0:
+                    result = None
+            return result
+        else:
+            return None
+
+    def validate(self, grammar, elem, name, context, list_pos):
+        self.parse_length(grammar, elem)
+        list_pos.append(0)
+        for new_list_pos, list_elem in enumerate(elem):
+            if list_elem is not None:
+                list_pos[-1] = new_list_pos
+                grammar.validate_elem(list_elem, self.schema, name, elem, list_pos)
+        list_pos.pop()
+
+    # Check the list being parsed, returning the length of the result
+    def parse_length(self, grammar, elem):
         no_max = self.length == 0
         if not isinstance(elem, list):
             raise GrammarException('type_not_list', "parse_list called on non list")
@@ -488,24 +1478,63 @@ class List(GrammarNode):
         if len(elem) != list_length:
             if not (grammar.minimal and len(elem) < list_length):
                 raise GrammarException('list_bad_length', "parse_list called with wrong length list")
+        return list_length
 
-        result = [None] * list_length
+    # The result of parsing the list from the (position, entry result) pairs of its entries
+    def merge_entries(self, grammar, list_length, entry_results):
+        result = self.parse_result(list_length)
+        modified = False
+        for pos, entry_result in entry_results:
+            if entry_result is not None:
+                modified = True
+                result[pos] = entry_result
+        if not modified:
+            return None
+        if grammar.minimal and not self.sparse:
+            prune_list(result)
+            if len(result) == 0:
+                return None
+        return result
+
+    # The empty result of parsing a list of the given length, the entries are set as they are parsed
+    # A SparseList has no trailing None entries, so it is never pruned
+    def parse_result(self, list_length):
+        if self.sparse:
+            return SparseList(list_length)
+        return [None] * list_length
+
+    def parse_steps(self, grammar, elem, name, context, list_pos, model):
+        list_length = self.parse_length(grammar, elem)
+        if type(elem) is PreparsedList:
+            return self.merge_entries(grammar, list_length, enumerate(elem))
+        if self.independent:
+            if grammar.lazy_lists:
+                return LazyList.of(grammar, self, elem, name, list_pos, model, list_length)
+            if grammar.parallel is not None and self in grammar.parallel.nodes:
+                return grammar.parallel.parse(self, elem, name, list_pos, list_length)
+        result = self.parse_result(list_length)
         modified = False
+        schema = self.schema
+        container = schema is not None and schema.container
+        list_pos.append(0)
         for new_list_pos, list_elem in enumerate(elem):
             if list_elem is not None:
-                entry_result = grammar.parse(list_elem, self.schema, name, elem, list_pos + [new_list_pos],
-                                             model)
+                list_pos[-1] = new_list_pos
+                if container:
+                    entry_result = yield grammar.parse_steps(list_elem, schema, name, elem, list_pos, model)
+                else:
+                    entry_result = grammar.parse(list_elem, schema, name, elem, list_pos, model)
                 if entry_result is not None:
                     modified = True
                     result[new_list_pos] = entry_result
-        if modified:
-            if grammar.minimal:
-                prune_list(result)
-                if len(result) == 0:
-                    result = None
-            return result
-        else:
+        list_pos.pop()
+        if not modified:
             return None
+        if grammar.minimal and not self.sparse:
+            prune_list(result)
+            if len(result) == 0:
+                return None
+        return result
 
     # generate a list from a model
     # For a complete grammar, this is a full length list
@@ -516,8 +1545,38 @@ class List(GrammarNode):
     # The model can be None, using only defaults
     # The model can be a model, pass through to sub elements
     # The model can be a list, the list elements are used in sub-parsing
+    # The model can be a SparseList, see gen_sparse
     def gen(self, grammar, model, context, list_pos):
+        if type(model) is LazyList:
+            model = model.resolve()
+        if grammar.parallel is not None and self in grammar.parallel.nodes and isinstance(model, (list, SparseList)):
+            return grammar.parallel.gen(self, model, list_pos)
+        if type(model) is SparseList:
+            return self.gen_sparse(grammar, model, list_pos,
+                                   lambda sub_model, result, sub_list_pos:
+                                   grammar.gen(sub_model, self.schema, result, sub_list_pos))
         is_list = isinstance(model, list)
+        list_length = self.gen_length(grammar, model, is_list)
+        result = [None] * list_length
+        list_pos.append(0)
+        for new_list_pos in range(0, list_length):
+            sub_model = model
+            if is_list:
+                if new_list_pos >= len(model):
+                    sub_model = None
+                else:
+                    sub_model = model[new_list_pos]
+            list_pos[-1] = new_list_pos
+            result[new_list_pos] = grammar.gen(sub_model, self.schema, result, list_pos)
+        list_pos.pop()
+        if grammar.minimal:
+            prune_list(result)
+            if len(result) == 0:
+                result = None
+        return result
+
+    # Check the model being genned, returning the length of the result
+    def gen_length(self, grammar, model, is_list):
         unlimited = self.length == 0
         if model is not None and not isinstance(model, GrammarModel):
             if not is_list:
@@ -530,25 +1589,230 @@ class List(GrammarNode):
         list_length = self.length
         if list_length == 0 and is_list:
             list_length = len(model)
+        return list_length
 
+    # Genning a SparseList model: the populated entries are genned from their models, the gaps without one
+    # In a complete grammar, dict gaps are stamped straight from the entry's gen template (see Grammar.gen_template)
+    # gen_entry gens one entry, as gen_entry(sub model, context, list position)
+    def gen_sparse(self, grammar, model, list_pos, gen_entry):
+        list_length = self.gen_length(grammar, model, True)
+        entries = model.entries
         result = [None] * list_length
+        list_pos.append(0)
+        template = self.gap_template(grammar, list_pos)
+        for new_list_pos in range(0, list_length):
+            list_pos[-1] = new_list_pos
+            sub_model = entries.get(new_list_pos)
+            if sub_model is None and template is not None:
+                result[new_list_pos] = grammar.stamp_template(template, list_pos)
+            else:
+                result[new_list_pos] = gen_entry(sub_model, result, list_pos)
+        list_pos.pop()
+        if grammar.minimal:
+            prune_list(result)
+            if len(result) == 0:
+                return None
+        return result
+
+    # The gen template the gaps of a SparseList model are stamped from, or None if they are genned
+    # Templates are only used by complete grammars, and genning a dict without a model stamps its template
+    def gap_template(self, grammar, list_pos):
+        if grammar.minimal or not isinstance(self.schema, DictBase):
+            return None
+        return grammar.gen_template(self.schema, list_pos)
+
+    def gen_steps(self, grammar, model, context, list_pos):
+        if type(model) is LazyList:
+            model = model.resolve()
+        if grammar.parallel is not None and self in grammar.parallel.nodes and isinstance(model, (list, SparseList)):
+            return grammar.parallel.gen(self, model, list_pos)
+        if type(model) is SparseList:
+            return (yield from self.gen_sparse_steps(grammar, model, list_pos))
+        is_list = isinstance(model, list)
+        list_length = self.gen_length(grammar, model, is_list)
+        result = [None] * list_length
+        schema = self.schema
+        container = schema is not None and schema.container
+        sub_model = model
+        list_pos.append(0)
         for new_list_pos in range(0, list_length):
-            sub_model = model
             if is_list:
                 if new_list_pos >= len(model):
                     sub_model = None
                 else:
                     sub_model = model[new_list_pos]
-            result[new_list_pos] = grammar.gen(sub_model, self.schema, result, list_pos + [new_list_pos])
+            list_pos[-1] = new_list_pos
+            if container:
+                result[new_list_pos] = yield grammar.gen_steps(sub_model, schema, result, list_pos)
+            else:
+                result[new_list_pos] = grammar.gen(sub_model, schema, result, list_pos)
+        list_pos.pop()
         if grammar.minimal:
             prune_list(result)
             if len(result) == 0:
-                result = None
+                return None
         return result
 
+    # gen_sparse for the stack engine
+    def gen_sparse_steps(self, grammar, model, list_pos):
+        list_length = self.gen_length(grammar, model, True)
+        entries = model.entries
+        result = [None] * list_length
+        schema = self.schema
+        container = schema is not None and schema.container
+        list_pos.append(0)
+        template = self.gap_template(grammar, list_pos)
+        for new_list_pos in range(0, list_length):
+            list_pos[-1] = new_list_pos
+            sub_model = entries.get(new_list_pos)
+            if sub_model is None and template is not None:
+                result[new_list_pos] = grammar.stamp_template(template, list_pos)
+            elif container:
+                result[new_list_pos] = yield grammar.gen_steps(sub_model, schema, result, list_pos)
+            else:
+                result[new_list_pos] = grammar.gen(sub_model, schema, result, list_pos)
+        list_pos.pop()
+        if grammar.minimal:
+            prune_list(result)
+            if len(result) == 0:
+                return None
+        return result
+
+    def compile_parse(self, grammar, name):
+        parse_entry = grammar.compile_parse(self.schema, name)
+        minimal = grammar.minimal
+        length = self.length
+        sparse = self.sparse
+        independent = self.independent
+        parse_result = self.parse_result
+
+        def parse_list(elem, context, list_pos, model):
+            if not isinstance(elem, list):
+                raise GrammarException('type_not_list', "parse_list called on non list")
+            if not minimal and length == 0:
+                raise GrammarException('unlimited_list_complete_grammar', 'length 0 with complete grammar')
+            list_length = length
+            if list_length == 0:
+                list_length = len(elem)
+            if len(elem) != list_length:
+                if not (minimal and len(elem) < list_length):
+                    raise GrammarException('list_bad_length', "parse_list called with wrong length list")
+
+            if type(elem) is PreparsedList:
+                return self.merge_entries(grammar, list_length, enumerate(elem))
+            if independent:
+                if grammar.lazy_lists:
+                    return LazyList.of(grammar, self, elem, name, list_pos, model, list_length)
+                if grammar.parallel is not None and self in grammar.parallel.nodes:
+                    return grammar.parallel.parse(self, elem, name, list_pos, list_length)
+            result = parse_result(list_length)
+            modified = False
+            list_pos.append(0)
+            for new_list_pos, list_elem in enumerate(elem):
+                if list_elem is not None:
+                    list_pos[-1] = new_list_pos
+                    entry_result = parse_entry(list_elem, elem, list_pos, model)
+                    if entry_result is not None:
+                        modified = True
+                        result[new_list_pos] = entry_result
+            list_pos.pop()
+            if not modified:
+                return None
+            if minimal and not sparse:
+                prune_list(result)
+                if len(result) == 0:
+                    return None
+            return result
+        return parse_list
+
+    def compile_gen(self, grammar):
+        gen_entry = grammar.compile_gen(self.schema)
+        minimal = grammar.minimal
+        length = self.length
+        unlimited = length == 0
+
+        def gen_list(model, context, list_pos):
+            if type(model) is LazyList:
+                model = model.resolve()
+            if (grammar.parallel is not None and self in grammar.parallel.nodes and
+                    isinstance(model, (list, SparseList))):
+                return grammar.parallel.gen(self, model, list_pos)
+            if type(model) is SparseList:
+                return self.gen_sparse(grammar, model, list_pos, gen_entry)
+            is_list = isinstance(model, list)
+            if model is not None and not isinstance(model, GrammarModel):
+                if not is_list:
+                    raise GrammarException('model_schema_mismatch', "gen_list got non list")
+                if not minimal and not unlimited and len(model) != length:
+                    raise GrammarException('list_bad_length', "gen_list called with wrong length list")
+                if minimal and not unlimited and len(model) > length:
+                    raise GrammarException('list_bad_length', "gen_list called with wrong length list")
+
+            list_length = length
+            if list_length == 0 and is_list:
+                list_length = len(model)
+
+            result = [None] * list_length
+            sub_model = model
+            list_pos.append(0)
+            for new_list_pos in range(0, list_length):
+                if is_list:
+                    if new_list_pos >= len(model):
+                        sub_model = None
+                    else:
+                        sub_model = model[new_list_pos]
+                list_pos[-1] = new_list_pos
+                result[new_list_pos] = gen_entry(sub_model, result, list_pos)
+            list_pos.pop()
+            if minimal:
+                prune_list(result)
+                if len(result) == 0:
+                    return None
+            return result
+        return gen_list
+
+    def collect_vars(self, model, result):
+        if self.schema is not None:
+            Grammar.collect_vars(self.schema, model, result)
+
+    def children(self):
+        return () if self.schema is None else (self.schema,)
+
+    def describe(self, child_fingerprint):
+        return super().describe(child_fingerprint) + (self.length, self.sparse, child_fingerprint(self.schema))
+
+    def path_index(self, step, list_pos):
+        try:
+            index = int(step)
+        except ValueError:
+            raise self.path_error(step)
+        if index < 0 or (self.length != 0 and index >= self.length):
+            raise self.path_error(step)
+        list_pos.append(index)
+        return index
+
+    # Like gen, a list model holds the entries' models, other models are passed to the entries
+    def path_gen_step(self, grammar, step, model, list_pos):
+        index = self.path_index(step, list_pos)
+        if isinstance(model, (list, SparseList, LazyList)):
+            model = model[index] if index < len(model) else None
+        return self.schema, model
+
+    def path_parse_step(self, grammar, step, elem, model_class, list_pos):
+        index = self.path_index(step, list_pos)
+        if elem is not None:
+            if not isinstance(elem, list):
+                raise GrammarException('type_not_list', "parse_list called on non list")
+            elem = elem[index] if index < len(elem) else None
+        return self.schema, model_class, elem
+
+    def templatable(self):
+        return self.schema is not None and self.schema.templatable()
+
     def print(self, indent):
         result = ' ' * indent
-        result += 'List ' + self.name + '(' + str(self.length) + "):\n"
+        result += 'Sparse List ' if self.sparse else 'List '
+        result += self.name + '(' + str(self.length) + "):\n"
         result += self.schema.print(indent + 2)
         return result
 
@@ -557,32 +1821,36 @@ class Enum(GrammarNode):
     def __init__(self, name, base, default, **kwargs):
         super().__init__(name, **kwargs)
         self.base = base
-        if default is not None:
-            try:
-                base.index(default)
-            except ValueError:
-                raise GrammarException('bad_enum_value', "bad enum value")
+        # Maps each enum value to its position in base
+        self.ordinals = {value: ordinal for ordinal, value in enumerate(base)}
+        if default is not None and default not in self.ordinals:
+            raise GrammarException('bad_enum_value', "bad enum value")
         self.default = default
 
     # parse_enum parses an enum element
     # The result is significant if it is not default
     def parse(self, grammar, elem, name, context, list_pos, model):
         if not isinstance(elem, str):
-            msg = "In Enum " + name + "\n"
-            msg += "Enum expected a string, but received: " + str(elem)
-            raise GrammarException('enum_wrong_type', msg)
+            raise self.wrong_type_error(name, elem)
         # Make sure the elem is valid
-        try:
-            self.base.index(elem)
-        except ValueError:
-            msg = 'In Enum ' + name + '\n'
-            msg += 'The value ' + elem + 'is not found\n'
-            msg += 'Enums are ' + ', '.join(self.base)
-            raise GrammarException('bad_enum_value', msg)
+        if elem not in self.ordinals:
+            raise self.bad_value_error(name, elem)
         if self.default is not None and elem == self.default:
             return None
         return elem
 
+    @staticmethod
+    def wrong_type_error(name, elem):
+        msg = "In Enum " + str(name) + "\n"
+        msg += "Enum expected a string, but received: " + str(elem)
+        return GrammarException('enum_wrong_type', msg)
+
+    def bad_value_error(self, name, elem):
+        msg = 'In Enum ' + str(name) + '\n'
+        msg += 'The value ' + elem + 'is not found\n'
+        msg += 'Enums are ' + ', '.join(self.base)
+        return GrammarException('bad_enum_value', msg)
+
     # generate an enum
     # This doesn't handle default/value functions
     # I don't have a use case
@@ -610,6 +1878,40 @@ class Enum(GrammarNode):
         else:
             return result
 
+    def compile_parse(self, grammar, name):
+        ordinals = self.ordinals
+        default = self.default
+
+        def parse_enum(elem, context, list_pos, model):
+            if not isinstance(elem, str):
+                raise self.wrong_type_error(name, elem)
+            if elem not in ordinals:
+                raise self.bad_value_error(name, elem)
+            if elem == default:
+                return None
+            return elem
+        return parse_enum
+
+    def compile_gen(self, grammar):
+        default = self.default
+        minimal = grammar.minimal
+
+        def gen_enum(model, context, list_pos):
+            if model is None or isinstance(model, GrammarModel) or model == default:
+                if default is None:
+                    raise GrammarException('enum_no_default', 'gen_enum resulted in None')
+                if minimal:
+                    return None
+                return default
+            return model
+        return gen_enum
+
+    def templatable(self):
+        return self.default is not None
+
+    def describe(self, child_fingerprint):
+        return super().describe(child_fingerprint) + (tuple(self.base), describe_value(self.default))
+
     def print(self, indent):
         result = ' ' * indent + 'Enum ' + self.name + ': ['
         if len(self.base) > 2:
@@ -635,8 +1937,7 @@ class Atom(GrammarNode):
     # not yet handled - we will throw an error when getting a config where features are used
     def parse(self, grammar, elem, name, context, list_pos, model):
         if not isinstance(elem, self.type):
-            message = 'In ' + name + ' expected ' + str(self.type) + ' atom but got ' + str(elem)
-            raise GrammarException('atom_wrong_type', message)
+            raise self.wrong_type_error(name, elem)
         if self.default is not None and self.value is not None:
             raise GrammarException('both_value_default', 'Schema atom has more than 1 value, skip and default')
         target = None
@@ -647,20 +1948,30 @@ class Atom(GrammarNode):
             target = self.value
             value = True
         if callable(target):
+            if grammar.profile is not None:
+                grammar.profile.count_function(self, value)
             target_elem = target(elem, context, list_pos)
         else:
             target_elem = target
 
         if elem != target_elem:
             if value:
-                msg = "parse atom called with " + str(elem) + " not matching schema " + str(target_elem)
-                msg += " in " + name
-                raise GrammarException('atom_wrong_value', msg)
+                raise self.wrong_value_error(name, elem, target_elem)
             result = elem
         else:
             result = None
         return result
 
+    def wrong_type_error(self, name, elem):
+        message = 'In ' + str(name) + ' expected ' + str(self.type) + ' atom but got ' + str(elem)
+        return GrammarException('atom_wrong_type', message)
+
+    @staticmethod
+    def wrong_value_error(name, elem, target_elem):
+        msg = "parse atom called with " + str(elem) + " not matching schema " + str(target_elem)
+        msg += " in " + str(name)
+        return GrammarException('atom_wrong_value', msg)
+
     # Generate an atom
     # model is an atom, None, or model object
     # None or model object is ignored, result is the default or value
@@ -679,6 +1990,8 @@ class Atom(GrammarNode):
         elif not grammar.minimal:
             raise GrammarException('no_value_default', "Missing both value and default in atom")
         if callable(atom_value):
+            if grammar.profile is not None:
+                grammar.profile.count_function(self, self.value is not None)
             atom_value = atom_value(model, context, list_pos)
 
         variable_result = None
@@ -704,6 +2017,90 @@ class Atom(GrammarNode):
         else:
             return result
 
+    # The target (value or default) and whether it is a function are decided once here
+    def compile_parse(self, grammar, name):
+        atom_type = self.type
+        is_value = self.value is not None
+        target = self.value if is_value else self.default
+
+        if callable(target):
+            if grammar.profile is not None:
+                target = grammar.profile.counted_function(self, target, is_value)
+
+            def parse_atom_function(elem, context, list_pos, model):
+                if not isinstance(elem, atom_type):
+                    raise self.wrong_type_error(name, elem)
+                target_elem = target(elem, context, list_pos)
+                if elem != target_elem:
+                    if is_value:
+                        raise self.wrong_value_error(name, elem, target_elem)
+                    return elem
+                return None
+            return parse_atom_function
+
+        def parse_atom(elem, context, list_pos, model):
+            if not isinstance(elem, atom_type):
+                raise self.wrong_type_error(name, elem)
+            if elem != target:
+                if is_value:
+                    raise self.wrong_value_error(name, elem, target)
+                return elem
+            return None
+        return parse_atom
+
+    def compile_gen(self, grammar):
+        minimal = grammar.minimal
+        is_value = self.value is not None
+        atom_value = self.value if is_value else self.default
+        is_function = callable(atom_value)
+        if is_function and grammar.profile is not None:
+            atom_value = grammar.profile.counted_function(self, atom_value, is_value)
+
+        def gen_atom(model, context, list_pos):
+            is_atom = not (model is None or isinstance(model, GrammarModel))
+            if atom_value is None and not minimal:
+                raise GrammarException('no_value_default', "Missing both value and default in atom")
+            if is_function:
+                value = atom_value(model if is_atom else None, context, list_pos)
+            else:
+                value = atom_value
+
+            if not is_atom:
+                result = value
+                # Weird case, but if model is None we want to set the value
+                variable_result = value if is_value else None
+            elif model == value:
+                result = value
+                variable_result = None
+            elif not is_value:
+                result = model
+                variable_result = model
+            else:
+                raise GrammarException('model_schema_mismatch', "atom has wrong value in model and schema")
+
+            if minimal:
+                return variable_result
+            if result is None:
+                raise GrammarException('programmer_error', 'gen_atom resulted in None')
+            return result
+        return gen_atom
+
+    # Functions are only allowed if they are known to depend on the list position alone
+    def templatable(self):
+        atom_value = self.value if self.value is not None else self.default
+        if atom_value is None:
+            return False
+        return not callable(atom_value) or atom_value in template_functions
+
+    # The template functions only read the list position
+    def reads_context(self):
+        atom_value = self.value if self.value is not None else self.default
+        return callable(atom_value) and atom_value not in template_functions
+
+    def describe(self, child_fingerprint):
+        return super().describe(child_fingerprint) + (describe_value(self.type), describe_value(self.default),
+                                                      describe_value(self.value))
+
     def print(self, indent):
         result = " " * indent
         result += "Atom " + self.name
@@ -714,6 +2111,192 @@ class Atom(GrammarNode):
         return result
 
 
+# An opaque node keeps its element as a raw blob instead of parsing it, and gens the blob back unchanged.
+# It is for subtrees that are mostly constants, where parsing them with their schema is wasted work.
+# schema is the full schema of the element. It gens the element when the model has no blob, and validates blobs.
+# extracts are (path, schema) tuples for the few parts of the element that are modelled. A path is a tuple of the keys
+# leading to the part. The parts are parsed with their schemas into the current model, and when genning, genned from
+# it over the blob.
+# blob_var is the variable in the current model the blob is stored in.
+# If check is set, the rest of the blob (with the extracted parts blanked out) is hashed. A blob whose rest hasn't been
+# seen before is parsed with the full schema instead, and the hash is remembered. The default element is known to be
+# valid. Without check, only the extracted parts are validated.
+# Opaque nodes are meant for complete grammars.
+class Opaque(GrammarNode):
+    def __init__(self, name, schema, extracts, blob_var, check=False):
+        super().__init__(name)
+        self.schema = schema
+        self.extracts = extracts
+        self.blob_var = blob_var
+        self.check = check
+
+    # Find the dictionary holding the last key of the path
+    @staticmethod
+    def lookup(elem, path, name):
+        for key in path[:-1]:
+            if not isinstance(elem, dict) or key not in elem:
+                break
+            elem = elem[key]
+        else:
+            if isinstance(elem, dict) and path[-1] in elem:
+                return elem
+        raise GrammarException('opaque_missing_path',
+                               'In ' + str(name) + ' the element has no ' + ':'.join(path))
+
+    # The hash of the blob without the extracted parts
+    # marshal version 2 doesn't share references, so equal blobs always give the same bytes
+    def digest(self, elem):
+        for path, _ in self.extracts:
+            elem = self.blank_path(elem, path)
+        return hashlib.blake2b(marshal.dumps(elem, 2), digest_size=16).digest()
+
+    # A copy of the element with the path set to None, only the dictionaries along the path are copied
+    @staticmethod
+    def blank_path(elem, path):
+        if not isinstance(elem, dict) or path[0] not in elem:
+            return elem
+        result = dict(elem)
+        if len(path) == 1:
+            result[path[0]] = None
+        else:
+            result[path[0]] = Opaque.blank_path(elem[path[0]], path[1:])
+        return result
+
+    # Returns the digest of the element if it needs checking with the full schema, None if its rest is known
+    def unchecked_digest(self, grammar, elem, context, list_pos):
+        if not self.check:
+            return None
+        digests = grammar.opaque_digests.get(self)
+        if digests is None:
+            digests = {self.digest(grammar.gen(None, self.schema, context, list_pos))}
+            grammar.opaque_digests[self] = digests
+        digest = self.digest(elem)
+        if digest in digests:
+            return None
+        return digest
+
+    def unconsumed_error(self, name):
+        return GrammarException('opaque_unconsumed',
+                                'In ' + str(name) + ' a part of the opaque element was not stored in the model')
+
+    def store_blob(self, elem, name, model):
+        if model is None:
+            raise GrammarException('opaque_without_model', 'In ' + str(name) + ' there is no model to keep the blob')
+        model.set_var(self.blob_var, elem, name)
+
+    def parse(self, grammar, elem, name, context, list_pos, model):
+        name = GrammarPath.of(name)
+        digest = self.unchecked_digest(grammar, elem, context, list_pos)
+        if digest is not None:
+            if grammar.parse(elem, self.schema, name, context, list_pos, model) is not None:
+                raise self.unconsumed_error(name)
+            grammar.opaque_digests[self].add(digest)
+        else:
+            for path, schema in self.extracts:
+                sub_context = self.lookup(elem, path, name)
+                name.extend(path)
+                result = grammar.parse(sub_context[path[-1]], schema, name, sub_context, list_pos, model)
+                del name[-len(path):]
+                if result is not None:
+                    raise self.unconsumed_error(name)
+        self.store_blob(elem, name, model)
+        return None
+
+    def validate(self, grammar, elem, name, context, list_pos):
+        digest = self.unchecked_digest(grammar, elem, context, list_pos)
+        if digest is not None:
+            grammar.validate_elem(elem, self.schema, name, context, list_pos)
+            grammar.opaque_digests[self].add(digest)
+        else:
+            for path, schema in self.extracts:
+                sub_context = self.lookup(elem, path, name)
+                name.extend(path)
+                grammar.validate_elem(sub_context[path[-1]], schema, name, sub_context, list_pos)
+                del name[-len(path):]
+
+    # Without a blob, the element is genned from the schema
+    # The blob is copied, so the result can be changed without changing the model
+    def gen(self, grammar, model, context, list_pos):
+        blob = None
+        if isinstance(model, GrammarModel):
+            blob = model.get_var(self.blob_var)
+        if blob is None:
+            return grammar.gen(model, self.schema, context, list_pos)
+        result = marshal.loads(marshal.dumps(blob))
+        for path, schema in self.extracts:
+            sub_context = self.lookup(result, path, self.name)
+            sub_context[path[-1]] = grammar.gen(model, schema, sub_context, list_pos)
+        return result
+
+    def compile_parse(self, grammar, name):
+        parse_schema = grammar.compile_parse(self.schema, name)
+        extracts = [(path, grammar.compile_parse(schema, name + ':' + ':'.join(path)))
+                    for path, schema in self.extracts]
+
+        def parse_opaque(elem, context, list_pos, model):
+            digest = self.unchecked_digest(grammar, elem, context, list_pos)
+            if digest is not None:
+                if parse_schema(elem, context, list_pos, model) is not None:
+                    raise self.unconsumed_error(name)
+                grammar.opaque_digests[self].add(digest)
+            else:
+                for path, parse_extract in extracts:
+                    sub_context = self.lookup(elem, path, name)
+                    if parse_extract(sub_context[path[-1]], sub_context, list_pos, model) is not None:
+                        raise self.unconsumed_error(name)
+            self.store_blob(elem, name, model)
+            return None
+        return parse_opaque
+
+    def compile_gen(self, grammar):
+        gen_schema = grammar.compile_gen(self.schema)
+        extracts = [(path, grammar.compile_gen(schema)) for path, schema in self.extracts]
+        blob_var = self.blob_var
+
+        def gen_opaque(model, context, list_pos):
+            blob = None
+            if isinstance(model, GrammarModel):
+                blob = model.get_var(blob_var)
+            if blob is None:
+                return gen_schema(model, context, list_pos)
+            result = marshal.loads(marshal.dumps(blob))
+            for path, gen_extract in extracts:
+                sub_context = self.lookup(result, path, self.name)
+                sub_context[path[-1]] = gen_extract(model, sub_context, list_pos)
+            return result
+        return gen_opaque
+
+    # Only the blob and the extracts are bound, the schema just checks the blob
+    def collect_vars(self, model, result):
+        if model is not None:
+            result[model].add(self.blob_var)
+        for _, schema in self.extracts:
+            Grammar.collect_vars(schema, model, result)
+
+    def children(self):
+        return tuple(schema for _, schema in self.extracts)
+
+    def describe(self, child_fingerprint):
+        extracts = tuple((tuple(path), child_fingerprint(schema)) for path, schema in self.extracts)
+        return super().describe(child_fingerprint) + (child_fingerprint(self.schema), extracts, self.blob_var,
+                                                      self.check)
+
+    # Without a model, the element is genned from the schema
+    def templatable(self):
+        return self.schema.templatable()
+
+    # The schema is parsed and genned with the opaque node's context
+    def reads_context(self):
+        return self.schema.reads_context()
+
+    def print(self, indent):
+        result = ' ' * indent + 'Opaque ' + self.name + ', extracts '
+        result += ', '.join(':'.join(path) for path, _ in self.extracts) + ':\n'
+        for _, schema in self.extracts:
+            result += schema.print(indent + 2)
+        return result
+
+
 # Value/Default atom functions, commonly used
 # identity just returns the position in the list, zero based
 def identity(_elem, _ctxt, lp):
@@ -730,6 +2313,12 @@ def identity2(_elem, _ctxt, lp):
     return lp[-2]
 
 
+# The functions gen templates may call
+# They must only depend on the list position when genning without a model, as they are called once per template
+# with placeholders in the list position (see GenTemplate). The value they gen must also parse as the default.
+# Grammars can add their own.
+template_functions = {identity, identity_plus_1, identity2}
+
 false_atom = Atom('False', bool, value=False)
 true_atom = Atom('True', bool, value=True)
 zero_atom = Atom('Zero', int, value=0)
@@ -753,10 +2342,681 @@ def compact_list(list_to_compact):
             i += 1
 
 
+# A fixed length list that only stores its populated (non None) entries, as {position: item}
+# Most of the 128 banks, 24 presets and 32 messages in a backup are unused, so sparse lists (see List) parse to these
+# rather than to mostly None lists. They index, iterate and compare like the equivalent list, with None in the gaps.
+# Trailing None entries are insignificant, so a SparseList equals the list with or without them.
+class SparseList:
+    __slots__ = ('length', 'entries')
+
+    def __init__(self, length, entries=None):
+        self.length = length
+        self.entries = {} if entries is None else entries
+
+    @staticmethod
+    def of(values):
+        return SparseList(len(values), dict(populated(values)))
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, pos):
+        if isinstance(pos, slice):
+            return self.to_list()[pos]
+        if pos < 0:
+            pos += self.length
+        if pos < 0 or pos >= self.length:
+            raise IndexError('SparseList index out of range')
+        return self.entries.get(pos)
+
+    def __setitem__(self, pos, item):
+        if pos < 0:
+            pos += self.length
+        if pos < 0 or pos >= self.length:
+            raise IndexError('SparseList assignment index out of range')
+        if item is None:
+            self.entries.pop(pos, None)
+        else:
+            self.entries[pos] = item
+
+    def __iter__(self):
+        entries = self.entries
+        for pos in range(self.length):
+            yield entries.get(pos)
+
+    # The (position, item) pairs of the populated entries, in position order
+    def populated(self):
+        return sorted(self.entries.items())
+
+    def to_list(self):
+        result = [None] * self.length
+        for pos, item in self.entries.items():
+            result[pos] = item
+        return result
+
+    def __eq__(self, other):
+        if isinstance(other, SparseList):
+            return self.entries == other.entries
+        if isinstance(other, list):
+            return (all(item is None for item in other[self.length:]) and
+                    self.entries == dict(populated(other[:self.length])))
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'SparseList(' + str(self.length) + ', ' + repr(dict(self.populated())) + ')'
+
+
+# The (position, item) pairs of the non None entries of a list, SparseList or LazyList
+def populated(values):
+    if isinstance(values, (SparseList, LazyList)):
+        return values.populated()
+    return [(pos, item) for pos, item in enumerate(values) if item is not None]
+
+
+# A list whose entries are only parsed when they are first accessed, see Grammar.use_lazy_lists
+# It keeps the list's element, with the debugging name, list position and model the list was parsed with. An entry is
+# parsed with the list position of its index pushed, as it is when the whole list is parsed, so position functions
+# (like identity) parse the same. Parse errors in an entry are raised when it is accessed.
+# The element must not be changed while the list is lazy.
+# Comparing, iterating, genning, digesting and copying parse the entries that aren't parsed yet. resolve() is the
+# result parsing the whole list would have given: a list, a SparseList or None.
+class LazyList:
+    __slots__ = ('grammar', 'node', 'elem', 'name', 'list_pos', 'model', 'length', 'entries')
+
+    def __init__(self, grammar, node, elem, name, list_pos, model, length):
+        self.grammar = grammar
+        self.node = node
+        self.elem = elem
+        self.name = list(GrammarPath.of(name))
+        self.list_pos = list(list_pos)
+        self.model = model
+        self.length = length
+        # The parsed entries, by position
+        self.entries = {}
+
+    # An element without entries parses to None, as it does when the list isn't lazy, and so does one whose entries
+    # are all default in a complete grammar (checked against the gen template, see Grammar.is_default)
+    # An entry that differs from its template parses to its model. Without a template, or with a cleanup (which may
+    # clean the model up to None), the entries are parsed until one isn't None, and kept parsed.
+    @staticmethod
+    def of(grammar, node, elem, name, list_pos, model, length):
+        lazy = None
+        for pos, list_elem in enumerate(elem):
+            if list_elem is not None:
+                list_pos.append(pos)
+                default = grammar.is_default(node.schema, list_elem, list_pos)
+                decided = node.schema.cleanup is None and grammar.gen_template(node.schema, list_pos) is not None
+                list_pos.pop()
+                if not default:
+                    if lazy is None:
+                        lazy = LazyList(grammar, node, elem, name, list_pos, model, length)
+                    if decided or lazy.parse_entry(pos) is not None:
+                        return lazy
+        return None
+
+    def parse_entry(self, pos):
+        list_elem = self.elem[pos] if pos < len(self.elem) else None
+        result = None
+        if list_elem is not None:
+            grammar = self.grammar
+            name = GrammarPath()
+            name.extend(self.name)
+            list_pos = self.list_pos + [pos]
+            if grammar.stack_engine:
+                result = grammar.run_steps(grammar.parse_steps(list_elem, self.node.schema, name, self.elem, list_pos,
+                                                               self.model))
+            else:
+                result = grammar.parse(list_elem, self.node.schema, name, self.elem, list_pos, self.model)
+        self.entries[pos] = result
+        return result
+
+    def position(self, pos):
+        if pos < 0:
+            pos += self.length
+        if pos < 0 or pos >= self.length:
+            raise IndexError('LazyList index out of range')
+        return pos
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, pos):
+        if isinstance(pos, slice):
+            return self.to_list()[pos]
+        pos = self.position(pos)
+        if pos in self.entries:
+            return self.entries[pos]
+        return self.parse_entry(pos)
+
+    def __setitem__(self, pos, item):
+        self.entries[self.position(pos)] = item
+
+    def __iter__(self):
+        for pos in range(self.length):
+            yield self[pos]
+
+    def populated(self):
+        return [(pos, item) for pos, item in enumerate(self) if item is not None]
+
+    def to_list(self):
+        return list(self)
+
+    def resolve(self):
+        result = self.node.parse_result(self.length)
+        modified = False
+        for pos, item in enumerate(self):
+            if item is not None:
+                modified = True
+                result[pos] = item
+        if not modified:
+            return None
+        if self.grammar.minimal and not self.node.sparse:
+            prune_list(result)
+        return result
+
+    def __eq__(self, other):
+        if isinstance(other, LazyList):
+            other = other.resolve()
+        return self.resolve() == other
+
+    __hash__ = None
+
+    # A copy or a pickle is of the parsed list, it doesn't keep the grammar or the element
+    def __deepcopy__(self, memo):
+        return copy.deepcopy(self.resolve(), memo)
+
+    def __reduce__(self):
+        return identity_value, (self.resolve(),)
+
+    def __repr__(self):
+        return 'LazyList(' + str(self.length) + ', ' + str(len(self.entries)) + ' parsed)'
+
+
+# Unpickles a LazyList as its parsed list, see LazyList.__reduce__
+def identity_value(value):
+    return value
+
+
+# Parallel lists: the entries of the named lists are parsed and genned by a pool of worker processes, see
+# Grammar.use_parallel_lists
+# The entries are sent to the workers in chunks of chunk_size, and the results are merged back in list order. Each
+# worker has its own copy of the grammar, with the same mode and engine, and parses or gens an entry with the list
+# position and debugging name it has in the whole element, so position functions and error messages are the same.
+# An error in an entry is raised from the first chunk (in list order) that has one, as parsing the list in order would.
+# In complete grammars, default entries are checked against the gen template without a worker, and gaps are stamped
+# from it, so only the significant entries are sent.
+class ParallelLists:
+    def __init__(self, grammar, list_names, max_workers=None, chunk_size=8):
+        if chunk_size < 1:
+            raise GrammarException('parallel_bad_chunk_size', 'The chunk size ' + str(chunk_size) + ' is less than 1')
+        self.grammar = grammar
+        self.max_workers = max_workers
+        self.chunk_size = chunk_size
+        # The list nodes, with the index the workers know them by
+        self.nodes = {}
+        found = grammar.find_nodes(list_names)
+        for list_name in list_names:
+            nodes = [node for node in found[list_name] if isinstance(node, List)]
+            if not nodes:
+                raise GrammarException('parallel_list_not_found', 'There is no list ' + list_name + ' in the grammar')
+            for node in nodes:
+                if not node.independent:
+                    raise GrammarException('parallel_list_not_independent',
+                                           'The entries of the list ' + list_name + ' bind into the enclosing model')
+                # The workers parse each entry without the list, which is the context its cleanup is called with
+                if node.schema.cleanup is not None:
+                    raise GrammarException('parallel_list_uses_context',
+                                           'The entries of the list ' + list_name + ' have a cleanup, which is ' +
+                                           'called with the list')
+                self.nodes.setdefault(node, len(self.nodes))
+        # Started on first use
+        self.executor = None
+
+    def engine(self):
+        if self.grammar.compiled_parse is not None:
+            return 'compiled'
+        if self.grammar.stack_engine:
+            return 'stack'
+        return 'interpreted'
+
+    def pool(self):
+        if self.executor is None:
+            self.executor = concurrent.futures.ProcessPoolExecutor(
+                self.max_workers, initializer=parallel_worker_init,
+                initargs=(self.grammar.schema, self.grammar.minimal, self.engine(), list(self.nodes)))
+        return self.executor
+
+    # Run the chunks of (position, value) entries in the pool, returning the (position, result) pairs in order
+    def run(self, function, node, entries, *args):
+        if not entries:
+            return []
+        index = self.nodes[node]
+        futures = [self.pool().submit(function, index, entries[start:start + self.chunk_size], *args)
+                   for start in range(0, len(entries), self.chunk_size)]
+        results = []
+        try:
+            for future in futures:
+                results.extend(future.result())
+        finally:
+            for future in futures:
+                future.cancel()
+        return results
+
+    # Parse the element of the list node, giving what List.parse would
+    def parse(self, node, elem, name, list_pos, list_length):
+        grammar = self.grammar
+        check_default = not grammar.minimal and isinstance(node.schema, DictBase)
+        entries = []
+        list_pos.append(0)
+        for pos, list_elem in enumerate(elem):
+            if list_elem is not None:
+                list_pos[-1] = pos
+                if not (check_default and grammar.is_default(node.schema, list_elem, list_pos)):
+                    entries.append((pos, list_elem))
+        list_pos.pop()
+        return node.merge_entries(grammar, list_length, self.run(parallel_parse_chunk, node, entries,
+                                                                 list(GrammarPath.of(name)), list(list_pos)))
+
+    # Gen the list node from a list or SparseList model, giving what List.gen would
+    def gen(self, node, model, list_pos):
+        grammar = self.grammar
+        list_length = node.gen_length(grammar, model, True)
+        if type(model) is SparseList:
+            entries = sorted(model.entries.items())
+        else:
+            entries = [(pos, sub_model) for pos, sub_model in enumerate(model) if sub_model is not None]
+        result = [None] * list_length
+        for pos, entry in self.run(parallel_gen_chunk, node, entries, list(list_pos)):
+            result[pos] = entry
+        populated = set(pos for pos, _ in entries)
+        list_pos.append(0)
+        template = node.gap_template(grammar, list_pos)
+        for pos in range(0, list_length):
+            if pos not in populated:
+                list_pos[-1] = pos
+                if template is not None:
+                    result[pos] = grammar.stamp_template(template, list_pos)
+                else:
+                    result[pos] = grammar.gen(None, node.schema, result, list_pos)
+        list_pos.pop()
+        if grammar.minimal:
+            prune_list(result)
+            if len(result) == 0:
+                return None
+        return result
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+
+# The grammar and parallel list nodes of a worker process, set by parallel_worker_init
+parallel_worker = None
+
+
+def parallel_worker_init(schema, minimal, engine, nodes):
+    global parallel_worker
+    grammar = Grammar(schema, minimal)
+    if engine == 'compiled':
+        grammar.compile()
+    elif engine == 'stack':
+        grammar.use_stack_engine()
+    # The compiled closures of each node, by node index (and debugging name for parsing)
+    parallel_worker = (grammar, nodes, {})
+
+
+def parallel_parse_chunk(index, entries, name, list_pos):
+    grammar, nodes, compiled = parallel_worker
+    schema = nodes[index].schema
+    list_pos.append(0)
+    results = []
+    for pos, list_elem in entries:
+        list_pos[-1] = pos
+        if grammar.compiled_parse is not None:
+            key = ('parse', index, ':'.join(name))
+            if key not in compiled:
+                compiled[key] = grammar.compile_parse(schema, ':'.join(name))
+            entry_result = compiled[key](list_elem, None, list_pos, None)
+        else:
+            path = GrammarPath()
+            path.extend(name)
+            if grammar.stack_engine:
+                entry_result = grammar.run_steps(grammar.parse_steps(list_elem, schema, path, None, list_pos, None))
+            else:
+                entry_result = grammar.parse(list_elem, schema, path, None, list_pos, None)
+        results.append((pos, entry_result))
+    return results
+
+
+def parallel_gen_chunk(index, entries, list_pos):
+    grammar, nodes, compiled = parallel_worker
+    schema = nodes[index].schema
+    list_pos.append(0)
+    results = []
+    for pos, sub_model in entries:
+        list_pos[-1] = pos
+        if grammar.compiled_gen is not None:
+            key = ('gen', index)
+            if key not in compiled:
+                compiled[key] = grammar.compile_gen(schema)
+            results.append((pos, compiled[key](sub_model, None, list_pos)))
+        elif grammar.stack_engine:
+            results.append((pos, grammar.run_steps(grammar.gen_steps(sub_model, schema, None, list_pos))))
+        else:
+            results.append((pos, grammar.gen(sub_model, schema, None, list_pos)))
+    return results
+
+
+# A placeholder for an entry of the list position while a gen template is built
+# The position functions can add offsets to it
+class ListPositionPlaceholder:
+    def __init__(self, index, offset=0):
+        self.index = index
+        self.offset = offset
+
+    def __add__(self, other):
+        return ListPositionPlaceholder(self.index, self.offset + other)
+
+    __radd__ = __add__
+
+
+# A gen template is the result of genning a node without a model, with placeholders for the list position entries
+# The value is kept marshalled, so stamping out a copy is a single loads, and then the placeholders are filled in
+#
+# Templates are also used when parsing, to recognize elements that are the default: see Grammar.is_default
+# The comparison is ==, which doesn't tell True from 1, or 1 from 1.0, so the types of the entries are then checked
+# too: parse rejects 0 for a bool or 0.0 for an int, and an element that isn't an exact match falls back to the parse.
+class GenTemplate:
+    position_marker = 0x3A5C0000
+
+    # stamps are the templates stamped out while genning the value, by id (see Grammar.stamp_template)
+    def __init__(self, value, stamps):
+        # (path to the placeholder, list position index, offset)
+        self.positions = []
+        self.find_positions(value, (), stamps)
+        self.data = marshal.dumps(value)
+        # A private copy, filled in with the list position being parsed
+        self.canonical = None
+        self.orders = self.find_orders(marshal.loads(self.data))
+
+    # Placeholders in a stamped out template can only be at its positions, so those are the only ones checked
+    def find_positions(self, value, path, stamps):
+        stamp = stamps.get(id(value))
+        if stamp is not None and stamp[0] is value:
+            template = stamp[1]
+            for sub_path, index, offset in template.positions:
+                container = value
+                for key in sub_path[:-1]:
+                    container = container[key]
+                entry = container[sub_path[-1]]
+                if isinstance(entry, ListPositionPlaceholder):
+                    self.positions.append((path + sub_path, entry.index, entry.offset))
+                    container[sub_path[-1]] = None
+            return
+
+        if isinstance(value, dict):
+            entries = value.items()
+        elif isinstance(value, list):
+            entries = enumerate(value)
+        else:
+            return
+        for key, entry in entries:
+            if isinstance(entry, ListPositionPlaceholder):
+                self.positions.append((path + (key,), entry.index, entry.offset))
+                value[key] = None
+            else:
+                self.find_positions(entry, path + (key,), stamps)
+
+    # The value marshalled (version 2, see matches) and split at the list position entries, so a match only marshals the
+    # positions: [(bytes, position or None)]. This is done for the keys in the order they are genned, and sorted, as
+    # the yaml backends save them.
+    # Positions are found from marker values, which can't be told apart if the template has the same number elsewhere.
+    # The order is then None, and matches compares the entries instead.
+    def find_orders(self, value):
+        markers = []
+        for position, (path, index, offset) in enumerate(self.positions):
+            container = value
+            for key in path[:-1]:
+                container = container[key]
+            container[path[-1]] = self.position_marker + position
+            markers.append(marshal.dumps(self.position_marker + position, 2))
+        return [self.find_segments(marshal.dumps(value, 2), markers),
+                self.find_segments(marshal.dumps(self.sort_keys(value), 2), markers)]
+
+    @staticmethod
+    def find_segments(data, markers):
+        found = []
+        for position, marker in enumerate(markers):
+            if data.count(marker) != 1:
+                return None
+            found.append((data.index(marker), position))
+        segments = []
+        start = 0
+        for at, position in sorted(found):
+            segments.append((data[start:at], position))
+            start = at + len(markers[position])
+        segments.append((data[start:], None))
+        return segments
+
+    @staticmethod
+    def sort_keys(value):
+        if isinstance(value, dict):
+            return {key: GenTemplate.sort_keys(value[key]) for key in sorted(value)}
+        if isinstance(value, list):
+            return [GenTemplate.sort_keys(entry) for entry in value]
+        return value
+
+    def join_segments(self, segments, list_pos):
+        pieces = []
+        for data, position in segments:
+            pieces.append(data)
+            if position is not None:
+                path, index, offset = self.positions[position]
+                pieces.append(marshal.dumps(list_pos[index] + offset, 2))
+        return b''.join(pieces)
+
+    def fill_positions(self, value, list_pos):
+        for path, index, offset in self.positions:
+            container = value
+            for key in path[:-1]:
+                container = container[key]
+            container[path[-1]] = list_pos[index] + offset
+
+    def stamp(self, list_pos):
+        value = marshal.loads(self.data)
+        self.fill_positions(value, list_pos)
+        return value
+
+    def matches(self, elem, list_pos):
+        if self.canonical is None:
+            self.canonical = marshal.loads(self.data)
+        self.fill_positions(self.canonical, list_pos)
+        if elem != self.canonical:
+            return False
+        # Equal values that marshal the same have the same types. Version 2 is used, as it doesn't record the sharing of
+        # objects or interned strings. The keys can be in another order, or a list be a subclass (which doesn't
+        # marshal), and then the types are compared entry by entry
+        try:
+            data = marshal.dumps(elem, 2)
+        except ValueError:
+            data = None
+        for segments in self.orders:
+            if data is not None and segments is not None and data == self.join_segments(segments, list_pos):
+                return True
+        return self.same_types(elem, self.canonical)
+
+    # elem is known to be == value, so the dicts have the same keys and the lists the same lengths
+    # The scalar entries are compared in place, as there are many more of them than of dicts and lists
+    def same_types(self, elem, value):
+        if isinstance(value, dict):
+            if not isinstance(elem, dict):
+                return False
+            entries = ((elem[key], entry) for key, entry in value.items())
+        elif isinstance(value, list):
+            if not isinstance(elem, list):
+                return False
+            entries = zip(elem, value)
+        else:
+            return type(elem) is type(value)
+        return all(self.same_types(elem_entry, entry) if isinstance(entry, (dict, list))
+                   else type(elem_entry) is type(entry) for elem_entry, entry in entries)
+
+
+# Profiling statistics for the schema nodes with the same name and type
+class NodeProfile:
+    def __init__(self, name, node_type):
+        self.name = name
+        self.node_type = node_type
+        self.visits = 0
+        # The seconds spent in the node, with (time) and without (self_time) its sub-elements
+        self.time = 0.0
+        self.self_time = 0.0
+        # The models built for the node, including switch models
+        self.models = 0
+        # The calls to default and value functions
+        self.default_calls = 0
+        self.value_calls = 0
+
+
+# The profile of a grammar, see Grammar.enable_profiling
+# nodes maps (node name, node type name) to its NodeProfile
+# A node nested in a node with the same name and type has its time counted in both, its self time only once
+class GrammarProfile:
+    def __init__(self):
+        self.nodes = {}
+        # A stack of the time spent in the sub-elements of each node being visited
+        self.sub_times = []
+
+    def node(self, schema):
+        key = (schema.name, type(schema).__name__)
+        node = self.nodes.get(key)
+        if node is None:
+            node = NodeProfile(schema.name, type(schema).__name__)
+            self.nodes[key] = node
+        return node
+
+    def visited(self, schema, start, models):
+        elapsed = time.perf_counter() - start
+        sub_time = self.sub_times.pop()
+        node = self.node(schema)
+        node.visits += 1
+        node.time += elapsed
+        node.self_time += elapsed - sub_time
+        node.models += models
+        if self.sub_times:
+            self.sub_times[-1] += elapsed
+
+    def count_function(self, schema, is_value):
+        node = self.node(schema)
+        if is_value:
+            node.value_calls += 1
+        else:
+            node.default_calls += 1
+
+    # Wrap a default or value function to count its calls
+    def counted_function(self, schema, function, is_value):
+        def counted(*args):
+            self.count_function(schema, is_value)
+            return function(*args)
+        return counted
+
+    # Wrap a model class to count the models built
+    def counted_model(self, schema, model_class):
+        def counted():
+            self.node(schema).models += 1
+            return model_class()
+        return counted
+
+    # Profiled versions of the per-element methods, where the schema is the second argument
+    # Parsing counts the model built for the schema
+    def wrap(self, method, parsing):
+        def profiled(*args):
+            schema = args[1]
+            if schema is None:
+                return method(*args)
+            self.sub_times.append(0.0)
+            start = time.perf_counter()
+            try:
+                return method(*args)
+            finally:
+                self.visited(schema, start, 1 if parsing and schema.model is not None else 0)
+        return profiled
+
+    # The steps are only counted when they finish, a parse or gen that raised leaves an unused time on the stack
+    def wrap_steps(self, method, parsing):
+        def profiled(*args):
+            schema = args[1]
+            if schema is None:
+                return (yield from method(*args))
+            self.sub_times.append(0.0)
+            start = time.perf_counter()
+            result = yield from method(*args)
+            self.visited(schema, start, 1 if parsing and schema.model is not None else 0)
+            return result
+        return profiled
+
+    # The compiling methods return the closure for the schema, which is profiled
+    def wrap_compile(self, compile_method, parsing):
+        def profiled_compile(schema, *args):
+            body = compile_method(schema, *args)
+            models = 1 if parsing and schema.model is not None else 0
+
+            def profiled(*body_args):
+                self.sub_times.append(0.0)
+                start = time.perf_counter()
+                try:
+                    return body(*body_args)
+                finally:
+                    self.visited(schema, start, models)
+            return profiled
+        return profiled_compile
+
+    # A table of the nodes, by decreasing self time
+    def report(self, limit=None):
+        nodes = sorted(self.nodes.values(), key=lambda node: node.self_time, reverse=True)
+        if limit is not None:
+            nodes = nodes[:limit]
+        line_format = '%-32s %-10s %10s %10s %10s %8s %10s %10s'
+        lines = [line_format % ('Node', 'Type', 'Visits', 'Time', 'Self', 'Models', 'Defaults', 'Values')]
+        for node in nodes:
+            lines.append(line_format % (node.name[:32], node.node_type, node.visits, '%.4f' % node.time,
+                                        '%.4f' % node.self_time, node.models, node.default_calls, node.value_calls))
+        return '\n'.join(lines)
+
+    def __str__(self):
+        return self.report()
+
+
 class Grammar:
     def __init__(self, schema, minimal=False):
         self.schema = schema
         self.minimal = minimal
+        # Set by compile()
+        self.compiled_parse = None
+        self.compiled_gen = None
+        # Set by use_stack_engine()
+        self.stack_engine = False
+        # Gen templates, by (schema, list position length), None if the schema can't be templated
+        self.templates = {}
+        # While a template is built, the templates stamped out in it
+        self.template_stamps = None
+        # The digests of the opaque blobs checked with their full schema, by Opaque node
+        self.opaque_digests = {}
+        # Set by enable_profiling()
+        self.profile = None
+        # Set by use_interning(), the variables to freeze in each model class
+        self.intern_vars = None
+        # The closures compiled for gen_at and parse_at
+        self.compiled_subtrees = {}
+        # Set by use_lazy_lists()
+        self.lazy_lists = False
+        # Set by use_parallel_lists()
+        self.parallel = None
+        # Set by fingerprint()
+        self.schema_fingerprint = None
 
     # Parsing
     # Parson a JSON/YAML subexpression can store the result in 3 ways
@@ -799,11 +3059,12 @@ class Grammar:
             model = schema.model()
             new_model = True
 
-        if name == "":
-            name = schema.name
+        name = GrammarPath.of(name)
+        name.append(schema.name)
+        if self.is_default(schema, elem, list_pos):
+            result = None
         else:
-            name = name + ":" + schema.name
-        result = schema.parse(self, elem, name, context, list_pos, model)
+            result = schema.parse(self, elem, name, context, list_pos, model)
 
         if new_model:
             if result is not None:
@@ -818,6 +3079,7 @@ class Grammar:
         if schema.variable is not None and result is not None:
             model.set_var(schema.variable, result, name)
             result = None
+        name.pop()
         return result
 
     # Generate a config JSON/YAML string from a model
@@ -852,61 +3114,1095 @@ class Grammar:
                 if not isinstance(model, GrammarModel):
                     raise GrammarException('variable_without_model',
                                            "In gen_elem, have a variable that isn't a model")
-                model_vars = vars(model)
-                if schema.variable not in model_vars.keys():
+                if not model.has_var(schema.variable):
                     raise GrammarException('variable_not_in_model',
                                            'The variable ' + schema.variable + ' is not in the model ' +
                                            model.model_name)
-                sub_model = model_vars[schema.variable]
+                sub_model = getattr(model, schema.variable)
 
+        if sub_model is None and isinstance(schema, DictBase) and not self.minimal:
+            template = self.gen_template(schema, list_pos)
+            if template is not None:
+                return self.stamp_template(template, list_pos)
         result = schema.gen(self, sub_model, context, list_pos)
         return result
 
+    # Gen templates
+    # In a complete grammar, genning a node without a model gives the same result every time, except for atoms
+    # whose value is a function of the list position. Most of the banks, presets and messages in a backup are unused,
+    # so the same results are genned thousands of times.
+    # The first time a container node is genned without a model, its result is built once as a template with
+    # placeholders for the list position, and then copies are stamped out.
+    # Templates are only built for dict nodes whose functions are all template_functions
+    # Lists aren't templated themselves: their entries are, and stamping the entries costs the same as stamping a
+    # list template would
+    def gen_template(self, schema, list_pos):
+        key = (schema, len(list_pos))
+        if key in self.templates:
+            return self.templates[key]
+        template = None
+        if schema.templatable():
+            placeholders = [ListPositionPlaceholder(index) for index in range(len(list_pos))]
+            outer_stamps = self.template_stamps
+            if outer_stamps is None:
+                self.template_stamps = {}
+            try:
+                template = GenTemplate(schema.gen(self, None, None, placeholders), self.template_stamps)
+            finally:
+                self.template_stamps = outer_stamps
+        self.templates[key] = template
+        return template
+
+    # Model variables: the variables the schema binds in each model class, as {model class: set of variable names}
+    # A model must have all of them, so this can declare slotted models (see make_model_class), or check them
+    def model_vars(self, schema=None):
+        result = {}
+        self.collect_vars(self.schema if schema is None else schema, None, result)
+        return result
+
+    # A node's variable binds in the enclosing model, its children bind in the node's model if it has one
+    @staticmethod
+    def collect_vars(schema, model, result):
+        if schema.variable is not None and model is not None:
+            result[model].add(schema.variable)
+        if schema.model is not None:
+            model = schema.model
+            result.setdefault(model, set())
+        schema.collect_vars(model, result)
+
+    # The stamps are kept while a template is built, so it doesn't need to search them for placeholders
+    # Keeping the value also keeps its id from being reused
+    def stamp_template(self, template, list_pos):
+        value = template.stamp(list_pos)
+        if self.template_stamps is not None:
+            self.template_stamps[id(value)] = (value, template)
+        return value
+
+    # Fast accept: in a complete grammar, a dict element equal to the dict's template is the default.
+    # It parses as insignificant, so its sub-elements don't need to be visited.
+    # A model, cleanup and variable on the dict are still handled as usual.
+    def is_default(self, schema, elem, list_pos):
+        if self.minimal or not isinstance(schema, DictBase):
+            return False
+        template = self.gen_template(schema, list_pos)
+        return template is not None and template.matches(elem, list_pos)
+
+    # Validating
+    # validate runs the checks parse does on an element: structure, types, enums, values and value functions (such as
+    # the version check). It doesn't build models or results, and doesn't run cleanup functions, so it is cheaper than
+    # parse_config when only the validity of a file matters.
+    # It raises the GrammarException parse_config would, except for the errors binding results to models.
+    def validate(self, elem):
+        self.validate_elem(elem, self.schema, "", None, [])
+
+    # The validating equivalent of parse
+    def validate_elem(self, elem, schema, name, context, list_pos):
+        if schema is None:
+            raise GrammarException('no_schema', "Schema is None")
+        name = GrammarPath.of(name)
+        name.append(schema.name)
+        if not self.is_default(schema, elem, list_pos):
+            schema.validate(self, elem, name, context, list_pos)
+        name.pop()
+
+    # Profiling
+    # enable_profiling collects, for each schema node name and type, the visits, the time spent, the models built and
+    # the calls to default and value functions, in self.profile (a GrammarProfile, see its report method).
+    # The per-element methods are replaced by profiled versions on this grammar object only, so a grammar that isn't
+    # profiled runs the same code as before. The compiled closures are rebuilt with profiling.
+    # Profiling continues from where it was if it is enabled again.
+    def enable_profiling(self):
+        if self.profile is not None:
+            return self
+        profile = GrammarProfile()
+        self.profile = profile
+        self.parse = profile.wrap(self.parse, True)
+        self.gen = profile.wrap(self.gen, False)
+        self.validate_elem = profile.wrap(self.validate_elem, False)
+        self.parse_steps = profile.wrap_steps(self.parse_steps, True)
+        self.gen_steps = profile.wrap_steps(self.gen_steps, False)
+        self.compile_parse = profile.wrap_compile(self.compile_parse, True)
+        self.compile_gen = profile.wrap_compile(self.compile_gen, False)
+        if self.compiled_parse is not None:
+            self.compile()
+        return self
+
+    # Stack engine
+    # parse and gen above recurse through several Python frames for every level of the schema.
+    # The stack engine instead runs the generator versions of parse and gen (parse_steps, gen_steps) from an explicit
+    # stack, so the depth of the schema and model is not limited by the Python recursion limit.
+    # It gives the same results and raises the same exceptions as parse and gen.
+    # Once selected, parse_config and gen_config use the stack engine.
+    def use_stack_engine(self):
+        self.stack_engine = True
+        return self
+
+    # Run the steps: each step yields the steps for a sub-element, which are run before it is sent their result
+    @staticmethod
+    def run_steps(steps):
+        stack = [steps]
+        value = None
+        while True:
+            try:
+                sub_steps = stack[-1].send(value)
+            except StopIteration as done:
+                stack.pop()
+                if not stack:
+                    return done.value
+                value = done.value
+            else:
+                stack.append(sub_steps)
+                value = None
+
+    # The steps equivalent of parse
+    def parse_steps(self, elem, schema, name, context, list_pos, model):
+        if schema is None:
+            raise GrammarException('no_schema', "Schema is None")
+
+        old_model = model
+        if schema.model is not None:
+            model = schema.model()
+
+        name = GrammarPath.of(name)
+        name.append(schema.name)
+        if self.is_default(schema, elem, list_pos):
+            result = None
+        elif schema.container:
+            result = yield schema.parse_steps(self, elem, name, context, list_pos, model)
+        else:
+            result = schema.parse(self, elem, name, context, list_pos, model)
+
+        if schema.model is not None:
+            if result is not None:
+                raise GrammarException('unconsumed', "Model was used, but some result not added")
+            if model.modified:
+                result = model
+            model = old_model
+
+        if schema.cleanup is not None:
+            result = schema.cleanup(result, context, list_pos)
+
+        if schema.variable is not None and result is not None:
+            model.set_var(schema.variable, result, name)
+            result = None
+        name.pop()
+        return result
+
+    # The steps equivalent of gen
+    def gen_steps(self, model, schema, context, list_pos):
+        if schema is None:
+            raise GrammarException('no_schema', "Schema is None")
+
+        if schema.model is not None and not isinstance(model, schema.model):
+            sub_model = None
+        else:
+            sub_model = model
+
+        if schema.variable is not None and model is not None:
+            if not isinstance(model, GrammarModel):
+                raise GrammarException('variable_without_model',
+                                       "In gen_elem, have a variable that isn't a model")
+            if not model.has_var(schema.variable):
+                raise GrammarException('variable_not_in_model',
+                                       'The variable ' + schema.variable + ' is not in the model ' +
+                                       model.model_name)
+            sub_model = getattr(model, schema.variable)
+
+        if sub_model is None and isinstance(schema, DictBase) and not self.minimal:
+            template = self.gen_template(schema, list_pos)
+            if template is not None:
+                return self.stamp_template(template, list_pos)
+        if schema.container:
+            return (yield schema.gen_steps(self, sub_model, context, list_pos))
+        return schema.gen(self, sub_model, context, list_pos)
+
+    # Compiling
+    # parse and gen above interpret the schema: every node visit re-checks the model, variable and cleanup
+    # bindings, extends the debugging name, and dispatches to the node type.
+    # Compiling walks the schema once and turns every node into a closure with those decisions already made.
+    # The debugging names are fixed at compile time, as they only depend on the position in the schema.
+    # Shared schema nodes are compiled once per position they appear in.
+    # The compiled closures give the same results and raise the same exceptions as parse and gen.
+    # Once compiled, parse_config and gen_config use the closures.
+    def compile(self):
+        self.compiled_parse = self.compile_parse(self.schema, "")
+        self.compiled_gen = self.compile_gen(self.schema)
+        return self
+
+    # The compiled equivalent of parse: handles the model, cleanup and variable bindings around the node closure
+    def compile_parse(self, schema, name):
+        if schema is None:
+            raise GrammarException('no_schema', "Schema is None")
+        if name == "":
+            name = schema.name
+        else:
+            name = name + ":" + schema.name
+        parse_body = schema.compile_parse(self, name)
+        if isinstance(schema, DictBase) and not self.minimal:
+            parse_body = self.compile_parse_default(schema, parse_body)
+        model_class = schema.model
+        cleanup = schema.cleanup
+        variable = schema.variable
+
+        if model_class is None and cleanup is None:
+            if variable is None:
+                return parse_body
+
+            def parse_variable(elem, context, list_pos, model):
+                result = parse_body(elem, context, list_pos, model)
+                if result is not None:
+                    model.set_var(variable, result, name)
+                    return None
+                return result
+            return parse_variable
+
+        def parse_node(elem, context, list_pos, model):
+            if model_class is not None:
+                new_model = model_class()
+                result = parse_body(elem, context, list_pos, new_model)
+                if result is not None:
+                    raise GrammarException('unconsumed', "Model was used, but some result not added")
+                if new_model.modified:
+                    result = new_model
+            else:
+                result = parse_body(elem, context, list_pos, model)
+            if cleanup is not None:
+                result = cleanup(result, context, list_pos)
+            if variable is not None and result is not None:
+                model.set_var(variable, result, name)
+                result = None
+            return result
+        return parse_node
+
+    # The compiled equivalent of gen: resolves the sub model before calling the node closure
+    def compile_gen(self, schema):
+        if schema is None:
+            raise GrammarException('no_schema', "Schema is None")
+        gen_body = schema.compile_gen(self)
+        if isinstance(schema, DictBase) and not self.minimal:
+            gen_body = self.compile_gen_template(schema, gen_body)
+        model_class = schema.model
+        variable = schema.variable
+
+        if model_class is None and variable is None:
+            return gen_body
+
+        def gen_node(model, context, list_pos):
+            if model_class is not None and not isinstance(model, model_class):
+                sub_model = None
+            else:
+                sub_model = model
+            if variable is not None and model is not None:
+                if not isinstance(model, GrammarModel):
+                    raise GrammarException('variable_without_model',
+                                           "In gen_elem, have a variable that isn't a model")
+                if not model.has_var(variable):
+                    raise GrammarException('variable_not_in_model',
+                                           'The variable ' + variable + ' is not in the model ' +
+                                           model.model_name)
+                sub_model = getattr(model, variable)
+            return gen_body(sub_model, context, list_pos)
+        return gen_node
+
+    # Accept default elements without parsing them
+    def compile_parse_default(self, schema, parse_body):
+        def parse_default(elem, context, list_pos, model):
+            template = self.gen_template(schema, list_pos)
+            if template is not None and template.matches(elem, list_pos):
+                return None
+            return parse_body(elem, context, list_pos, model)
+        return parse_default
+
+    # Stamp out the gen template when there is no model
+    def compile_gen_template(self, schema, gen_body):
+        def gen_template(model, context, list_pos):
+            if model is None:
+                template = self.gen_template(schema, list_pos)
+                if template is not None:
+                    return self.stamp_template(template, list_pos)
+            return gen_body(model, context, list_pos)
+        return gen_template
+
     def print(self, indent=0):
         return self.schema.print(indent)
 
+    # Interning: parse_config shares one frozen instance between structurally identical models, lists and dicts in
+    # its result, and interns the strings. A backup repeats the same messages, presets and names many times, so it
+    # holds much less memory, and equal subtrees are usually the same object (== and equals() check that first).
+    # Subtrees are shared within one parse_config result. copy.deepcopy() gives a model that can be changed.
+    def use_interning(self):
+        self.intern_vars = self.model_vars()
+        return self
+
+    # Lazy lists: parse_config returns the lists whose entries parse to their own model (the banks, presets and
+    # messages of a backup) as LazyLists, which only parse an entry when it is first accessed. Looking at one bank of a
+    # backup only parses that bank.
+    # The entries aren't checked until they are parsed, use validate() to check the whole element.
+    # Only complete grammars have lazy lists: a list is insignificant if its entries are all default, which complete
+    # grammars check against the gen templates without parsing. Minimal grammars would have to parse the entries.
+    def use_lazy_lists(self):
+        self.lazy_lists = not self.minimal
+        return self
+
+    # Parallel lists: the entries of the named lists (like the 'Bank List' of a backup) are parsed and genned by a
+    # pool of max_workers processes (default one per core), in chunks of chunk_size entries, see ParallelLists
+    # The lists' entries must parse to their own model. The pool is started on first use, close() shuts it down.
+    def use_parallel_lists(self, list_names, max_workers=None, chunk_size=8):
+        self.close()
+        self.parallel = ParallelLists(self, list_names, max_workers, chunk_size)
+        return self
+
+    def close(self):
+        if self.parallel is not None:
+            self.parallel.shutdown()
+
+    # A hash of the grammar's structure and mode: the nodes, their names, keys, variables, models, defaults and values
+    # Grammars parsing elements to the same models have the same fingerprint, changing the schema changes it.
+    # Functions are identified by name, so a change to a function's code doesn't change the fingerprint.
+    def fingerprint(self):
+        if self.schema_fingerprint is None:
+            fingerprints = {}
+
+            def child_fingerprint(node):
+                if node is None:
+                    return None
+                if node not in fingerprints:
+                    description = repr(node.describe(child_fingerprint)).encode()
+                    fingerprints[node] = hashlib.sha256(description).hexdigest()
+                return fingerprints[node]
+            description = repr((self.minimal, child_fingerprint(self.schema))).encode()
+            self.schema_fingerprint = hashlib.sha256(description).hexdigest()
+        return self.schema_fingerprint
+
+    # The nodes of the grammar with the names, as {name: [nodes]}
+    def find_nodes(self, names):
+        result = {name: [] for name in names}
+        seen = set()
+        pending = [self.schema]
+        while pending:
+            node = pending.pop()
+            if node in seen:
+                continue
+            seen.add(node)
+            if node.name in result:
+                result[node.name].append(node)
+            pending.extend(reversed(node.children()))
+        return result
+
     def parse_config(self, elem):
-        return self.parse(elem, self.schema, "", None, [], None)
+        if self.compiled_parse is not None:
+            result = self.compiled_parse(elem, None, [], None)
+        elif self.stack_engine:
+            result = self.run_steps(self.parse_steps(elem, self.schema, "", None, [], None))
+        else:
+            result = self.parse(elem, self.schema, "", None, [], None)
+        if self.intern_vars is not None and result is not None:
+            result = InternTable(self.intern_vars).intern(result)[0]
+        return result
+
+    # Paths: gen_at and parse_at gen or parse only the subtree of an element at a path, like 'data/bankArray/17' in
+    # a backup, or 'banks/3/presets/5' in a simple config. A path is the element's keys and list positions, as a '/'
+    # separated string or a list.
+    # The list positions on the path are kept, so identity atoms gen and parse as they do in the whole element.
+    # parse_at parses with the enclosing element as the context, as parse does.
+    # This lets one bank be regenerated and spliced into an element, without genning the rest.
+    @staticmethod
+    def split_path(path):
+        if isinstance(path, str):
+            return [step for step in path.split('/') if step != '']
+        return list(path)
+
+    # The model gen uses for a node's children, see gen
+    @staticmethod
+    def path_model(model, schema):
+        if schema.variable is not None and model is not None:
+            if not isinstance(model, GrammarModel):
+                raise GrammarException('variable_without_model', "In gen_at, have a variable that isn't a model")
+            return model.get_var(schema.variable)
+        if schema.model is not None and not isinstance(model, schema.model):
+            return None
+        return model
+
+    # Gen the subtree at path from the model of the whole element
+    # A node that reads its context (see GrammarNode.reads_context) is genned with the enclosing node, which builds
+    # the context, and picked out of its result
+    def gen_at(self, model, path):
+        schema = self.schema
+        list_pos = []
+        enclosing = None
+        for step in self.split_path(path):
+            enclosing = (model, schema, list(list_pos), step)
+            schema, model = schema.path_gen_step(self, step, self.path_model(model, schema), list_pos)
+        if enclosing is not None and schema.reads_context():
+            enclosing_model, enclosing_schema, enclosing_list_pos, step = enclosing
+            return self.path_result(self.gen_subtree(enclosing_model, enclosing_schema, enclosing_list_pos), step)
+        return self.gen_subtree(model, schema, list_pos)
+
+    # The part of a genned element at a path step, None if a minimal element leaves it out
+    @staticmethod
+    def path_result(elem, step):
+        if isinstance(elem, dict):
+            return elem.get(step)
+        if isinstance(elem, list):
+            index = int(step)
+            return elem[index] if index < len(elem) else None
+        return None
+
+    # Gen the subtree of a node with the grammar's engine, from the model of the enclosing node
+    def gen_subtree(self, model, schema, list_pos):
+        if self.compiled_gen is not None:
+            key = ('gen', schema)
+            if key not in self.compiled_subtrees:
+                self.compiled_subtrees[key] = self.compile_gen(schema)
+            return self.compiled_subtrees[key](model, None, list_pos)
+        if self.stack_engine:
+            return self.run_steps(self.gen_steps(model, schema, None, list_pos))
+        return self.gen(model, schema, None, list_pos)
+
+    # Parse the subtree at path of the whole element, returning its model or value
+    # The variables a subtree binds in an enclosing model (like the keys of the backup's data dict) are returned in a
+    # new instance of that model. A subtree missing from a minimal element is default, and parses to None
+    def parse_at(self, elem, path):
+        schema = self.schema
+        list_pos = []
+        name = GrammarPath()
+        context = None
+        model_class = None
+        for step in self.split_path(path):
+            if schema.model is not None:
+                model_class = schema.model
+            name.append(schema.name)
+            context = elem
+            schema, model_class, elem = schema.path_parse_step(self, step, elem, model_class, list_pos)
+        if elem is None:
+            return None
+        model = None if model_class is None else model_class()
+        if schema.variable is not None and model is None:
+            raise GrammarException('variable_without_model', 'The ' + schema.name + ' at ' + str(path) +
+                                   ' binds the variable ' + schema.variable + ' without a model')
+        result = self.parse_subtree(elem, schema, name, context, list_pos, model)
+        if schema.variable is not None:
+            result = model.get_var(schema.variable)
+        elif result is None and model is not None and model.modified:
+            result = model
+        if self.intern_vars is not None and result is not None:
+            result = InternTable(self.intern_vars).intern(result)[0]
+        return result
+
+    # Parse the subtree of a node with the grammar's engine, name is the debugging trail of the enclosing node
+    def parse_subtree(self, elem, schema, name, context, list_pos, model):
+        if self.compiled_parse is not None:
+            key = ('parse', schema, str(name))
+            if key not in self.compiled_subtrees:
+                self.compiled_subtrees[key] = self.compile_parse(schema, str(name))
+            return self.compiled_subtrees[key](elem, context, list_pos, model)
+        if self.stack_engine:
+            return self.run_steps(self.parse_steps(elem, schema, name, context, list_pos, model))
+        return self.parse(elem, schema, name, context, list_pos, model)
+
+    # Streaming parse: parses the JSON read by the JsonReader as parse_config parses the loaded element, without
+    # loading the entries of the lists whose entries parse to their own model (like the banks of a backup) all at
+    # once. Each entry is read, parsed and released before the next one is read, and the list is parsed from the
+    # entry results (see PreparsedList). list_names limits this to the lists with those names, by default it is the
+    # outermost such lists. The rest of the element is read whole.
+    # The parse gives the same result as parse_config, but an error in an entry is raised when the entry is read,
+    # before errors in the keys the schema parses first.
+    def parse_stream(self, reader, list_names=None):
+        streamed = self.streamed_nodes(list_names)
+        elem = self.read_elem(reader, self.schema, GrammarPath(), [], streamed)
+        reader.end()
+        if elem is None:
+            elem = {}
+        return self.parse_config(elem)
+
+    # The lists parse_stream parses entry by entry, and the nodes leading to them, as {node: is a streamed list}
+    def streamed_nodes(self, list_names):
+        streamed = {}
+
+        def visit(node, seen):
+            if node in streamed:
+                return True
+            if node in seen:
+                return False
+            seen.add(node)
+            # An entry's cleanup is called with the list as its context, so lists whose entries have one are read whole
+            if (isinstance(node, List) and node.independent and node.schema.cleanup is None and
+                    (list_names is None or node.name in list_names)):
+                streamed[node] = True
+                return True
+            leads = False
+            if isinstance(node, (Dict, List)):
+                for child in node.children():
+                    leads = visit(child, seen) or leads
+            if leads:
+                streamed[node] = False
+            return leads
+        visit(self.schema, set())
+        return streamed
+
+    # Read the element of a node, name and list_pos are pushed as parse pushes them
+    def read_elem(self, reader, schema, name, list_pos, streamed):
+        if schema not in streamed:
+            return reader.value()
+        name.append(schema.name)
+        if isinstance(schema, Dict) and reader.peek() == '{':
+            if schema.key_table is None:
+                schema.key_table = schema.make_key_table(schema.keys, {})
+            elem = {}
+            for key_name in reader.items():
+                key = schema.key_table.get(key_name)
+                if key is None or key['schema'] is None:
+                    elem[key_name] = reader.value()
+                else:
+                    name.append(key_name)
+                    elem[key_name] = self.read_elem(reader, key['schema'], name, list_pos, streamed)
+                    name.pop()
+        elif isinstance(schema, List) and reader.peek() == '[':
+            elem = PreparsedList() if streamed[schema] else []
+            list_pos.append(0)
+            for pos in reader.entries():
+                list_pos[-1] = pos
+                if streamed[schema]:
+                    list_elem = reader.value()
+                    elem.append(None if list_elem is None else
+                                self.parse_subtree(list_elem, schema.schema, name, None, list_pos, None))
+                else:
+                    elem.append(self.read_elem(reader, schema.schema, name, list_pos, streamed))
+            list_pos.pop()
+        else:
+            elem = reader.value()
+        name.pop()
+        return elem
 
     def gen_config(self, model):
+        if self.compiled_gen is not None:
+            return self.compiled_gen(model, None, [])
+        if self.stack_engine:
+            return self.run_steps(self.gen_steps(model, self.schema, None, []))
         return self.gen(model, self.schema, None, [])
 
+    # Streaming gen: writes the JSON text gen_config(model) would be dumped as to write_file, as it walks the schema,
+    # so the whole element is never built. The text is the same as json.dump(element, write_file, indent=4), or
+    # with compact, json.dump(element, write_file, separators=(',', ':')).
+    # Complete grammars stream their dicts and lists, one entry at a time. Other nodes are genned whole by the
+    # grammar's engine, and written as values. Minimal grammars are genned whole, as a dict key or list entry can only
+    # be left out once its whole subtree is known to be default.
+    # Parallel lists (see use_parallel_lists) are streamed entry by entry, without the pool.
+    def gen_stream(self, model, write_file, compact=False):
+        emitter = JsonEmitter(write_file, compact)
+        if self.minimal:
+            emitter.value(self.gen_config(model), 0)
+        else:
+            self.stream(model, self.schema, [], emitter, 0)
+        emitter.flush()
+
+    # Stream the subtree of a node, from the model of the enclosing node (as gen is called)
+    # Streamed dicts and lists aren't built, so a dict or list with a child that reads its context (see
+    # GrammarNode.reads_context) is genned whole. The other leaves don't need their context, and are genned without it.
+    def stream(self, model, schema, list_pos, emitter, level):
+        if isinstance(schema, Dict):
+            sub_model = self.path_model(model, schema)
+            if (sub_model is not None and isinstance(sub_model, GrammarModel) and
+                    not any(key['schema'].reads_context() for key in schema.keys)):
+                emitter.open('{')
+                for pos, key in enumerate(schema.keys):
+                    emitter.key(pos, key['name'], level + 1)
+                    self.stream(sub_model, key['schema'], list_pos, emitter, level + 1)
+                emitter.close('}', len(schema.keys), level)
+                return
+        elif isinstance(schema, List):
+            sub_model = self.path_model(model, schema)
+            if type(sub_model) is LazyList:
+                sub_model = sub_model.resolve()
+            if (type(sub_model) is SparseList or isinstance(sub_model, list)) and not schema.schema.reads_context():
+                list_length = schema.gen_length(self, sub_model, True)
+                emitter.open('[')
+                list_pos.append(0)
+                for pos in range(0, list_length):
+                    list_pos[-1] = pos
+                    emitter.entry(pos, level + 1)
+                    self.stream(sub_model[pos] if pos < len(sub_model) else None, schema.schema, list_pos, emitter,
+                                level + 1)
+                list_pos.pop()
+                emitter.close(']', list_length, level)
+                return
+        emitter.value(self.gen_subtree(model, schema, list_pos), level)
+
+
+# Writes JSON text a token at a time, in the layout json.dump gives with indent=4, or compact separators
+# The text is buffered, and written in large chunks
+class JsonEmitter:
+    buffer_size = 1 << 16
+
+    def __init__(self, write_file, compact=False):
+        self.write_file = write_file
+        self.indent = None if compact else 4
+        self.key_separator = ':' if compact else ': '
+        self.chunks = []
+        self.size = 0
+
+    def write(self, text):
+        self.chunks.append(text)
+        self.size += len(text)
+        if self.size >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        self.write_file.write(''.join(self.chunks))
+        self.chunks = []
+        self.size = 0
+
+    def newline(self, level):
+        if self.indent is not None:
+            self.write('\n' + ' ' * (self.indent * level))
+
+    # A value written whole, indented to its level
+    # JSON strings escape their newlines, so the only newlines are the layout's own
+    def value(self, value, level):
+        text = json.dumps(value, indent=self.indent, separators=(',', self.key_separator))
+        if self.indent is not None and level > 0:
+            text = text.replace('\n', '\n' + ' ' * (self.indent * level))
+        self.write(text)
+
+    # An empty container is written on one line
+    def open(self, bracket):
+        self.write(bracket)
+
+    def close(self, bracket, length, level):
+        if length > 0:
+            self.newline(level)
+        self.write(bracket)
+
+    # The start of the entry at pos of a list or dict
+    def entry(self, pos, level):
+        if pos > 0:
+            self.write(',')
+        self.newline(level)
+
+    def key(self, pos, name, level):
+        self.entry(pos, level)
+        self.write(json.dumps(name) + self.key_separator)
+
 
+# The element of a list whose entries have been parsed as they were read (see Grammar.parse_stream), holding the
+# result of parsing each entry. Parsing the list merges the results, as parsing the entries would.
+class PreparsedList(list):
+    __slots__ = ()
+
+
+# Reads JSON text incrementally from a file, a buffer of buffer_size characters at a time
+# The element is read by walking it: items() and entries() step through a dict's keys and a list's positions, and
+# the caller reads each one's value (with value(), or by walking it) before the next step. Values are decoded whole
+# by the json module. The text already read is released as the buffer moves on.
+# Syntax errors raise json.JSONDecodeError, as json.load does, with the position in the buffer.
+class JsonReader:
+    whitespace = re.compile(r'[ \t\n\r]*')
+    number_tail = re.compile(r'[0-9.eE+-]*\Z')
+    keywords = ('true', 'false', 'null', 'NaN', 'Infinity', '-Infinity')
+
+    def __init__(self, read_file, buffer_size=1 << 16):
+        self.read_file = read_file
+        self.buffer_size = buffer_size
+        self.buffer = ''
+        self.pos = 0
+        self.at_end = False
+        self.decoder = json.JSONDecoder()
+
+    # Read another buffer, returning False at the end of the file
+    # While a value is longer than the buffer, the buffer doubles, so the value is decoded a few times, not once per
+    # buffer
+    def fill(self, size=None):
+        if self.at_end:
+            return False
+        text = self.read_file.read(size or self.buffer_size)
+        if text == '':
+            self.at_end = True
+            return False
+        self.buffer = self.buffer[self.pos:] + text
+        self.pos = 0
+        return True
+
+    def error(self, message):
+        return json.JSONDecodeError(message, self.buffer, self.pos)
+
+    # The next character that isn't whitespace, or '' at the end of the file
+    def peek(self):
+        while True:
+            self.pos = self.whitespace.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.fill():
+                return ''
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise self.error('Expecting ' + repr(char))
+        self.pos += 1
+
+    # Read a whole value, reading more of the file while the value runs past the end of the buffer
+    def value(self):
+        if self.peek() == '':
+            raise self.error('Expecting value')
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError as error:
+                if self.truncated(error) and self.fill(max(self.buffer_size, len(self.buffer) - self.pos)):
+                    continue
+                raise
+            # A number running to the end of the buffer may continue in the next one
+            if self.number_tail.match(self.buffer, end) and not isinstance(value, (str, list, dict)) and self.fill():
+                continue
+            self.pos = end
+            return value
+
+    # True if a decoding error may only be the value running past the end of the buffer: the error is at the end, in
+    # a string, \u escape, number or keyword the buffer ends in. Other syntax errors are raised without reading on.
+    def truncated(self, error):
+        rest = len(self.buffer) - error.pos
+        if rest <= 0 or error.msg.startswith('Unterminated string'):
+            return True
+        if error.msg.startswith('Invalid \\uXXXX escape'):
+            return rest < 5
+        tail = self.buffer[error.pos:]
+        return self.number_tail.match(tail) is not None or any(keyword.startswith(tail) for keyword in self.keywords)
+
+    # Step through the keys of a dict, the value of each key must be read before the next step
+    def items(self):
+        self.expect('{')
+        if self.peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            if self.peek() != '"':
+                raise self.error('Expecting property name enclosed in double quotes')
+            key = self.value()
+            self.expect(':')
+            yield key
+            char = self.peek()
+            self.pos += 1
+            if char == '}':
+                return
+            if char != ',':
+                self.pos -= 1
+                raise self.error("Expecting ',' delimiter")
+
+    # Step through the positions of a list, the entry at each position must be read before the next step
+    def entries(self):
+        self.expect('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+        pos = 0
+        while True:
+            yield pos
+            pos += 1
+            char = self.peek()
+            self.pos += 1
+            if char == ']':
+                return
+            if char != ',':
+                self.pos -= 1
+                raise self.error("Expecting ',' delimiter")
+
+    # Check only whitespace follows the element
+    def end(self):
+        if self.peek() != '':
+            raise self.error('Extra data')
+
+
+# Serialization backends: how GrammarFile loads and dumps a format
+# load(read_file) returns the element, dump(data, write_file) writes it. Binary backends get files opened in binary.
+# The JSON backends with json's layout stream (see Grammar.gen_stream and parse_stream), stream_compact is the layout
+# they stream in, None if they don't stream.
+class FileBackend:
+    def __init__(self, name, is_yaml, load, dump, binary=False, stream_compact=None):
+        self.name = name
+        self.is_yaml = is_yaml
+        self.load = load
+        self.dump = dump
+        self.binary = binary
+        self.stream_compact = stream_compact
+
+
+# The backends by name, see register_backend
+file_backends = {}
+# The backend of each format when a GrammarFile doesn't name one, by is_yaml
+default_backends = {}
+
+
+def register_backend(backend):
+    file_backends[backend.name] = backend
+
+
+def get_backend(name):
+    if name not in file_backends:
+        raise GrammarException('unknown_backend', 'There is no serialization backend ' + name + ', the backends are ' +
+                               ', '.join(file_backends))
+    return file_backends[name]
+
+
+# Make the backend the default for its format
+def set_default_backend(name):
+    backend = get_backend(name)
+    default_backends[backend.is_yaml] = backend
+
+
+# yaml is PyYAML's pure Python loader and dumper, libyaml is its C loader and dumper, when PyYAML was built with libyaml
+# They give the same elements and text.
+# json is json.dump's indent=4 layout, json-compact has no whitespace, and orjson (when it is installed) gives the
+# json-compact layout, without escaping non-ASCII characters
+register_backend(FileBackend('yaml', True, yaml.safe_load, lambda data, write_file: yaml.dump(data, write_file)))
+if yaml.__with_libyaml__:
+    register_backend(FileBackend('libyaml', True, lambda read_file: yaml.load(read_file, Loader=yaml.CSafeLoader),
+                                 lambda data, write_file: yaml.dump(data, write_file, Dumper=yaml.CSafeDumper)))
+register_backend(FileBackend('json', False, json.load, lambda data, write_file: json.dump(data, write_file, indent=4),
+                             stream_compact=False))
+register_backend(FileBackend('json-compact', False, json.load,
+                             lambda data, write_file: json.dump(data, write_file, separators=(',', ':')),
+                             stream_compact=True))
+if orjson is not None:
+    register_backend(FileBackend('orjson', False, lambda read_file: orjson.loads(read_file.read()),
+                                 lambda data, write_file: write_file.write(orjson.dumps(data)), binary=True))
+set_default_backend('libyaml' if 'libyaml' in file_backends else 'yaml')
+set_default_backend('json')
+
+
+# Files are json or yaml, optionally compressed with one of the compression_modules (by file extension)
+# A GrammarFile can also be:
+#   '-', stdin when loading and stdout when saving
+#   an open file object (file=), which is left open
+#   an in-memory buffer, without a filename or file. save() fills it, getvalue() returns its text (or bytes, for
+#   binary backends), and load() reads it back. text= starts it with some text
+# These have no extension, so is_yaml gives their format.
 class GrammarFile:
-    def __init__(self, filename=None, is_yaml=None):
-        if filename is None:
+    compression_modules = {'.gz': 'gzip', '.xz': 'lzma', '.bz2': 'bz2'}
+
+    def __init__(self, filename=None, is_yaml=None, backend=None, file=None, text=None):
+        self.filename = filename
+        self.file = file
+        self.compression = None
+        if filename is None or filename == '-':
             if is_yaml is None:
                 raise GrammarException('must specify filename or is_yaml')
             self.is_yaml = is_yaml
-            self.filename = None
         else:
-            self.filename = filename
-            if re.search(r'\.yaml$', filename):
-                self.is_yaml = True
-            elif re.search(r'\.json$', filename):
-                self.is_yaml = False
-            else:
+            match = re.search(r'\.(yaml|json)(\.gz|\.xz|\.bz2)?$', filename)
+            if match is None:
                 raise GrammarException('File is not json or yaml: ' + filename)
+            self.is_yaml = match.group(1) == 'yaml'
+            self.compression = match.group(2)
+        if backend is None:
+            self.backend = default_backends[self.is_yaml]
+        else:
+            self.backend = get_backend(backend)
+            if self.backend.is_yaml != self.is_yaml:
+                raise GrammarException('backend_format_mismatch', 'The backend ' + backend + ' can not be used for ' +
+                                       ('yaml' if self.is_yaml else 'json'))
+        # The in-memory buffer's contents
+        self.text = text
+
+    # Whether the file is a named file on disk
+    def on_disk(self):
+        return self.filename is not None and self.filename != '-'
+
+    def getvalue(self):
+        return self.text
+
+    # Compressed files (like backup.json.gz) are read and written through the compression module, as they stream
+    # Files that are already open are used as they are, or wrapped when they are binary and the backend isn't
+    # filename overrides the file's name on disk
+    @contextlib.contextmanager
+    def open(self, mode, filename=None):
+        if self.on_disk():
+            filename = filename or self.filename
+            if self.compression is None:
+                opened = open(filename, mode + ('b' if self.backend.binary else ''))
+            else:
+                compression_module = importlib.import_module(self.compression_modules[self.compression])
+                opened = compression_module.open(filename, mode + ('b' if self.backend.binary else 't'))
+            with opened as opened_file:
+                yield opened_file
+        elif self.filename is None and self.file is None:
+            buffer_class = io.BytesIO if self.backend.binary else io.StringIO
+            if mode == 'w':
+                buffer = buffer_class()
+                yield buffer
+                self.text = buffer.getvalue()
+            else:
+                if self.text is None:
+                    raise GrammarException('empty_buffer', 'The in-memory file was read before anything was saved')
+                yield buffer_class(self.text)
+        else:
+            open_file = self.file
+            if open_file is None:
+                open_file = sys.stdin if mode == 'r' else sys.stdout
+            binary = isinstance(open_file, (io.RawIOBase, io.BufferedIOBase))
+            if binary and not self.backend.binary:
+                open_file = io.TextIOWrapper(open_file, encoding='utf-8')
+            elif not binary and self.backend.binary:
+                if not hasattr(open_file, 'buffer'):
+                    raise GrammarException('file_not_binary', 'The backend ' + self.backend.name +
+                                           ' needs a binary file')
+                open_file.flush()
+                open_file = open_file.buffer
+            try:
+                yield open_file
+                if mode == 'w':
+                    open_file.flush()
+            finally:
+                if binary and not self.backend.binary:
+                    # The wrapper would close the file
+                    open_file.detach()
 
     def save(self, data):
-        if self.filename is not None:
-            with open(self.filename, "w") as write_file:
-                if self.is_yaml:
-                    yaml.dump(data, write_file)
-                else:
-                    json.dump(data, write_file, indent=4)
+        with self.open("w") as write_file:
+            self.backend.dump(data, write_file)
+
+    # Save the element the grammar gens from the model, JSON is streamed as it is genned (see Grammar.gen_stream)
+    def save_model(self, grammar, model):
+        if self.backend.stream_compact is None:
+            self.save(grammar.gen_config(model))
         else:
-            raise GrammarException('Not implemented')
+            if not self.on_disk():
+                with self.open("w") as write_file:
+                    grammar.gen_stream(model, write_file, self.backend.stream_compact)
+                return
+            # The file is streamed to a temporary file next to it, which replaces it once genning succeeds, so an error
+            # leaves the existing file as it was. The replaced file's permissions are kept.
+            temp_filename = self.filename + '.' + str(os.getpid()) + '.tmp'
+            try:
+                with self.open("w", temp_filename) as write_file:
+                    grammar.gen_stream(model, write_file, self.backend.stream_compact)
+                if os.path.exists(self.filename):
+                    shutil.copymode(self.filename, temp_filename)
+                os.replace(temp_filename, self.filename)
+            except BaseException:
+                try:
+                    os.remove(temp_filename)
+                except FileNotFoundError:
+                    pass
+                raise
+
+    # Load the file and parse it with the grammar, JSON is parsed as it is read (see Grammar.parse_stream)
+    # With a ModelCache, a file already parsed by the same grammar is loaded from the cache instead. Only files on disk
+    # and in-memory buffers are cached, as stdin and open files can only be read once.
+    def load_model(self, grammar, list_names=None, cache=None):
+        if cache is not None and self.file is None and self.filename != '-':
+            key = cache.key(self.contents(), grammar)
+            found, model = cache.get(key)
+            if not found:
+                model = self.load_model(grammar, list_names)
+                cache.put(key, model)
+            elif grammar.intern_vars is not None and model is not None:
+                model = InternTable(grammar.intern_vars).intern(model)[0]
+            return model
+        if self.backend.stream_compact is None:
+            return grammar.parse_config(self.load())
+        with self.open("r") as read_file:
+            return grammar.parse_stream(JsonReader(read_file), list_names)
+
+    # The bytes of a file on disk (as stored, so still compressed) or of an in-memory buffer
+    def contents(self):
+        if self.on_disk():
+            with open(self.filename, 'rb') as read_file:
+                return read_file.read()
+        if self.text is None:
+            raise GrammarException('empty_buffer', 'The in-memory file was read before anything was saved')
+        return self.text.encode() if isinstance(self.text, str) else self.text
 
     def load(self):
-        if self.filename is not None:
-            with open(self.filename, "r") as read_file:
-                if self.is_yaml:
-                    result = yaml.safe_load(read_file)
-                else:
-                    result = json.load(read_file)
-        else:
-            raise GrammarException('Not implemented')
+        with self.open("r") as read_file:
+            result = self.backend.load(read_file)
         if result is None:
             result = {}
         return result
+
+
+# A cache of parsed models on disk, see GrammarFile.load_model
+# A model is stored under the hash of the file's bytes, the grammar's fingerprint (see Grammar.fingerprint), whether it
+# interns, and the version, so changing the file, the schema or the version parses the file again. The version is
+# given by the caller, as the schema functions' code isn't part of the fingerprint.
+# Models are pickled and zlib compressed, each in its own file, written atomically so concurrent runs can share the
+# cache. When the cache is over max_size bytes, the least recently used models are removed: a hit updates the file's
+# modification time.
+# Unpickling a file can run any code, so the directory must be private: owned by the user, with no access for the
+# group or others (it is made with mode 700). Otherwise cache_not_private is raised. Systems without owners (Windows)
+# aren't checked.
+# Pickles don't keep frozen models (see GrammarModel), so GrammarFile.load_model interns a cached model again.
+class ModelCache:
+    suffix = '.model'
+
+    def __init__(self, directory, max_size=256 * 1024 * 1024, version=''):
+        self.directory = directory
+        self.max_size = max_size
+        self.version = version
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        self.check_private()
+
+    def check_private(self):
+        if not hasattr(os, 'getuid'):
+            return
+        stat = os.stat(self.directory)
+        if stat.st_uid != os.getuid() or stat.st_mode & 0o077:
+            raise GrammarException('cache_not_private', 'The cache directory ' + self.directory + ' must be owned by ' +
+                                   'you, with no access for others (mode 700)')
+
+    def key(self, contents, grammar):
+        digest = hashlib.sha256(contents)
+        digest.update(repr((grammar.fingerprint(), grammar.intern_vars is not None, self.version)).encode())
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + self.suffix)
+
+    # Returns (True, model) for a cached model, or (False, None)
+    # A model that can't be read (from another Python, or a damaged file) is removed, and parsed again
+    def get(self, key):
+        path = self.path(key)
+        try:
+            with open(path, 'rb') as cache_file:
+                model = pickle.loads(zlib.decompress(cache_file.read()))
+            os.utime(path)
+        except FileNotFoundError:
+            return False, None
+        except Exception:
+            self.remove(path)
+            return False, None
+        return True, model
+
+    def put(self, key, model):
+        data = zlib.compress(pickle.dumps(model, pickle.HIGHEST_PROTOCOL), 1)
+        path = self.path(key)
+        temp_path = path + '.' + str(os.getpid()) + '.tmp'
+        with open(temp_path, 'wb') as cache_file:
+            cache_file.write(data)
+        os.replace(temp_path, path)
+        self.evict()
+
+    @staticmethod
+    def remove(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    # Remove the least recently used models until the cache fits in max_size
+    def evict(self):
+        entries = []
+        total = 0
+        with os.scandir(self.directory) as scan:
+            for entry in scan:
+                if entry.name.endswith(self.suffix):
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    entries.append((stat.st_mtime, entry.path, stat.st_size))
+                    total += stat.st_size
+        entries.sort()
+        for _, path, size in entries:
+            if total <= self.max_size:
+                break
+            self.remove(path)
+            total -= size
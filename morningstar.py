@@ -11,18 +11,52 @@
 # are not required
 
 import argparse
+import sys
 import grammar as jg
-import backup_grammar
-import intuitive_grammar
-import simple_grammar
-import simple_model
 from IntuitiveException import IntuitiveException
 
+
+# The grammars are only built when an operation uses them, and their schema modules are only imported then
+# A run is short, so importing the modules and building the schemas is a large part of it
+def make_grammar(grammar_name):
+    if grammar_name == 'Backup':
+        import backup_grammar
+        return jg.Grammar(backup_grammar.backup_schema).compile()
+    if grammar_name == 'Simple':
+        import simple_grammar
+        return jg.Grammar(simple_grammar.simple_schema, minimal=True).compile()
+    import intuitive_grammar
+    return jg.Grammar(intuitive_grammar.intuitive_schema, minimal=True).compile()
+
+
+grammar_objs = {}
+profile_grammars = False
+# Set by --jobs, the number of processes the banks of the backup and simple grammars are parsed and genned by
+parallel_jobs = None
+
+
+def get_grammar(grammar_name):
+    if grammar_name not in grammar_objs:
+        grammar_objs[grammar_name] = make_grammar(grammar_name)
+        if profile_grammars:
+            grammar_objs[grammar_name].enable_profiling()
+        if parallel_jobs is not None and grammar_name != 'Intuitive':
+            grammar_objs[grammar_name].use_parallel_lists(['Bank List'], parallel_jobs)
+    return grammar_objs[grammar_name]
+
+
 # Operations:
 # Convert an intuitive file to a backup file --intuitive-to-backup -i
 # Convert an intuitive file to a simple file --intuitive-to-simple -I
 # Convert a simple file to a backup file     --simple-to-backup    -s
 # Convert a backup file to a simple file     --backup-to-simple    -b
+# Only check the source file is valid        --check               -c
+#   The source is an intuitive file, unless -b (backup) or -s (simple) is given
+# Profile the grammars by schema node        --profile-grammar
+# Parse and gen the banks in N processes     --jobs N
+# Read and write a format with a backend     --backend NAME (yaml, libyaml, json, json-compact, orjson)
+# The source and destination can be '-', for stdin and stdout, so conversions can be piped
+# Cache the parsed source files in DIR         --cache DIR [--cache-size MB]
 if __name__ == '__main__':
     desc = "Morningstar Configuration Management. Convert various file formats"
     parser = argparse.ArgumentParser(description=desc)
@@ -34,9 +68,30 @@ if __name__ == '__main__':
                         help='Convert a config file to an backup file')
     parser.add_argument('--intuitive-to-simple', '-I', action='store_true',
                         help='Convert a config file to an backup file')
-    parser.add_argument('source', help='The source config')
-    parser.add_argument('dest', help='The destination config')
+    parser.add_argument('--check', '-c', action='store_true',
+                        help='Only check the source config is valid, without converting it')
+    parser.add_argument('--profile-grammar', action='store_true',
+                        help='Print where the grammars spent their time, by schema node')
+    parser.add_argument('--jobs', '-j', type=int,
+                        help='Parse and generate the banks in this many processes')
+    parser.add_argument('--backend', action='append', choices=list(jg.file_backends),
+                        help='Read and write the files of its format with this serialization backend')
+    parser.add_argument('--cache', help='Cache the parsed source files in this directory')
+    parser.add_argument('--cache-size', type=int, default=256,
+                        help='The megabytes the cache may use before the least recently used files are removed')
+    parser.add_argument('source', help="The source config, '-' for stdin")
+    parser.add_argument('dest', nargs='?', help="The destination config, '-' for stdout")
     args = parser.parse_args()
+    if args.dest is None and not args.check:
+        parser.error('the destination config is required')
+    profile_grammars = args.profile_grammar
+    parallel_jobs = args.jobs
+    for backend_name in args.backend or []:
+        jg.set_default_backend(backend_name)
+    model_cache = None
+    if args.cache is not None:
+        from version import intuitive_version
+        model_cache = jg.ModelCache(args.cache, args.cache_size * 1024 * 1024, intuitive_version)
 
     flags = 0
     if args.backup_to_simple:
@@ -48,43 +103,65 @@ if __name__ == '__main__':
     if args.intuitive_to_simple:
         flags += 1
     if flags > 1:
-        print("Error: At most one of -b, -i, or -c must be specified")
+        print("Error: At most one of -b, -s, -i, or -I must be specified")
         exit(1)
 
-    backup_grammar_obj = jg.Grammar(backup_grammar.backup_schema)
-    simple_grammar_obj = jg.Grammar(simple_grammar.simple_schema, minimal=True)
-    intuitive_grammar_obj = jg.Grammar(intuitive_grammar.intuitive_schema, minimal=True)
-
-    source_file = jg.GrammarFile(args.source)
-    dest_file = jg.GrammarFile(args.dest)
+    # '-' is stdin or stdout, in the format of the operation: backups are json, simple and intuitive files are yaml
+    source_file = jg.GrammarFile(args.source, is_yaml=not args.backup_to_simple)
+    dest_file = None
+    if args.dest is not None:
+        dest_file = jg.GrammarFile(args.dest, is_yaml=args.backup_to_simple or args.intuitive_to_simple)
+    # Errors go to stderr when the destination is stdout
+    error_file = sys.stderr if args.dest == '-' else sys.stdout
 
     try:
-        if args.backup_to_simple:
-            backup_model = backup_grammar_obj.parse_config(source_file.load())
+        if args.check:
+            if args.backup_to_simple:
+                get_grammar('Backup').validate(source_file.load())
+            elif args.simple_to_backup:
+                get_grammar('Simple').validate(source_file.load())
+            else:
+                get_grammar('Intuitive').validate(source_file.load())
+        elif args.backup_to_simple:
+            backup_model = source_file.load_model(get_grammar('Backup'), cache=model_cache)
 
+            # simple_model can't be imported before simple_grammar, which imports it
+            simple_grammar_obj = get_grammar('Simple')
+            import simple_model
             simple_model_obj = simple_model.Simple()
             simple_model_obj.from_backup(backup_model)
 
-            dest_file.save(simple_grammar_obj.gen_config(simple_model_obj))
+            dest_file.save_model(simple_grammar_obj, simple_model_obj)
         elif args.simple_to_backup:
-            simple_model_obj = simple_grammar_obj.parse_config(source_file.load())
+            simple_model_obj = source_file.load_model(get_grammar('Simple'), cache=model_cache)
 
             backup_model = simple_model_obj.to_backup()
 
-            dest_file.save(backup_grammar_obj.gen_config(backup_model))
+            dest_file.save_model(get_grammar('Backup'), backup_model)
         else:  # args.intuitive_to_backup or args.intuitive_to_simple:
-            intuitive_model_obj = intuitive_grammar_obj.parse_config(source_file.load())
-            simple_model = intuitive_model_obj.to_simple()
+            intuitive_model_obj = source_file.load_model(get_grammar('Intuitive'), cache=model_cache)
+            simple_model_obj = intuitive_model_obj.to_simple()
             if args.intuitive_to_simple:
-                dest_file.save(simple_grammar_obj.gen_config(simple_model))
+                dest_file.save_model(get_grammar('Simple'), simple_model_obj)
             else:
-                backup_model = simple_model.to_backup()
-                dest_file.save(backup_grammar_obj.gen_config(backup_model))
+                backup_model = simple_model_obj.to_backup()
+                dest_file.save_model(get_grammar('Backup'), backup_model)
     except jg.GrammarException as e:
-        print("ERROR\n")
-        print(e.args[1])
+        print("ERROR\n", file=error_file)
+        print(e.args[1], file=error_file)
         exit(1)
     except IntuitiveException as e:
-        print("ERROR\n")
-        print(e.args[1])
+        print("ERROR\n", file=error_file)
+        print(e.args[1], file=error_file)
         exit(1)
+    finally:
+        # Shut down the --jobs process pools
+        for grammar_obj in grammar_objs.values():
+            grammar_obj.close()
+
+    # The profile goes to stderr, so it doesn't mix with a destination on stdout
+    if args.profile_grammar:
+        for grammar_name, grammar_obj in grammar_objs.items():
+            if grammar_obj.profile.nodes:
+                print(grammar_name + ' grammar profile:', file=sys.stderr)
+                print(grammar_obj.profile.report(30), file=sys.stderr)
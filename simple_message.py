@@ -1,5 +1,3 @@
-import copy
-
 import grammar as jg
 import PCCC_message
 import bank_jump_message
@@ -1748,13 +1746,7 @@ class SimpleMessage(jg.GrammarModel):
         result.specific_message = TogglePageModel().mk_toggle_page_message(page_up)
         return message_catalog.add(result)
 
-    def __init__(self):
-        super().__init__('SimpleMessage')
-        self.name = None
-        self.specific_message = None
-        self.type = None
-        self.trigger = None
-        self.toggle_state = None
+    __slots__ = ('name', 'specific_message', 'type', 'trigger', 'toggle_state')
 
     def __eq__(self, other):
         result = isinstance(other, SimpleMessage) and self.type == other.type
@@ -2053,17 +2045,21 @@ transition_message_case_keys = {
 #     return case_keys
 #
 def make_message_case_keys():
-    case_keys = copy.deepcopy(transition_message_case_keys)
+    case_keys = dict(transition_message_case_keys)
     for message_type in SimpleMessage.to_bank_classes:
         case_keys[message_type] = SimpleMessage.to_bank_classes[message_type].get_case_keys()
     return case_keys
 
 
+# Schema keys are frozen, so the message schemas share one set of case keys and their nodes
+message_case_keys = make_message_case_keys()
+
+
 def mk_message_schema(common_keys=None):
     if common_keys is None:
         common_keys = simple_common_keys
     return jg.SwitchDict('message_schema', message_switch_key,
-                         make_message_case_keys(), common_keys,
+                         message_case_keys, common_keys,
                          model=SimpleMessage, model_var='specific_message')
 
 
@@ -61,23 +61,9 @@ class SimplePreset(jg.GrammarModel):
         result.messages = messages
         return result
 
-    def __init__(self):
-        super().__init__('SimplePreset')
-        self.short_name = None
-        self.long_name = None
-        self.toggle_name = None
-        self.message_scroll = None
-        self.text = None
-        self.text_toggle = None
-        self.text_shift = None
-        self.background = None
-        self.background_toggle = None
-        self.background_shift = None
-        self.strip_color = None
-        self.strip_toggle_color = None
-        self.toggle_mode = None
-        self.toggle_group = None
-        self.messages = None
+    __slots__ = ('short_name', 'long_name', 'toggle_name', 'message_scroll', 'text', 'text_toggle', 'text_shift',
+                 'background', 'background_toggle', 'background_shift', 'strip_color', 'strip_toggle_color',
+                 'toggle_mode', 'toggle_group', 'messages')
 
     def __eq__(self, other):
         result = (isinstance(other, SimplePreset) and self.short_name == other.short_name and
@@ -118,7 +104,7 @@ class SimplePreset(jg.GrammarModel):
         self.toggle_mode = backup_preset.to_toggle
         if backup_preset.messages is not None:
             self.messages = [None] * 32
-            for pos, backup_message in enumerate(backup_preset.messages):
+            for pos, backup_message in jg.populated(backup_preset.messages):
                 if backup_message is not None:
                     self.messages[pos] = sm.SimpleMessage()
                     self.messages[pos].from_backup(backup_message, backup_bank, bank_catalog,
@@ -197,7 +183,7 @@ class SimpleBank(jg.GrammarModel):
         self.clear_toggle = backup_bank.clear_toggle
         if backup_bank.messages is not None:
             self.messages = [None] * 32
-            for pos, backup_message in enumerate(backup_bank.messages):
+            for pos, backup_message in jg.populated(backup_bank.messages):
                 if backup_message is not None:
                     self.messages[pos] = sm.SimpleMessage()
                     if backup_message.trigger != 1:
@@ -207,14 +193,14 @@ class SimpleBank(jg.GrammarModel):
             jg.prune_list(self.messages)
         if backup_bank.presets is not None:
             self.presets = [None] * 24
-            for pos, backup_preset in enumerate(backup_bank.presets):
+            for pos, backup_preset in jg.populated(backup_bank.presets):
                 if backup_preset is not None:
                     self.presets[pos] = SimplePreset()
                     self.presets[pos].from_backup(backup_preset, backup_bank, bank_catalog)
             jg.prune_list(self.presets)
         if backup_bank.exp_presets is not None:
             self.exp_presets = [None] * 4
-            for pos, backup_preset in enumerate(backup_bank.exp_presets):
+            for pos, backup_preset in jg.populated(backup_bank.exp_presets):
                 if backup_preset is not None:
                     self.exp_presets[pos] = SimplePreset()
                     self.exp_presets[pos].from_backup(backup_preset, backup_bank, bank_catalog)
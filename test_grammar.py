@@ -1,7 +1,16 @@
 import copy
+import io
+import json
+import os
+import pickle
+import sys
+import tempfile
 import unittest
 
 import backup_grammar
+import backup_model
+import benchmark_grammar
+import intuitive_grammar
 import simple_grammar
 from version import intuitive_version
 import grammar as jg
@@ -93,6 +102,115 @@ def make_common_switch():
     return test_switch
 
 
+# A switch dict with a model for each case, the case model is bound to switched_model
+def make_model_switch():
+    switch_key = jg.SwitchDict.make_key('switcher', jg.Enum('enum', ['a', 'b'], 'a', var='switch_key'))
+    case_keys = {'a': [SwitchAModel, jg.SwitchDict.make_key('a1', jg.Atom('atom', int, var='a1')),
+                       jg.SwitchDict.make_key('a2', jg.Atom('atom', int, var='a2'))],
+                 'b': [SwitchBModel, jg.SwitchDict.make_key('b1', jg.Atom('atom', int, var='b1')),
+                       jg.SwitchDict.make_key('b2', jg.Atom('atom', int, var='b2'))]}
+    common_keys = [jg.SwitchDict.make_key('x', jg.Atom('atom x', int, var='x')),
+                   jg.SwitchDict.make_key('y', jg.Atom('atom y', int, var='y'))]
+    return jg.SwitchDict('switch', switch_key, case_keys, common_keys, model_var='switched_model',
+                         model=SwitchBaseModel)
+
+
+# The models for a list of make_model_switch, alternating between the cases
+def make_switch_models(length):
+    models = []
+    for pos in range(length):
+        model = SwitchBaseModel()
+        if pos % 2 == 0:
+            model.switch_key = 'a'
+            model.switched_model = SwitchAModel()
+            model.switched_model.a1 = pos
+            model.switched_model.a2 = 127
+        else:
+            model.switch_key = 'b'
+            model.switched_model = SwitchBModel()
+            model.switched_model.b1 = pos
+            model.switched_model.b2 = 127
+        model.x = pos
+        model.y = 0
+        models.append(model)
+    return models
+
+
+# Slotted models and their schema for the model and list tests: a list of entries, each with a name and a list of
+# items. Only entries 0 and 5 are set, the rest is default.
+class ItemForTests(jg.GrammarModel):
+    __slots__ = ('value', 'data')
+
+    def __eq__(self, other):
+        return isinstance(other, ItemForTests) and self.value == other.value and self.data == other.data
+
+
+class EntryForTests(jg.GrammarModel):
+    __slots__ = ('name', 'items')
+
+    def __eq__(self, other):
+        return isinstance(other, EntryForTests) and self.name == other.name and self.items == other.items
+
+
+item_schema = jg.Dict('Item', [jg.Dict.make_key('itemNum', jg.identity_atom),
+                               jg.Dict.make_key('value', jg.Atom('Value', int, 0, var='value')),
+                               jg.Dict.make_key('data', jg.List('Data List', 3, jg.Atom('Data', int, 0), var='data'))],
+                      model=ItemForTests)
+entry_schema = jg.Dict('Entry', [jg.Dict.make_key('entryNum', jg.identity_atom),
+                                 jg.Dict.make_key('name', jg.Atom('Name', str, '', var='name')),
+                                 jg.Dict.make_key('items', jg.List('Item List', 4, item_schema, var='items'))],
+                       model=EntryForTests)
+entry_list_schema = jg.List('Entry List', 8, entry_schema)
+
+
+# An item whose check key is its value plus 1, read from the enclosing dict (the context)
+# A minimal grammar gens the default value as None
+def value_plus_1(_elem, context, _list_pos):
+    return (context['value'] or 0) + 1
+
+
+context_item_schema = jg.Dict('Context Item', [jg.Dict.make_key('value', jg.Atom('Value', int, 0, var='value')),
+                                               jg.Dict.make_key('check', jg.Atom('Check', int, value=value_plus_1))],
+                              model=ItemForTests)
+context_list_schema = jg.List('Context List', 3, context_item_schema)
+
+
+def make_item(value, data):
+    item = ItemForTests()
+    item.value = value
+    item.data = data
+    return item
+
+
+# The grammar on each engine: interpreted, compiled and stack
+def make_grammars(schema, minimal=False):
+    return [jg.Grammar(schema, minimal), jg.Grammar(schema, minimal).compile(),
+            jg.Grammar(schema, minimal).use_stack_engine()]
+
+
+def make_entries():
+    entries = [None] * 8
+    for pos in [0, 5]:
+        entry = EntryForTests()
+        entry.name = 'E' + str(pos)
+        entry.items = [make_item(pos + 1, [pos, None, None]), None, None, None]
+        entries[pos] = entry
+    return entries
+
+
+# A backup with one preset in one bank, the rest is default. The download date is set, as it is genned from the clock.
+def make_backup():
+    backup = backup_model.Backup()
+    backup.download_date = '2024-01-01T00:00:00'
+    bank = backup_model.Bank()
+    bank.name = 'Bank 2'
+    preset = backup_model.Preset()
+    preset.short_name = 'P'
+    bank.set_preset(preset, 3)
+    backup.set_bank(bank, 2)
+    return backup
+
+
 # Test the list pruning, compacting
 # Pruning should only remove empty elements at the end, not the middle
 class ListTestCases(unittest.TestCase):
@@ -167,6 +285,46 @@ class ModelTestCases(unittest.TestCase):
         self.assertEqual(obj.x, 2)
         self.assertEqual(obj.get_var('x'), 2)
 
+    def test_slots(self):
+        slotted_class = jg.make_model_class('SlottedForTests', ['x', 'y'])
+        obj = slotted_class()
+        self.assertFalse(hasattr(obj, '__dict__'))
+        self.assertEqual(obj.model_name, 'SlottedForTests')
+        self.assertEqual(slotted_class.model_fields, {'x', 'y'})
+        self.assertIsNone(obj.x)
+        self.assertTrue(obj.has_var('y'))
+        self.assertFalse(obj.has_var('z'))
+        obj.set_var('x', 2, 'error message')
+        self.assertTrue(obj.modified)
+        self.assertEqual(obj.get_var('x'), 2)
+        with self.assertRaises(jg.GrammarException) as context:
+            obj.set_var('x', 3, 'error message')
+        self.assertEqual(context.exception.args[0], 'multiply_assigned_var')
+        with self.assertRaises(jg.GrammarException) as context:
+            obj.set_var('z', 3, 'error message')
+        self.assertEqual(context.exception.args[0], 'model_missing_var')
+        with self.assertRaises(jg.GrammarException) as context:
+            obj.get_var('z')
+        self.assertEqual(context.exception.args[0], 'model_missing_var')
+
+        # Slotted and unslotted models gen and parse the same
+        schema = jg.Dict('Dict', [jg.Dict.make_key('x', jg.Atom('X', int, 0, var='x'))], model=slotted_class)
+        grammar = jg.Grammar(schema)
+        model = grammar.parse_config({'x': 5})
+        self.assertIsInstance(model, slotted_class)
+        self.assertEqual(model.x, 5)
+        self.assertEqual(grammar.gen_config(model), {'x': 5})
+
+    # The backup models declare every variable the backup schema binds
+    def test_model_vars(self):
+        model_vars = jg.Grammar(backup_grammar.backup_schema).model_vars()
+        self.assertIn(backup_grammar.backup_model.MidiMessage, model_vars)
+        for model_class, variables in model_vars.items():
+            self.assertIsNotNone(model_class.model_fields)
+            self.assertLessEqual(variables, model_class.model_fields)
+        switch_vars = jg.Grammar(im.simple_preset_message_schema).model_vars()
+        self.assertIn('specific_message', switch_vars[im.SimpleMessage])
+
 
 # Test the structure of the various grammar elements
 # These are brittle, not the best
@@ -187,7 +345,7 @@ class JsonGrammarElementStructureTestCase(unittest.TestCase):
 
     def validate_dict(self, node, name, keys, var, model, cleanup):
         self.assertEqual(name, node.name)
-        self.assertEqual(keys, node.keys)
+        self.assertEqual(tuple(keys), node.keys)
         self.validate_keywords(node, var, model, cleanup)
 
     # Test dict structure, include variable, model and both and none
@@ -207,8 +365,8 @@ class JsonGrammarElementStructureTestCase(unittest.TestCase):
     def validate_switch_dict(self, node, name, switch_key, case_keys, common_keys, var, model, cleanup):
         self.assertEqual(name, node.name)
         self.assertEqual(switch_key, node.switch_key)
-        self.assertEqual(case_keys, node.case_keys)
-        self.assertEqual(common_keys, node.common_keys)
+        self.assertEqual({case_key: tuple(keys) for case_key, keys in case_keys.items()}, node.case_keys)
+        self.assertEqual(tuple(common_keys), node.common_keys)
         self.validate_keywords(node, var, model, cleanup)
 
     def test_switch_dict(self):
@@ -293,7 +451,16 @@ class JsonGrammarElementStructureTestCase(unittest.TestCase):
                           'c': [SwitchCModel, jg.SwitchDict.make_key('c1', jg.Atom('atom', int, 1)),
                                 jg.SwitchDict.make_key('c2', jg.Atom('atom', int, 2)),
                                 jg.SwitchDict.make_key('c3', jg.Atom('atom', int, 3))]}
-        self.assertIsNotNone(jg.SwitchDict('test', test_switch_key, test_case_keys, model_var='x'))
+        test_switch = jg.SwitchDict('test', test_switch_key, test_case_keys, model_var='x')
+        self.assertEqual(((), tuple(test_switch.case_keys['b'])), test_switch.parse_case_keys['b'])
+
+    # The merged keys for each case, in parse and gen order
+    def test_switch_dict_case_keys(self):
+        test_switch = make_common_switch()
+        a1, a2 = test_switch.case_keys['a']
+        c1, c2 = test_switch.common_keys
+        self.assertEqual(((c1, c2, a1, a2), ()), test_switch.parse_case_keys['a'])
+        self.assertEqual(((a1, a2, c1, c2), ()), test_switch.gen_case_keys['a'])
 
     def validate_list(self, node, length, schema, var, model, cleanup):
         self.assertEqual(length, node.length)
@@ -319,6 +486,7 @@ class JsonGrammarElementStructureTestCase(unittest.TestCase):
         with self.assertRaises(jg.GrammarException) as context:
             jg.Enum('enum', enum_base, "four")
         self.assertEqual('bad_enum_value', context.exception.args[0])
+        self.assertEqual({"one": 0, "two": 1, "three": 2}, jg.Enum('enum', enum_base, "two").ordinals)
 
     # Test atom structure
     # Test that default and value both specified is an error
@@ -481,6 +649,21 @@ class JsonGrammarParserTestCase(JsonGrammarBaseTestCase):
         list_schema = jg.List('list', 3, jg.Atom('atom', int, 1, var='x'), model=ObjectForTests)
         self.run_grammar_parse_error(list_schema, [1, 2, 3], 'multiply_assigned_var')
 
+    # The debugging trail is only built into the message when an error is raised
+    # The shared list position is left as it was after a parse or gen
+    def test_path_and_list_pos(self):
+        list_schema = jg.List('list', 2, jg.Dict('inner', [jg.Dict.make_key('a', jg.Atom('atom', int, value=0))]))
+        with self.assertRaises(jg.GrammarException) as context:
+            complete_conf.parse([{'a': 0}, {'a': 1}], list_schema, 'foo', None, [], None)
+        self.assertEqual('atom_wrong_value', context.exception.args[0])
+        self.assertTrue(context.exception.args[1].endswith(' in foo:list:inner:a:atom'))
+
+        list_pos = [3]
+        self.assertIsNone(complete_conf.parse([{'a': 0}, {'a': 0}], list_schema, 'foo', None, list_pos, None))
+        self.assertEqual([3], list_pos)
+        self.assertEqual([{'a': 0}, {'a': 0}], complete_conf.gen(None, list_schema, None, list_pos))
+        self.assertEqual([3], list_pos)
+
 
 class JsonGrammarGenTestCase(JsonGrammarBaseTestCase):
     def test_elem(self):
@@ -1217,5 +1400,1085 @@ class JsonGrammarPrintTestCase(unittest.TestCase):
         self.assertTrue(isinstance(result, str))
 
 
+# Dicts genned without a model are stamped out from templates in complete grammars
+class GenTemplateTestCase(unittest.TestCase):
+    def setUp(self):
+        inner_schema = jg.Dict('inner entry', [jg.Dict.make_key('i', jg.identity_atom),
+                                               jg.Dict.make_key('o', jg.identity2_atom),
+                                               jg.Dict.make_key('z', jg.zero_atom)])
+        self.entry_schema = jg.Dict('entry', [jg.Dict.make_key('n', jg.identity_atom),
+                                              jg.Dict.make_key('p', jg.Atom('p', int, value=jg.identity_plus_1)),
+                                              jg.Dict.make_key('l', jg.List('inner', 2, inner_schema))])
+        self.schema = jg.List('outer', 3, self.entry_schema)
+
+    @staticmethod
+    def expected(length):
+        return [{'n': n, 'p': n + 1, 'l': [{'i': i, 'o': n, 'z': 0} for i in range(2)]} for n in range(length)]
+
+    def test_template(self):
+        grammar = jg.Grammar(self.schema)
+        result = grammar.gen(None, self.schema, None, [])
+        self.assertEqual(self.expected(3), result)
+        self.assertIsNotNone(grammar.templates[(self.entry_schema, 1)])
+        # Each stamp is a separate copy
+        self.assertIsNot(result[0]['l'], result[1]['l'])
+        self.assertEqual(result, grammar.gen(None, self.schema, None, []))
+        self.assertEqual(result, jg.Grammar(self.schema).compile().gen_config(None))
+
+    def test_not_templatable(self):
+        schema = jg.List('outer', 2, jg.Dict('entry', [jg.Dict.make_key('n', jg.Atom('n', int, lambda e, c, lp: 5))]))
+        grammar = jg.Grammar(schema)
+        self.assertEqual([{'n': 5}, {'n': 5}], grammar.gen(None, schema, None, []))
+        self.assertIsNone(grammar.templates[(schema.schema, 1)])
+
+        # Minimal grammars don't use templates
+        grammar = jg.Grammar(self.schema, True)
+        self.assertEqual(self.expected(3), grammar.gen(None, self.schema, None, []))
+        self.assertEqual({}, grammar.templates)
+
+    def test_fast_accept(self):
+        entry_schema = jg.Dict('entry', [jg.Dict.make_key('n', jg.identity_atom),
+                                         jg.Dict.make_key('b', jg.Atom('b', bool, False))])
+        schema = jg.List('outer', 2, entry_schema)
+        default = [{'n': 0, 'b': False}, {'n': 1, 'b': False}]
+        for grammar in [jg.Grammar(schema), jg.Grammar(schema).compile(), jg.Grammar(schema).use_stack_engine()]:
+            self.assertTrue(grammar.is_default(entry_schema, {'n': 1, 'b': False}, [1]))
+            self.assertFalse(grammar.is_default(entry_schema, {'n': 0, 'b': False}, [1]))
+            self.assertIsNone(grammar.parse_config(copy.deepcopy(default)))
+            # A 0 compares equal to False, but isn't a bool
+            with self.assertRaises(jg.GrammarException) as context:
+                grammar.parse_config([{'n': 0, 'b': 0}, {'n': 1, 'b': False}])
+            self.assertEqual('atom_wrong_type', context.exception.args[0])
+            # Nor is 1.0 an int
+            self.assertFalse(grammar.is_default(entry_schema, {'n': 1.0, 'b': False}, [1]))
+            with self.assertRaises(jg.GrammarException) as context:
+                grammar.parse_config([{'n': 0, 'b': False}, {'n': 1.0, 'b': False}])
+            self.assertEqual('atom_wrong_type', context.exception.args[0])
+            # The keys in another order are still the default
+            self.assertTrue(grammar.is_default(entry_schema, {'b': False, 'n': 1}, [1]))
+            self.assertFalse(grammar.is_default(entry_schema, {'b': False, 'n': 1.0}, [1]))
+            # Not the default, parsed normally
+            self.assertFalse(grammar.is_default(entry_schema, {'n': 0, 'b': True}, [0]))
+            self.assertEqual([{'b': True}, None], grammar.parse_config([{'n': 0, 'b': True}, {'n': 1, 'b': False}]))
+
+    # The genned and the sorted key orders are compared marshalled, any other order entry by entry
+    def test_fast_accept_key_order(self):
+        entry_schema = jg.Dict('entry', [jg.Dict.make_key('n', jg.identity_atom),
+                                         jg.Dict.make_key('b', jg.Atom('b', bool, False)),
+                                         jg.Dict.make_key('m', jg.Atom('m', list, [0, 1]))])
+        grammar = jg.Grammar(jg.List('outer', 2, entry_schema))
+        for elem in [{'n': 1, 'b': False, 'm': [0, 1]}, {'b': False, 'm': [0, 1], 'n': 1},
+                     {'m': [0, 1], 'n': 1, 'b': False}]:
+            self.assertTrue(grammar.is_default(entry_schema, elem, [1]))
+            elem['m'] = [0, 1.0]
+            self.assertFalse(grammar.is_default(entry_schema, elem, [1]))
+
+
+# The compiled grammar must give the same results and raise the same exceptions as the interpreted grammar
+class CompiledGrammarTestCase(unittest.TestCase):
+    @staticmethod
+    def make_grammar(schema, minimal):
+        return jg.Grammar(schema, minimal).compile()
+
+    def make_switch_schema(self):
+        switch_enum = jg.Enum('enum', ['a', 'b', 'c'], 'a', var='switch_key')
+        switch_key = jg.SwitchDict.make_key('switcher', switch_enum)
+        common_keys = [jg.SwitchDict.make_key('x', jg.Atom('atom x', int, 1, var='x')),
+                       jg.SwitchDict.make_key('y', jg.Atom('atom y', int, 2, var='y'))]
+        case_keys = {'a': [SwitchAModel,
+                           jg.SwitchDict.make_key('a1', jg.Atom('atom', int, 1, var='a1')),
+                           jg.SwitchDict.make_key('a2', jg.Atom('atom', int, 2, var='a2'))],
+                     'b': [SwitchBModel,
+                           jg.SwitchDict.make_key('b1', jg.Atom('atom', int, 1, var='b1')),
+                           jg.SwitchDict.make_key('b2', jg.Atom('atom', int, 2, var='b2')),
+                           jg.SwitchDict.make_key('b3', jg.Atom('atom', int, 3))],
+                     'c': [SwitchCModel]}
+        return jg.SwitchDict('test', switch_key, case_keys, common_keys=common_keys,
+                             model_var='switched_model', model=SwitchBaseModel)
+
+    def make_list_schema(self):
+        element = jg.Dict('element', [jg.Dict.make_key('value', jg.Atom('atom', int, value=lambda e, c, lp: lp[-1]))])
+        return jg.List('list', 4, element)
+
+    def check_parse(self, schema, minimal, elem):
+        interpreted = jg.Grammar(schema, minimal)
+        compiled = self.make_grammar(schema, minimal)
+        self.assertEqual(interpreted.parse_config(copy.deepcopy(elem)), compiled.parse_config(copy.deepcopy(elem)))
+
+    def check_parse_error(self, schema, minimal, elem):
+        interpreted = jg.Grammar(schema, minimal)
+        compiled = self.make_grammar(schema, minimal)
+        with self.assertRaises(jg.GrammarException) as interpreted_context:
+            interpreted.parse_config(elem)
+        with self.assertRaises(jg.GrammarException) as compiled_context:
+            compiled.parse_config(elem)
+        self.assertEqual(interpreted_context.exception.args, compiled_context.exception.args)
+
+    def check_gen(self, schema, minimal, model):
+        interpreted = jg.Grammar(schema, minimal)
+        compiled = self.make_grammar(schema, minimal)
+        self.assertEqual(interpreted.gen_config(model), compiled.gen_config(model))
+
+    def test_switch(self):
+        schema = self.make_switch_schema()
+        for minimal in [False, True]:
+            self.check_parse(schema, minimal, {'switcher': 'a', 'a1': 3, 'a2': 4, 'x': 3, 'y': 4})
+            self.check_parse(schema, minimal, {'switcher': 'b', 'b1': 4, 'b2': 2, 'b3': 3, 'x': 5, 'y': 2})
+            self.check_parse(schema, minimal, {'switcher': 'c', 'x': 5, 'y': 2})
+            self.check_parse_error(schema, minimal, {'switcher': 'd', 'x': 5, 'y': 2})
+            self.check_parse_error(schema, minimal, {'switcher': 'c', 'x': 'a', 'y': 2})
+            self.check_parse_error(schema, minimal, {'switcher': 'c', 'x': 5, 'y': 2, 'z': 6})
+            self.check_parse_error(schema, minimal, [])
+
+            model = jg.Grammar(schema, minimal).parse_config({'switcher': 'b', 'b1': 4, 'b2': 2, 'b3': 3,
+                                                              'x': 5, 'y': 2})
+            self.check_gen(schema, minimal, model)
+
+    def test_list(self):
+        schema = self.make_list_schema()
+        for minimal in [False, True]:
+            self.check_parse(schema, minimal, [{'value': 0}, {'value': 1}, {'value': 2}, {'value': 3}])
+            self.check_parse_error(schema, minimal, [{'value': 1}, {'value': 1}, {'value': 2}, {'value': 3}])
+            self.check_parse_error(schema, minimal, {'value': 0})
+            self.check_gen(schema, minimal, None)
+
+    def test_backup(self):
+        simple_grammar_obj = jg.Grammar(simple_grammar.simple_schema, minimal=True)
+        simple_model = simple_grammar_obj.parse_config(jg.GrammarFile('Configs/Test/Demo.yaml').load())
+        backup_model = simple_model.to_backup()
+        backup_model.download_date = '2024-11-16T00:00:00'
+        interpreted = jg.Grammar(backup_grammar.backup_schema)
+        compiled = self.make_grammar(backup_grammar.backup_schema, False)
+        backup = interpreted.gen_config(backup_model)
+        self.assertEqual(backup, compiled.gen_config(backup_model))
+        self.assertEqual(interpreted.parse_config(copy.deepcopy(backup)), compiled.parse_config(backup))
+
+
+# The stack engine must also match the interpreted grammar, and isn't limited by the recursion limit
+class StackEngineTestCase(CompiledGrammarTestCase):
+    @staticmethod
+    def make_grammar(schema, minimal):
+        return jg.Grammar(schema, minimal).use_stack_engine()
+
+    def test_deep_schema(self):
+        schema = jg.Atom('atom', int, 0)
+        elem = 1
+        for _ in range(500):
+            schema = jg.Dict('dict', [jg.Dict.make_key('a', schema)])
+            elem = {'a': elem}
+        grammar = self.make_grammar(schema, True)
+        self.assertEqual(elem, grammar.parse_config(elem))
+        self.assertEqual(elem, grammar.gen_config(elem))
+        with self.assertRaises(RecursionError):
+            jg.Grammar(schema, True).parse_config(elem)
+
+
+# Model for the opaque tests
+class BlobModel(jg.GrammarModel):
+    def __init__(self):
+        super().__init__('BlobModel')
+        self.x = None
+        self.blob = None
+
+
+class OpaqueTestCase(unittest.TestCase):
+    def setUp(self):
+        self.settings_schema = jg.Dict('settings', [
+            jg.Dict.make_key('inner', jg.Dict('inner', [jg.Dict.make_key('x', jg.Atom('x', int, 1, var='x'))])),
+            jg.Dict.make_key('rest', jg.Dict('rest', [jg.Dict.make_key('c', jg.Atom('c', int, value=3))]))])
+        self.default = {'inner': {'x': 1}, 'rest': {'c': 3}}
+
+    def make_schema(self, check):
+        opaque = jg.Opaque('opaque', self.settings_schema, [(('inner', 'x'), jg.Atom('x', int, 1, var='x'))], 'blob',
+                           check=check)
+        return jg.Dict('root', [jg.Dict.make_key('settings', opaque)], model=BlobModel)
+
+    @staticmethod
+    def grammars(schema):
+        return [jg.Grammar(schema), jg.Grammar(schema).compile(), jg.Grammar(schema).use_stack_engine()]
+
+    def test_opaque(self):
+        elem = {'settings': {'inner': {'x': 5}, 'rest': {'c': 4}}}
+        for grammar in self.grammars(self.make_schema(False)):
+            model = grammar.parse_config(copy.deepcopy(elem))
+            # Only the extracted part is parsed
+            self.assertEqual(5, model.x)
+            self.assertEqual(elem['settings'], model.blob)
+            self.assertEqual(elem, grammar.gen_config(model))
+            # The extracted part is genned from the model over the blob
+            model.x = 7
+            result = grammar.gen_config(model)
+            self.assertEqual({'settings': {'inner': {'x': 7}, 'rest': {'c': 4}}}, result)
+            self.assertEqual(5, model.blob['inner']['x'])
+            # Without a blob, the schema is genned
+            self.assertEqual({'settings': self.default}, grammar.gen_config(None))
+            with self.assertRaises(jg.GrammarException) as context:
+                grammar.parse_config({'settings': {'rest': {'c': 3}}})
+            self.assertEqual('opaque_missing_path', context.exception.args[0])
+
+    def test_check(self):
+        for grammar in self.grammars(self.make_schema(True)):
+            # The rest is default, only the extracted part is parsed
+            model = grammar.parse_config({'settings': {'inner': {'x': 5}, 'rest': {'c': 3}}})
+            self.assertEqual(5, model.x)
+            self.assertEqual(1, len(grammar.opaque_digests))
+            # An unknown rest is parsed with the full schema
+            with self.assertRaises(jg.GrammarException) as context:
+                grammar.parse_config({'settings': {'inner': {'x': 5}, 'rest': {'c': 4}}})
+            self.assertEqual('atom_wrong_value', context.exception.args[0])
+            grammar.validate({'settings': {'inner': {'x': 6}, 'rest': {'c': 3}}})
+            with self.assertRaises(jg.GrammarException) as context:
+                grammar.validate({'settings': {'inner': {'x': 5}, 'rest': {'c': 4}}})
+            self.assertEqual('atom_wrong_value', context.exception.args[0])
+
+
+# A model that can't be built, validating must not build models
+class UnbuildableModel(jg.GrammarModel):
+    def __init__(self):
+        raise AssertionError('validate built a model')
+
+
+class ValidateTestCase(unittest.TestCase):
+    # Only validate can use the unbuildable model
+    def make_schema(self, model=None):
+        switch_enum = jg.Enum('enum', ['a', 'b'], 'a')
+        case_keys = {'a': [jg.SwitchDict.make_key('a1', jg.Atom('atom', int, 1))],
+                     'b': [jg.SwitchDict.make_key('b1', jg.Atom('atom', int, value=2))]}
+        switch = jg.SwitchDict('switch', jg.SwitchDict.make_key('switcher', switch_enum), case_keys)
+        entry = jg.Dict('entry', [jg.Dict.make_key('n', jg.identity_atom), jg.Dict.make_key('s', switch)],
+                        model=model, cleanup=lambda e, c, lp: self.fail('validate ran a cleanup') if model else e)
+        return jg.List('list', 2, entry)
+
+    def check_error(self, grammar, elem):
+        with self.assertRaises(jg.GrammarException) as validate_context:
+            grammar.validate(elem)
+        parse_grammar = jg.Grammar(grammar.schema, grammar.minimal)
+        with self.assertRaises(jg.GrammarException) as parse_context:
+            parse_grammar.parse_config(elem)
+        self.assertEqual(parse_context.exception.args, validate_context.exception.args)
+
+    def test_validate(self):
+        schema = self.make_schema(UnbuildableModel)
+        for minimal in [False, True]:
+            grammar = jg.Grammar(schema, minimal)
+            grammar.validate([{'n': 0, 's': {'switcher': 'a', 'a1': 5}}, {'n': 1, 's': {'switcher': 'b', 'b1': 2}}])
+
+    def test_validate_errors(self):
+        grammar = jg.Grammar(self.make_schema())
+        self.check_error(grammar, [{'n': 0, 's': {'switcher': 'a', 'a1': 5}}])
+        self.check_error(grammar, [{'n': 0, 's': {'switcher': 'a', 'a1': 5}},
+                                   {'n': 0, 's': {'switcher': 'a', 'a1': 5}}])
+        self.check_error(grammar, [{'n': 0, 's': {'switcher': 'c'}}, {'n': 1, 's': {'switcher': 'a', 'a1': 1}}])
+        self.check_error(grammar, [{'n': 0, 's': {'switcher': 'b', 'b1': 3}},
+                                   {'n': 1, 's': {'switcher': 'a', 'a1': 1}}])
+        self.check_error(grammar, [{'n': 0, 's': {'switcher': 'b', 'b1': 2, 'x': 1}},
+                                   {'n': 1, 's': {'switcher': 'a', 'a1': 1}}])
+        self.check_error(grammar, [{'n': 0, 's': {'switcher': 'a'}}, {'n': 1, 's': {'switcher': 'a', 'a1': 1}}])
+
+    def test_validate_configs(self):
+        intuitive_grammar_obj = jg.Grammar(intuitive_grammar.intuitive_schema, minimal=True)
+        intuitive_grammar_obj.validate(jg.GrammarFile('Configs/Example.yaml').load())
+        intuitive_grammar_obj.validate(jg.GrammarFile('Configs/Config.yaml').load())
+        simple_grammar_obj = jg.Grammar(simple_grammar.simple_schema, minimal=True)
+        elem = jg.GrammarFile('Configs/Test/Demo.yaml').load()
+        simple_grammar_obj.validate(elem)
+        elem['version'] = '0.0.1'
+        self.check_error(simple_grammar_obj, elem)
+
+    # validate skips the elements equal to their gen template, which must not take a float for an int
+    # The engines are switched on one grammar, which keeps the templates (the compiled engine takes precedence)
+    def test_validate_default_types(self):
+        grammar = jg.Grammar(backup_grammar.backup_schema)
+        elem = grammar.gen_config(None)
+        elem['data']['bankArray'][120]['bankMsgArray'][5]['data'][3] = 0.0
+        for use_engine in [lambda: grammar, grammar.use_stack_engine, grammar.compile]:
+            use_engine()
+            with self.assertRaises(jg.GrammarException) as validate_context:
+                grammar.validate(elem)
+            self.assertEqual('atom_wrong_type', validate_context.exception.args[0])
+            with self.assertRaises(jg.GrammarException) as parse_context:
+                grammar.parse_config(json.loads(json.dumps(elem)))
+            self.assertEqual(validate_context.exception.args, parse_context.exception.args)
+
+
+class ProfileTestCase(unittest.TestCase):
+    def make_schema(self):
+        entry = jg.Dict('entry', [jg.Dict.make_key('n', jg.identity_atom),
+                                  jg.Dict.make_key('x', jg.Atom('x', int, 0, var='x'))], model=ObjectForTests)
+        return jg.List('list', 3, entry)
+
+    def test_profile(self):
+        elem = [{'n': 0, 'x': 1}, {'n': 1, 'x': 0}, {'n': 2, 'x': 2}]
+        for minimal in [True, False]:
+            for grammar in [jg.Grammar(self.make_schema(), minimal), jg.Grammar(self.make_schema(), minimal).compile(),
+                            jg.Grammar(self.make_schema(), minimal).use_stack_engine()]:
+                self.assertIsNone(grammar.profile)
+                model = grammar.parse_config(elem)
+                grammar.enable_profiling()
+                self.assertEqual(model, grammar.parse_config(elem))
+                profile = grammar.profile.nodes
+                self.assertEqual(1, profile[('list', 'List')].visits)
+                self.assertEqual(3, profile[('entry', 'Dict')].visits)
+                self.assertEqual(3, profile[('entry', 'Dict')].models)
+                list_profile = profile[('list', 'List')]
+                self.assertGreaterEqual(list_profile.time, list_profile.self_time)
+                if minimal:
+                    # Complete grammars fast-accept the default entry, minimal grammars visit every atom
+                    self.assertEqual(3, profile[('I', 'Atom')].value_calls)
+                    self.assertEqual(3, profile[('x', 'Atom')].visits)
+
+                grammar.gen_config(model)
+                self.assertEqual(2, profile[('list', 'List')].visits)
+                self.assertIn('entry', grammar.profile.report())
+
+
+class BenchmarkTestCase(unittest.TestCase):
+    # The benchmark shapes must round trip, or the benchmarks measure errors
+    def test_shapes(self):
+        for shape_name, (schema, make_model, modes) in benchmark_grammar.shapes.items():
+            model = make_model()
+            for mode in modes:
+                for engine in benchmark_grammar.engines:
+                    grammar = benchmark_grammar.make_grammar(schema, benchmark_grammar.modes[mode], engine)
+                    elem = grammar.gen_config(model)
+                    self.assertEqual(elem, grammar.gen_config(grammar.parse_config(elem)))
+
+    def test_run(self):
+        results = benchmark_grammar.run(['message'], ['minimal'], ['compiled'], 0.0, 1)
+        self.assertEqual(['message/minimal/compiled/parse', 'message/minimal/compiled/gen'], list(results))
+        baseline = {key: result * 2 for key, result in results.items()}
+        _, slower = benchmark_grammar.compare(results, baseline, 0.1)
+        self.assertEqual(list(results), slower)
+        _, slower = benchmark_grammar.compare(results, results, 0.1)
+        self.assertEqual([], slower)
+
+
+class DigestTestCase(unittest.TestCase):
+    def test_digest(self):
+        entries = make_entries()
+        other = make_entries()
+        self.assertTrue(entries[0].equals(other[0]))
+        self.assertEqual(entries[0].digest(), other[0].digest())
+        self.assertFalse(entries[0].equals(entries[5]))
+        self.assertFalse(entries[0].equals(None))
+        self.assertEqual([], entries[0].diff(other[0]))
+
+        # Setting a variable of a sub-model changes the digest of the enclosing model
+        digest = entries[5].digest()
+        other[5].items[0].value = 9
+        self.assertNotEqual(digest, other[5].digest())
+        self.assertEqual(['EntryForTests.items[0].value'], entries[5].diff(other[5]))
+        other[5].name = 'X'
+        self.assertEqual(['EntryForTests.items[0].value', 'EntryForTests.name'],
+                         entries[5].diff(other[5], every=True))
+        self.assertEqual(['EntryForTests.items[0].value'], entries[5].diff(other[5]))
+
+        # Lists changed in place need the digests invalidated
+        entries[0].items[1] = make_item(1, None)
+        entries[0].invalidate_digests()
+        self.assertEqual(['EntryForTests.items[1]'], entries[0].diff(other[0]))
+
+        # Types are part of the digest, and comparing doesn't set modified
+        item = make_item(1, None)
+        other_item = make_item(True, None)
+        self.assertFalse(item.equals(other_item))
+        self.assertEqual(['ItemForTests.value'], item.diff(other_item))
+        self.assertFalse(item.modified)
+        self.assertFalse(other_item.modified)
+
+        # Copies have their own cache
+        copied = copy.deepcopy(entries[5])
+        self.assertTrue(copied.equals(entries[5]))
+        copied.name = 'Copied'
+        self.assertFalse(copied.equals(entries[5]))
+
+    # Setting a variable drops the digests of the model and of the models including it, and no others
+    def test_invalidation(self):
+        entries = make_entries()
+        digest = entries[5].digest()
+        other_digest = entries[0].digest()
+        item = entries[5].items[0]
+        item_digest = item.digest()
+        entries[0].name = 'X'
+        self.assertIsNone(entries[0].digest_cache)
+        self.assertEqual(digest, entries[5].digest_cache)
+        self.assertEqual(item_digest, item.digest_cache)
+
+        value = item.value
+        item.value = 9
+        self.assertIsNone(item.digest_cache)
+        self.assertIsNone(entries[5].digest_cache)
+        self.assertNotEqual(digest, entries[5].digest())
+        item.value = value
+        self.assertEqual(digest, entries[5].digest())
+        entries[0].name = 'E0'
+        self.assertEqual(other_digest, entries[0].digest())
+
+        # Copies and pickles don't take the cache or the enclosing models along
+        for copied in [copy.deepcopy(item), pickle.loads(pickle.dumps(item))]:
+            self.assertIs(ItemForTests, type(copied))
+            self.assertIsNone(copied.digest_cache)
+            self.assertIsNone(copied.digest_parents)
+            self.assertTrue(copied.equals(item))
+
+    # Only digested and frozen models watch setting their variables
+    def test_watching(self):
+        entries = make_entries()
+        self.assertIs(EntryForTests, type(entries[5]))
+        entries[5].digest()
+        self.assertIsNot(EntryForTests, type(entries[5]))
+        self.assertIsInstance(entries[5], EntryForTests)
+        self.assertIs(EntryForTests, entries[5].plain_class)
+        self.assertIs(ItemForTests, type(entries[5].items[0]).plain_class)
+        self.assertEqual([], entries[5].diff(copy.deepcopy(entries[5])))
+        with self.assertRaises(jg.GrammarException) as context:
+            entries[5].digest_cache = None
+        self.assertEqual(context.exception.args[0], 'model_internal_slot')
+
+    # Unslotted models are compared by their attributes
+    def test_unslotted(self):
+        obj = ObjectForTests()
+        other = ObjectForTests()
+        obj.x = [1, {'a': 2}]
+        other.x = [1, {'a': 3}]
+        self.assertEqual(["ObjectForTests.x[1]['a']"], obj.diff(other))
+        other.x[1]['a'] = 2
+        other.invalidate_digests()
+        self.assertTrue(obj.equals(other))
+        self.assertEqual(['ObjectForTests'], obj.diff(Object2ForTests()))
+
+
+class InternTestCase(unittest.TestCase):
+    def test_interning(self):
+        entries = make_entries()
+        entries[5] = copy.deepcopy(entries[0])
+        for grammar in make_grammars(entry_list_schema):
+            grammar.use_interning()
+            elem = grammar.gen_config(entries)
+            model = grammar.parse_config(elem)
+            self.assertIs(model[0], model[5])
+            self.assertIs(model[0].items, model[5].items)
+            self.assertEqual(elem, grammar.gen_config(model))
+
+        # Shared models are frozen, copies aren't
+        with self.assertRaises(jg.GrammarException) as context:
+            model[0].name = 'X'
+        self.assertEqual(context.exception.args[0], 'frozen_model')
+        model[0].modified = False
+        copied = copy.deepcopy(model[0])
+        copied.name = 'X'
+        self.assertEqual('X', copied.name)
+
+    def test_intern_table(self):
+        table = jg.InternTable({})
+        first = [1, True, 'name', {'a': [1, 2]}]
+        second = [1, True, ''.join(['na', 'me']), {'a': [1, 2]}]
+        interned = table.intern(first)[0]
+        self.assertIs(interned, table.intern(second)[0])
+        self.assertIsNot(table.intern([True, 1, 'name', {'a': [1, 2]}])[0], interned)
+        self.assertIs(interned[2], table.intern('name')[0])
+
+        # Equal values of different types, or of different signs, aren't shared
+        values = [[0.0], [-0.0], [1], [1.0], [True], [float('nan')]]
+        for value in values:
+            self.assertIs(table.intern(value)[0], table.intern(list(value))[0])
+        interned = [table.intern(value)[0] for value in values]
+        self.assertEqual(len(values), len(set(id(value) for value in interned)))
+        self.assertEqual('-0.0', repr(interned[1][0]))
+        for value in [0.0, -0.0]:
+            item = table.intern(make_item(value, None))[0]
+            self.assertEqual(repr(value), repr(item.value))
+
+
+class PathTestCase(unittest.TestCase):
+    def test_paths(self):
+        entries = make_entries()
+        for minimal in [False, True]:
+            for grammar in make_grammars(entry_list_schema, minimal):
+                elem = grammar.gen_config(entries)
+                # The entry number is an identity atom, genned from the list position on the path
+                for path in ['5', '7', '5/items/0', '5/items/0/data', '5/items/0/data/0', '5/entryNum']:
+                    expected = elem
+                    for step in path.split('/'):
+                        if expected is not None:
+                            expected = expected[int(step)] if isinstance(expected, list) else expected.get(step)
+                    self.assertEqual(expected, grammar.gen_at(entries, path))
+                self.assertEqual(elem, grammar.gen_at(entries, ''))
+                self.assertEqual(grammar.gen_at(entries, '5/items/0'), grammar.gen_at(entries, [5, 'items', 0]))
+
+                parsed = grammar.parse_config(elem)
+                self.assertTrue(grammar.parse_at(elem, '5').equals(parsed[5]))
+                self.assertTrue(grammar.parse_at(elem, '5/items/0').equals(parsed[5].items[0]))
+                self.assertEqual('E5', grammar.parse_at(elem, '5/name'))
+                self.assertIsNone(grammar.parse_at(elem, '7'))
+                self.assertEqual(5, grammar.parse_at(elem, '5/items/0/data')[0])
+
+        # Variables a dict without a model binds come back in a new instance of the enclosing model
+        dict_schema = jg.Dict('Outer', [jg.Dict.make_key('inner', jg.Dict('Inner', [
+            jg.Dict.make_key('x', jg.Atom('X', int, 0, var='x'))]))], model=ObjectForTests)
+        dict_grammar = jg.Grammar(dict_schema)
+        obj = dict_grammar.parse_at({'inner': {'x': 3}}, 'inner')
+        self.assertIsInstance(obj, ObjectForTests)
+        self.assertEqual(3, obj.x)
+
+        for path, code in [('8', 'path_not_found'), ('x', 'path_not_found'), ('5/nothing', 'path_not_found'),
+                           ('5/name/0', 'path_not_found')]:
+            with self.assertRaises(jg.GrammarException) as context:
+                grammar.gen_at(entries, path)
+            self.assertEqual(context.exception.args[0], code)
+
+    def test_switch_paths(self):
+        models = make_switch_models(4)
+        for grammar in make_grammars(jg.List('Switch List', 0, make_model_switch()), True):
+            elem = grammar.gen_config(models)
+            self.assertEqual(elem[3], grammar.gen_at(models, '3'))
+            self.assertEqual(127, grammar.gen_at(models, '3/b2'))
+            self.assertEqual('b', grammar.gen_at(models, '3/switcher'))
+            self.assertTrue(grammar.parse_at(elem, '3').equals(grammar.parse_config(elem)[3]))
+            self.assertEqual(127, grammar.parse_at(elem, '3/b2'))
+            with self.assertRaises(jg.GrammarException) as context:
+                grammar.gen_at(models, '2/b2')
+            self.assertEqual(context.exception.args[0], 'path_not_found')
+
+    # A key that reads its context gens from its enclosing dict, and parses with the enclosing element
+    def test_context_paths(self):
+        items = [make_item(4, None), None, make_item(7, None)]
+        for minimal in [False, True]:
+            for grammar in make_grammars(context_list_schema, minimal):
+                elem = grammar.gen_config(items)
+                for path in ['0/check', '1/check', '2/check']:
+                    expected = elem[int(path[0])] if int(path[0]) < len(elem) else None
+                    self.assertEqual(None if expected is None else expected.get('check'), grammar.gen_at(items, path))
+        for grammar in make_grammars(context_list_schema):
+            elem = grammar.gen_config(items)
+            self.assertEqual(8, grammar.gen_at(items, '2/check'))
+            self.assertIsNone(grammar.parse_at(elem, '2/check'))
+            elem[2]['check'] = 9
+            with self.assertRaises(jg.GrammarException) as context:
+                grammar.parse_at(elem, '2/check')
+            self.assertEqual(context.exception.args[0], 'atom_wrong_value')
+
+
+class SparseListTestCase(unittest.TestCase):
+    def test_sparse_list(self):
+        sparse = jg.SparseList(4)
+        sparse[1] = 'a'
+        sparse[-1] = 'b'
+        self.assertEqual(4, len(sparse))
+        self.assertEqual([None, 'a', None, 'b'], list(sparse))
+        self.assertEqual([(1, 'a'), (3, 'b')], sparse.populated())
+        self.assertEqual('b', sparse[3])
+        self.assertIsNone(sparse[0])
+        self.assertEqual(['a', None], sparse[1:3])
+        self.assertEqual(sparse, [None, 'a', None, 'b'])
+        self.assertEqual([None, 'a', None, 'b', None], sparse)
+        self.assertNotEqual(sparse, [None, 'a'])
+        self.assertEqual(sparse, jg.SparseList.of([None, 'a', None, 'b']))
+        sparse[3] = None
+        self.assertEqual(sparse, [None, 'a'])
+        self.assertEqual({1: 'a'}, sparse.entries)
+        with self.assertRaises(IndexError):
+            sparse[4] = 'c'
+        with self.assertRaises(IndexError):
+            _ = sparse[4]
+        self.assertEqual([(1, 'a')], jg.populated([None, 'a', None]))
+        self.assertEqual(jg.populated(sparse), jg.populated(sparse.to_list()))
+
+        with self.assertRaises(jg.GrammarException) as context:
+            jg.List('Unlimited', 0, jg.zero_atom, sparse=True)
+        self.assertEqual(context.exception.args[0], 'unlimited_sparse_list')
+
+    def test_sparse_gen_parse(self):
+        entries = make_entries()
+        sparse_schema = jg.List('Entry List', 8, entry_schema, sparse=True)
+        for minimal in [False, True]:
+            for grammar, sparse_grammar in zip(make_grammars(entry_list_schema, minimal),
+                                               make_grammars(sparse_schema, minimal)):
+                elem = grammar.gen_config(entries)
+                # A sparse model gens the same elements as the dense one, in either grammar
+                self.assertEqual(elem, grammar.gen_config(jg.SparseList.of(entries)))
+                self.assertEqual(elem, sparse_grammar.gen_config(jg.SparseList.of(entries)))
+                parsed = sparse_grammar.parse_config(elem)
+                self.assertIsInstance(parsed, jg.SparseList)
+                self.assertEqual([0, 5], [pos for pos, _ in parsed.populated()])
+                self.assertEqual(parsed, grammar.parse_config(elem))
+                self.assertEqual(elem, sparse_grammar.gen_config(parsed))
+                self.assertIsNone(sparse_grammar.parse_config(sparse_grammar.gen_config(None)))
+                with self.assertRaises(jg.GrammarException) as context:
+                    sparse_grammar.gen_config(jg.SparseList(9))
+                self.assertEqual(context.exception.args[0], 'list_bad_length')
+
+        # Backup models hold their banks, presets and messages in sparse lists
+        grammar = jg.Grammar(backup_grammar.backup_schema)
+        backup = grammar.parse_config(grammar.gen_config(None))
+        bank = backup_model.Bank()
+        bank.name = 'Sparse'
+        preset = backup_model.Preset()
+        preset.short_name = 'P'
+        bank.set_preset(preset, 3)
+        backup.set_bank(bank, 2)
+        self.assertIsInstance(backup.banks, jg.SparseList)
+        parsed = grammar.parse_config(grammar.gen_config(backup))
+        self.assertEqual([2], [pos for pos, _ in parsed.banks.populated()])
+        self.assertEqual('P', parsed.banks[2].presets[3].short_name)
+        self.assertEqual([], parsed.banks[2].diff(bank))
+
+
+class SchemaKeyTestCase(unittest.TestCase):
+    def test_frozen_keys(self):
+        key = jg.Dict.make_key('a', jg.zero_atom)
+        self.assertEqual({'name': 'a', 'schema': jg.zero_atom, 'required': None}, key)
+        for change in [lambda: key.__setitem__('name', 'b'), lambda: key.update(required=True),
+                       lambda: key.pop('schema'), lambda: key.clear()]:
+            with self.assertRaises(jg.GrammarException) as context:
+                change()
+            self.assertEqual(context.exception.args[0], 'frozen_schema_key')
+        self.assertEqual('a', key['name'])
+        for copied in [copy.deepcopy(key), pickle.loads(pickle.dumps(key))]:
+            self.assertIsInstance(copied, jg.SchemaKey)
+            self.assertEqual('a', copied['name'])
+
+    # Switch dicts share the keys and nodes of their cases, without changing the case key lists
+    def test_shared_case_keys(self):
+        switch_key = jg.SwitchDict.make_key('x', jg.Enum('enum', ['a', 'b'], 'a'))
+        case_keys = {'a': [], 'b': [ObjectForTests, jg.SwitchDict.make_key('b1', jg.Atom('atom', int, 1)),
+                                    jg.SwitchDict.make_key('b2', jg.Atom('atom', int, 2))]}
+        first = jg.SwitchDict('first', switch_key, case_keys, model_var='y')
+        second = jg.SwitchDict('second', switch_key, case_keys, model_var='y')
+        self.assertIs(ObjectForTests, case_keys['b'][0])
+        self.assertEqual(3, len(case_keys['b']))
+        self.assertEqual(tuple(case_keys['b'][1:]), first.case_keys['b'])
+        for case_key in case_keys:
+            for first_key, second_key in zip(first.case_keys[case_key], second.case_keys[case_key]):
+                self.assertIs(first_key, second_key)
+
+        bank_case_keys = im.simple_bank_message_schema.case_keys
+        preset_case_keys = im.simple_preset_message_schema.case_keys
+        self.assertIs(bank_case_keys['PC'][0]['schema'], preset_case_keys['PC'][0]['schema'])
+
+
+class LazyListTestCase(unittest.TestCase):
+    def test_lazy_lists(self):
+        entries = make_entries()
+        for grammar, lazy_grammar in zip(make_grammars(entry_list_schema), make_grammars(entry_list_schema)):
+            lazy_grammar.use_lazy_lists()
+            elem = grammar.gen_config(entries)
+            parsed = grammar.parse_config(elem)
+            lazy = lazy_grammar.parse_config(elem)
+            self.assertIsInstance(lazy, jg.LazyList)
+            self.assertEqual(8, len(lazy))
+            self.assertEqual({}, lazy.entries)
+            # Only the accessed entries are parsed, with their list position
+            self.assertEqual('E5', lazy[5].name)
+            self.assertIsInstance(lazy[5].items, jg.LazyList)
+            self.assertEqual(parsed[5].items[0], lazy[5].items[0])
+            self.assertEqual([5], list(lazy.entries))
+            self.assertIsNone(lazy[-1])
+            self.assertEqual(parsed, lazy)
+            self.assertEqual(parsed, lazy.resolve())
+            self.assertEqual(elem, lazy_grammar.gen_config(lazy))
+            self.assertEqual(elem, grammar.gen_config(lazy_grammar.parse_config(elem)))
+            self.assertTrue(lazy_grammar.parse_config(elem)[0].equals(parsed[0]))
+            self.assertIsNone(lazy_grammar.parse_config(lazy_grammar.gen_config(None)))
+
+            # Parse errors are raised when the entry is accessed
+            bad_elem = copy.deepcopy(elem)
+            bad_elem[3]['entryNum'] = 4
+            lazy = lazy_grammar.parse_config(bad_elem)
+            self.assertEqual('E0', lazy[0].name)
+            with self.assertRaises(jg.GrammarException):
+                _ = lazy[3]
+
+        # Lists whose entries don't have their own model, and minimal grammars, are parsed as usual
+        lazy_grammar = jg.Grammar(jg.List('Numbers', 3, jg.Atom('Number', int, 0))).use_lazy_lists()
+        self.assertEqual([None, 2, None], lazy_grammar.parse_config([0, 2, 0]))
+        lazy_grammar = jg.Grammar(entry_list_schema, True).use_lazy_lists()
+        self.assertIsInstance(lazy_grammar.parse_config(lazy_grammar.gen_config(entries)), list)
+
+        # Entries that clean up to None, or have no template, parse to None as they do eagerly
+        def drop_ones(item, _context, _list_pos):
+            return None if item is not None and item.value == 1 else item
+        cleaned_schema = jg.Dict('Cleaned Item', [jg.Dict.make_key('value', jg.Atom('Value', int, 0, var='value'))],
+                                 model=ItemForTests, cleanup=drop_ones)
+        item = make_item(2, None)
+        for schema, elem in [(jg.List('Cleaned List', 2, cleaned_schema), [{'value': 1}, {'value': 1}]),
+                             (jg.List('Cleaned List', 2, cleaned_schema), [{'value': 1}, {'value': 2}]),
+                             (context_list_schema, jg.Grammar(context_list_schema).gen_config(None)),
+                             (context_list_schema, jg.Grammar(context_list_schema).gen_config([None, item, None]))]:
+            for grammar, lazy_grammar in zip(make_grammars(schema), make_grammars(schema)):
+                lazy_grammar.use_lazy_lists()
+                parsed = grammar.parse_config(elem)
+                lazy = lazy_grammar.parse_config(elem)
+                self.assertEqual(parsed is None, lazy is None)
+                self.assertEqual(parsed, lazy)
+
+        lazy = jg.Grammar(entry_list_schema).use_lazy_lists().parse_config(
+            jg.Grammar(entry_list_schema).gen_config(entries))
+        lazy[7] = EntryForTests()
+        self.assertIs(lazy[7], lazy.entries[7])
+        copied = copy.deepcopy(lazy)
+        self.assertIsInstance(copied, list)
+        self.assertEqual([0, 5, 7], [pos for pos, _ in jg.populated(copied)])
+
+
+class ParallelListsTestCase(unittest.TestCase):
+    def test_parallel_lists(self):
+        entries = make_entries()
+        for minimal in [False, True]:
+            for grammar, parallel_grammar in zip(make_grammars(entry_list_schema, minimal),
+                                                 make_grammars(entry_list_schema, minimal)):
+                parallel_grammar.use_parallel_lists(['Entry List'], max_workers=2, chunk_size=2)
+                try:
+                    elem = grammar.gen_config(entries)
+                    self.assertEqual(elem, parallel_grammar.gen_config(entries))
+                    self.assertEqual(elem, parallel_grammar.gen_config(jg.SparseList.of(entries)))
+                    self.assertEqual(grammar.parse_config(elem), parallel_grammar.parse_config(elem))
+                    self.assertIsNone(parallel_grammar.parse_config(grammar.gen_config(None)))
+
+                    # The error is the one parsing in order raises first, with the entry's path and position
+                    bad_elem = copy.deepcopy(elem)
+                    bad_elem[3]['entryNum'] = 4
+                    bad_elem[6]['entryNum'] = 4
+                    with self.assertRaises(jg.GrammarException) as serial_error:
+                        grammar.parse_config(bad_elem)
+                    with self.assertRaises(jg.GrammarException) as parallel_error:
+                        parallel_grammar.parse_config(bad_elem)
+                    self.assertEqual(serial_error.exception.args, parallel_error.exception.args)
+                finally:
+                    parallel_grammar.close()
+
+        with self.assertRaises(jg.GrammarException) as error:
+            jg.Grammar(entry_list_schema).use_parallel_lists(['Bank List'])
+        self.assertEqual('parallel_list_not_found', error.exception.args[0])
+        with self.assertRaises(jg.GrammarException) as error:
+            jg.Grammar(entry_list_schema).use_parallel_lists(['Data List'])
+        self.assertEqual('parallel_list_not_independent', error.exception.args[0])
+        # The entries' cleanup would be called without the list
+        cleaned_schema = jg.Dict('Cleaned', [], cleanup=lambda result, _context, _list_pos: result, model=ItemForTests)
+        with self.assertRaises(jg.GrammarException) as error:
+            jg.Grammar(jg.List('Cleaned List', 2, cleaned_schema)).use_parallel_lists(['Cleaned List'])
+        self.assertEqual('parallel_list_uses_context', error.exception.args[0])
+
+
+class GenStreamTestCase(unittest.TestCase):
+    def test_gen_stream(self):
+        switch_schema = jg.List('Switch List', 0, make_model_switch())
+        for schema, model, modes in [(entry_list_schema, make_entries(), [False, True]),
+                                     (switch_schema, make_switch_models(4), [True])]:
+            for minimal in modes:
+                for grammar in make_grammars(schema, minimal):
+                    elem = grammar.gen_config(model)
+                    for compact, dump_args in [(False, {'indent': 4}), (True, {'separators': (',', ':')})]:
+                        stream = io.StringIO()
+                        grammar.gen_stream(model, stream, compact)
+                        self.assertEqual(json.dumps(elem, **dump_args), stream.getvalue())
+
+        grammar = jg.Grammar(entry_list_schema)
+        entries = make_entries()
+        stream = io.StringIO()
+        grammar.gen_stream(jg.SparseList.of(entries), stream)
+        self.assertEqual(json.dumps(grammar.gen_config(entries), indent=4), stream.getvalue())
+        stream = io.StringIO()
+        jg.Grammar(jg.List('Empty', 0, entry_schema), True).gen_stream([], stream)
+        self.assertEqual('null', stream.getvalue())
+        with self.assertRaises(jg.GrammarException):
+            grammar.gen_stream(entries[:3], io.StringIO())
+
+    # Dicts with a key that reads the context are genned whole
+    def test_gen_stream_context(self):
+        items = [make_item(4, None), None, make_item(7, None)]
+        for grammar in make_grammars(context_list_schema):
+            elem = grammar.gen_config(items)
+            self.assertEqual({'value': 4, 'check': 5}, elem[0])
+            stream = io.StringIO()
+            grammar.gen_stream(items, stream)
+            self.assertEqual(json.dumps(elem, indent=4), stream.getvalue())
+
+    # A backup streams its sparse bank list, stamping out the default banks
+    def test_gen_stream_backup(self):
+        grammar = jg.Grammar(backup_grammar.backup_schema)
+        backup = make_backup()
+        stream = io.StringIO()
+        grammar.gen_stream(backup, stream, True)
+        self.assertEqual(json.dumps(grammar.gen_config(backup), separators=(',', ':')), stream.getvalue())
+
+
+class ParseStreamTestCase(unittest.TestCase):
+    def test_json_reader(self):
+        text = json.dumps({'a': [1, 22, {'b': None}], 'c': 'x"y', 'd': [], 'e': {}, 'f': 1.5e3})
+        for buffer_size in [1, 3, 1 << 16]:
+            reader = jg.JsonReader(io.StringIO(text), buffer_size)
+            keys = []
+            for key in reader.items():
+                keys.append(key)
+                if key == 'a':
+                    self.assertEqual([0, 1, 2], [pos for pos in reader.entries() if reader.value() or True])
+                else:
+                    reader.value()
+            reader.end()
+            self.assertEqual(['a', 'c', 'd', 'e', 'f'], keys)
+        for bad_text in ['{"a" 1}', '[1 2]', '[1, 2', '{"a": 1} 2', '']:
+            with self.assertRaises(json.JSONDecodeError):
+                jg.Grammar(jg.Dict('Empty', [])).parse_stream(jg.JsonReader(io.StringIO(bad_text), 2))
+
+        # Values cut by the end of the buffer anywhere are read on
+        text = '[true, false, null, "\\u00e9x", -1.5e+3, "a\\"b"]'
+        for buffer_size in range(1, 8):
+            reader = jg.JsonReader(io.StringIO(text), buffer_size)
+            self.assertEqual(json.loads(text), [reader.value() for _ in reader.entries()])
+
+        # A syntax error is raised without reading the rest of the file
+        bad_file = io.StringIO('[{"a": 1 2}, ' + ', '.join(['{"a": 1}'] * 1000) + ']')
+        reader = jg.JsonReader(bad_file, 64)
+        with self.assertRaises(json.JSONDecodeError):
+            for _ in reader.entries():
+                reader.value()
+        self.assertEqual(64, bad_file.tell())
+
+    def test_parse_stream(self):
+        entries = make_entries()
+        for minimal in [False, True]:
+            for grammar in make_grammars(entry_list_schema, minimal):
+                text = json.dumps(grammar.gen_config(entries), indent=4)
+                parsed = grammar.parse_stream(jg.JsonReader(io.StringIO(text), 64))
+                self.assertEqual(grammar.parse_config(json.loads(text)), parsed)
+                self.assertEqual(grammar.parse_config(json.loads(text)),
+                                 grammar.parse_stream(jg.JsonReader(io.StringIO(text)), ['Item List']))
+
+                # An entry's error is the one parse_config raises
+                bad_elem = json.loads(text)
+                bad_elem[5]['entryNum'] = 4
+                with self.assertRaises(jg.GrammarException) as load_error:
+                    grammar.parse_config(bad_elem)
+                with self.assertRaises(jg.GrammarException) as stream_error:
+                    grammar.parse_stream(jg.JsonReader(io.StringIO(json.dumps(bad_elem))))
+                self.assertEqual(load_error.exception.args, stream_error.exception.args)
+
+    # Lists whose entries' cleanup reads the list are read whole, so the cleanup gets its context
+    def test_parse_stream_cleanup(self):
+        def drop_last(item, context, list_pos):
+            return None if list_pos[-1] == len(context) - 1 else item
+        cleaned_schema = jg.Dict('Cleaned Item', [jg.Dict.make_key('value', jg.Atom('Value', int, 0, var='value'))],
+                                 model=ItemForTests, cleanup=drop_last)
+        grammar = jg.Grammar(jg.List('Cleaned List', 3, cleaned_schema))
+        self.assertEqual({}, grammar.streamed_nodes(None))
+        text = json.dumps([{'value': 1}, {'value': 2}, {'value': 3}])
+        self.assertEqual(grammar.parse_config(json.loads(text)),
+                         grammar.parse_stream(jg.JsonReader(io.StringIO(text))))
+
+    # The entries of the bank list are parsed as they are read
+    def test_parse_stream_backup(self):
+        grammar = jg.Grammar(backup_grammar.backup_schema)
+        streamed = grammar.streamed_nodes(None)
+        self.assertEqual(['Bank List'], [node.name for node, is_list in streamed.items() if is_list])
+        text = json.dumps(grammar.gen_config(make_backup()), separators=(',', ':'))
+        parsed = grammar.parse_stream(jg.JsonReader(io.StringIO(text)))
+        self.assertEqual('P', parsed.banks[2].presets[3].short_name)
+        self.assertEqual([], parsed.diff(grammar.parse_config(json.loads(text))))
+
+
+class FileBackendTestCase(unittest.TestCase):
+    def test_backends(self):
+        data = {'name': 'Preset', 'data': [1, None, True], 'nested': {'x': 1.5}}
+        with tempfile.TemporaryDirectory() as directory:
+            for backend_name, backend in jg.file_backends.items():
+                filename = os.path.join(directory, 'config.' + ('yaml' if backend.is_yaml else 'json'))
+                config_file = jg.GrammarFile(filename, backend=backend_name)
+                config_file.save(data)
+                self.assertEqual(data, config_file.load())
+
+            # A model saved and loaded by each JSON backend
+            grammar = jg.Grammar(entry_list_schema)
+            entries = make_entries()
+            json_filename = os.path.join(directory, 'entries.json')
+            for backend_name in ['json', 'json-compact']:
+                jg.GrammarFile(json_filename, backend=backend_name).save_model(grammar, entries)
+                with open(json_filename) as json_file:
+                    text = json_file.read()
+                self.assertEqual(jg.file_backends[backend_name].stream_compact, '\n' not in text)
+                for load_backend_name, load_backend in jg.file_backends.items():
+                    if not load_backend.is_yaml:
+                        loaded = jg.GrammarFile(json_filename, backend=load_backend_name).load_model(grammar)
+                        self.assertEqual(grammar.parse_config(json.loads(text)), loaded)
+
+        self.assertIs(jg.file_backends['json'], jg.GrammarFile('config.json').backend)
+        with self.assertRaises(jg.GrammarException) as error:
+            jg.GrammarFile('config.yaml', backend='json')
+        self.assertEqual('backend_format_mismatch', error.exception.args[0])
+        with self.assertRaises(jg.GrammarException) as error:
+            jg.GrammarFile('config.json', backend='xml')
+        self.assertEqual('unknown_backend', error.exception.args[0])
+
+    def test_failed_save_keeps_file(self):
+        backup_grammar_obj = jg.Grammar(backup_grammar.backup_schema)
+        bad_backup = backup_model.Backup()
+        bad_backup.banks = 'not a list'
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'backup.json')
+            with open(filename, 'w') as existing_file:
+                existing_file.write('{}')
+            with self.assertRaises(jg.GrammarException):
+                jg.GrammarFile(filename).save_model(backup_grammar_obj, bad_backup)
+            with open(filename) as existing_file:
+                self.assertEqual('{}', existing_file.read())
+            self.assertEqual(['backup.json'], os.listdir(directory))
+
+            # A successful save keeps the file's permissions
+            os.chmod(filename, 0o600)
+            jg.GrammarFile(filename).save_model(backup_grammar_obj, make_backup())
+            self.assertEqual(0o600, os.stat(filename).st_mode & 0o777)
+            self.assertEqual(['backup.json'], os.listdir(directory))
+
+    def test_compression(self):
+        data = {'name': 'Preset', 'data': [1, None, True] * 100}
+        magic = {'.gz': b'\x1f\x8b', '.xz': b'\xfd7zXZ', '.bz2': b'BZh'}
+        grammar = jg.Grammar(entry_list_schema)
+        entries = make_entries()
+        with tempfile.TemporaryDirectory() as directory:
+            for extension, file_magic in magic.items():
+                for backend_name, backend in jg.file_backends.items():
+                    filename = os.path.join(directory, 'config.' + ('yaml' if backend.is_yaml else 'json') + extension)
+                    config_file = jg.GrammarFile(filename, backend=backend_name)
+                    config_file.save(data)
+                    with open(filename, 'rb') as compressed_file:
+                        self.assertEqual(file_magic, compressed_file.read(len(file_magic)))
+                    self.assertEqual(data, config_file.load())
+                    config_file.save_model(grammar, entries)
+                    self.assertEqual(grammar.parse_config(grammar.gen_config(entries)), config_file.load_model(grammar))
+        with self.assertRaises(jg.GrammarException):
+            jg.GrammarFile('config.json.zip')
+
+    def test_memory_and_open_files(self):
+        data = {'name': 'Preset', 'data': [1, None, True]}
+        grammar = jg.Grammar(entry_list_schema)
+        entries = make_entries()
+        for backend_name, backend in jg.file_backends.items():
+            buffer_file = jg.GrammarFile(is_yaml=backend.is_yaml, backend=backend_name)
+            buffer_file.save(data)
+            self.assertEqual(data, jg.GrammarFile(is_yaml=backend.is_yaml, backend=backend_name,
+                                                  text=buffer_file.getvalue()).load())
+            buffer_file.save_model(grammar, entries)
+            self.assertEqual(grammar.parse_config(grammar.gen_config(entries)), buffer_file.load_model(grammar))
+
+            # Text and binary file objects are left open
+            for open_file in [io.StringIO(), io.BytesIO()]:
+                if backend.binary and isinstance(open_file, io.StringIO):
+                    continue
+                jg.GrammarFile(file=open_file, is_yaml=backend.is_yaml, backend=backend_name).save(data)
+                self.assertFalse(open_file.closed)
+                open_file.seek(0)
+                self.assertEqual(data, jg.GrammarFile(file=open_file, is_yaml=backend.is_yaml,
+                                                      backend=backend_name).load())
+        with self.assertRaises(jg.GrammarException) as error:
+            jg.GrammarFile(is_yaml=True).load()
+        self.assertEqual('empty_buffer', error.exception.args[0])
+
+        # '-' is stdin and stdout
+        stdin, stdout = sys.stdin, sys.stdout
+        try:
+            sys.stdout = io.StringIO()
+            jg.GrammarFile('-', is_yaml=False).save_model(grammar, entries)
+            sys.stdin = io.StringIO(sys.stdout.getvalue())
+            self.assertEqual(json.dumps(grammar.gen_config(entries), indent=4), sys.stdin.getvalue())
+            self.assertEqual(grammar.parse_config(grammar.gen_config(entries)),
+                             jg.GrammarFile('-', is_yaml=False).load_model(grammar))
+        finally:
+            sys.stdin, sys.stdout = stdin, stdout
+        with self.assertRaises(jg.GrammarException):
+            jg.GrammarFile('-')
+
+
+class ModelCacheTestCase(unittest.TestCase):
+    def test_fingerprint(self):
+        fingerprint = jg.Grammar(entry_list_schema).fingerprint()
+        for grammar in make_grammars(entry_list_schema):
+            self.assertEqual(fingerprint, grammar.fingerprint())
+        self.assertNotEqual(fingerprint, jg.Grammar(entry_list_schema, True).fingerprint())
+        self.assertEqual(jg.Grammar(jg.List('Numbers', 3, jg.Atom('Number', int, 0))).fingerprint(),
+                         jg.Grammar(jg.List('Numbers', 3, jg.Atom('Number', int, 0))).fingerprint())
+        self.assertNotEqual(jg.Grammar(jg.List('Numbers', 3, jg.Atom('Number', int, 0))).fingerprint(),
+                            jg.Grammar(jg.List('Numbers', 3, jg.Atom('Number', int, 1))).fingerprint())
+        self.assertNotEqual(jg.Grammar(simple_grammar.simple_schema, True).fingerprint(),
+                            jg.Grammar(intuitive_grammar.intuitive_schema, True).fingerprint())
+
+    def test_model_cache(self):
+        grammar = jg.Grammar(entry_list_schema)
+        entries = make_entries()
+        parsed = grammar.parse_config(grammar.gen_config(entries))
+        with tempfile.TemporaryDirectory() as directory:
+            cache = jg.ModelCache(directory, version='1.0')
+            config_file = jg.GrammarFile(is_yaml=False)
+            config_file.save_model(grammar, entries)
+            self.assertEqual(parsed, config_file.load_model(grammar, cache=cache))
+            key = cache.key(config_file.contents(), grammar)
+            self.assertEqual((True, parsed), cache.get(key))
+            self.assertEqual(parsed, config_file.load_model(grammar, cache=cache))
+
+            # The key changes with the file, the grammar and the version
+            other_file = jg.GrammarFile(is_yaml=False, text=json.dumps(grammar.gen_config(entries)))
+            self.assertNotEqual(key, cache.key(other_file.contents(), grammar))
+            self.assertNotEqual(key, cache.key(config_file.contents(), jg.Grammar(grammar.schema, True)))
+            self.assertNotEqual(key, jg.ModelCache(directory, version='1.1').key(config_file.contents(), grammar))
+
+            # A damaged model is parsed again
+            with open(cache.path(key), 'wb') as cache_file:
+                cache_file.write(b'damaged')
+            self.assertEqual((False, None), cache.get(key))
+            self.assertEqual(parsed, config_file.load_model(grammar, cache=cache))
+            self.assertEqual((True, parsed), cache.get(key))
+
+            # The least recently used models are removed
+            size = os.path.getsize(cache.path(key))
+            small_cache = jg.ModelCache(directory, max_size=size * 2)
+            other_key = small_cache.key(other_file.contents(), grammar)
+            other_file.load_model(grammar, cache=small_cache)
+            os.utime(cache.path(key), (0, 0))
+            small_cache.put('third', None)
+            self.assertEqual((False, None), small_cache.get(key))
+            self.assertEqual((True, parsed), small_cache.get(other_key))
+            self.assertEqual((True, None), small_cache.get('third'))
+
+    # Only a directory no one else can write to is used
+    def test_private_cache(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cache_directory = os.path.join(directory, 'cache')
+            jg.ModelCache(cache_directory)
+            self.assertEqual(0, os.stat(cache_directory).st_mode & 0o077)
+            os.chmod(cache_directory, 0o777)
+            with self.assertRaises(jg.GrammarException) as context:
+                jg.ModelCache(cache_directory)
+            self.assertEqual(context.exception.args[0], 'cache_not_private')
+
+    # A model loaded from the cache is frozen and shared like a parsed one
+    def test_cache_interning(self):
+        grammar = jg.Grammar(entry_list_schema).use_interning()
+        entries = make_entries()
+        entries[5] = copy.deepcopy(entries[0])
+        config_file = jg.GrammarFile(is_yaml=False)
+        config_file.save_model(grammar, entries)
+        with tempfile.TemporaryDirectory() as directory:
+            cache = jg.ModelCache(directory)
+            config_file.load_model(grammar, cache=cache)
+            cached = config_file.load_model(grammar, cache=cache)
+            self.assertIs(cached[0], cached[5])
+            with self.assertRaises(jg.GrammarException) as context:
+                cached[0].name = 'X'
+            self.assertEqual(context.exception.args[0], 'frozen_model')
+
+    # A backup is parsed once, and then loaded from the cache
+    def test_backup_cache(self):
+        grammar = jg.Grammar(backup_grammar.backup_schema)
+        backup_file = jg.GrammarFile(is_yaml=False, backend='json-compact')
+        backup_file.save_model(grammar, make_backup())
+        with tempfile.TemporaryDirectory() as directory:
+            cache = jg.ModelCache(directory)
+            parsed = backup_file.load_model(grammar, cache=cache)
+            found, cached = cache.get(cache.key(backup_file.contents(), grammar))
+            self.assertTrue(found)
+            self.assertEqual('P', cached.banks[2].presets[3].short_name)
+            self.assertIsInstance(cached.banks, jg.SparseList)
+            self.assertEqual([], parsed.diff(backup_file.load_model(grammar, cache=cache)))
+
+
 if __name__ == '__main__':
     unittest.main()
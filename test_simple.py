@@ -56,8 +56,8 @@ class SimpleTestCase(unittest.TestCase):
         # Load the new backup config file back into a backup model
         # Compare against the original backup model
         orig_backup_config_filename = "Configs/Test/" + filename + ".json"
-        simple_config_filename = "tmp/" + filename + "_simple." + extension
-        new_backup_config_filename = "tmp/" + filename + ".json"
+        # The simple and new backup files are in-memory buffers
+        is_yaml = extension == 'yaml'
         backup_grammar_obj = jg.Grammar(backup_grammar.backup_schema)
         backup_file = jg.GrammarFile(filename=orig_backup_config_filename)
         orig_backup_model = backup_grammar_obj.parse_config(backup_file.load())
@@ -69,12 +69,12 @@ class SimpleTestCase(unittest.TestCase):
 
         # Save the simple model to a file
         int_grammar = jg.Grammar(simple_grammar.simple_schema, True)
-        int_file = jg.GrammarFile(filename=simple_config_filename)
+        int_file = jg.GrammarFile(is_yaml=is_yaml)
         int_file.save(int_grammar.gen_config(orig_int_model))
 
         # Load the simple string back to a model
         reloaded_int_grammar = jg.Grammar(simple_grammar.simple_schema, True)
-        reloaded_int_file = jg.GrammarFile(simple_config_filename)
+        reloaded_int_file = jg.GrammarFile(is_yaml=is_yaml, text=int_file.getvalue())
         reloaded_int_model = reloaded_int_grammar.parse_config(reloaded_int_file.load())
 
         # Compare the reloaded model
@@ -92,12 +92,12 @@ class SimpleTestCase(unittest.TestCase):
 
         # Save a new config file
         reloaded_backup_file_grammar = jg.Grammar(backup_grammar.backup_schema)
-        reloaded_backup_file = jg.GrammarFile(filename=new_backup_config_filename)
+        reloaded_backup_file = jg.GrammarFile(is_yaml=False)
         reloaded_backup_file.save(reloaded_backup_file_grammar.gen_config(reloaded_backup_model))
 
         # Load the new config file
         rereloaded_backup_grammar = jg.Grammar(backup_grammar.backup_schema)
-        rereloaded_backup_file = jg.GrammarFile(filename=new_backup_config_filename)
+        rereloaded_backup_file = jg.GrammarFile(is_yaml=False, text=reloaded_backup_file.getvalue())
         rereloaded_backup_model = rereloaded_backup_grammar.parse_config(rereloaded_backup_file.load())
         self.assertEqual(rereloaded_backup_model, orig_backup_model)
 
@@ -159,7 +159,7 @@ class SimpleTestCase(unittest.TestCase):
     #
     def test_demo(self):
         backup_conf = jg.Grammar(backup_grammar.backup_schema)
-        backup_file = jg.GrammarFile('tmp/Demo_test.json')
+        backup_file = jg.GrammarFile(is_yaml=False)
         simple_conf = jg.Grammar(simple_grammar.simple_schema, minimal=True)
         simple_file = jg.GrammarFile('Configs/Test/Demo.yaml')
         simple_model = simple_conf.parse_config(simple_file.load())